@@ -1,18 +1,35 @@
 from __future__ import annotations
 
+import argparse
+import cProfile
+import fcntl
+import functools
+import hashlib
+import heapq
+import io
 import json
 import math
 import os
+import pstats
 import re
+import secrets
+import select
 import shutil
+import signal
+import socket
 import stat
 import subprocess
+import sys
+import tarfile
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, Callable
 
-from flask import Flask, jsonify, redirect, render_template, request, url_for
+from flask import Flask, Response, g, has_request_context, jsonify, redirect, render_template, request, url_for
 
 app = Flask(__name__)
 
@@ -38,6 +55,51 @@ def _inject_static_versions() -> dict[str, int]:
     }
 
 
+@app.before_request
+def _start_request_timer() -> None:
+    g.request_started = time.perf_counter()
+    root = _new_span("request", g.request_started)
+    g.trace = {"root": root, "stack": [root]}
+    if PROFILE_ENABLED and (request.args.get("profile") or "").strip() == "1":
+        g.profiler = _start_profiler()
+
+
+@app.after_request
+def _observe_request(resp: Response) -> Response:
+    started = g.get("request_started")
+    if started is None:
+        return resp
+    elapsed = time.perf_counter() - started
+    rule = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+    _metrics.observe(
+        "hyperdrive_http_request_duration_seconds",
+        {"route": rule, "method": request.method, "status": str(resp.status_code)},
+        elapsed,
+    )
+
+    trace = g.pop("trace", None)
+    if trace is None:
+        return resp
+    root = trace["root"]
+    root["ms"] = round(elapsed * 1000, 3)
+    profile = _stop_profiler(g.pop("profiler", None))
+    resp.headers["Server-Timing"] = _server_timing(root, profile is not None)
+    _slow_requests.record(
+        {
+            "at": time.time(),
+            "pid": os.getpid(),
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "route": rule,
+            "status": resp.status_code,
+            "ms": root["ms"],
+            "spans": _strip_span(root)["children"],
+            "profile": profile,
+        }
+    )
+    return resp
+
+
 DEVICE_ID_RE = re.compile(r"^[A-Za-z0-9]+$")
 UUID_RE = re.compile(r"^[A-Fa-f0-9-]+$")
 
@@ -48,6 +110,13 @@ ALLOWED_MOUNT_PREFIXES = ("/mnt/", "/media/")
 SYSTEM_MOUNTPOINTS = {"/", "/boot", "/boot/efi"}
 SYSTEM_PREFIXES = ("/proc", "/sys", "/dev", "/run", "/snap", "/var/lib/snapd")
 
+FSTAB_PATH = "/etc/fstab"
+SMB_CONF_PATH = "/etc/samba/smb.conf"
+# Estado compartido entre workers (trabajos, locks...). tmpfs: se vacía al reiniciar.
+STATE_DIR = os.getenv("DISKMANAGER_STATE_DIR", "/run/hyperdrive")
+# Datos que sobreviven a reinicios del servicio (último estado conocido).
+DATA_DIR = os.getenv("DISKMANAGER_DATA_DIR", "/var/lib/hyperdrive")
+
 
 def _parse_size_to_bytes(value: Any) -> int | None:
     if value is None:
@@ -84,19 +153,16 @@ def _parse_size_to_bytes(value: Any) -> int | None:
     return None
 
 
-def _is_noise_partition(p: dict[str, Any]) -> bool:
+def _is_noise_partition(p: DeviceNode) -> bool:
     # Evita mostrar particiones pequeñas “técnicas” (p.ej. MSR de Windows ~16MB)
     # que suelen venir sin UUID y sin fstype y no son gestionables desde esta UI.
-    if (p.get("type") or "") != "part":
+    if p.type != "part":
         return False
-    fstype = (p.get("fstype") or "").strip().lower()
-    uuid = (p.get("uuid") or "").strip()
-    if fstype or uuid:
+    if p.fstype or p.uuid:
         return False
-    size_b = _parse_size_to_bytes(p.get("size"))
-    if size_b is None:
+    if p.size_bytes is None:
         return False
-    return size_b <= 64 * 1024 * 1024
+    return p.size_bytes <= 64 * 1024 * 1024
 
 
 def _root_physical_disk(parts: list[dict[str, Any]]) -> str | None:
@@ -106,37 +172,381 @@ def _root_physical_disk(parts: list[dict[str, Any]]) -> str | None:
     hasta llegar al disco superior (p.ej. ubuntu-lv -> sda3 -> sda).
     """
 
-    root_name: str | None = None
-    for p in parts:
-        if (p.get("mountpoint") or "") == "/":
-            root_name = p.get("name") or None
-            break
-    if not root_name:
+    return DeviceGraph(parts).root_disk
+
+
+# ---- Métricas (Prometheus) ----
+
+# Cada worker acumula sus contadores/histogramas en memoria y los vuelca cada
+# METRICS_FLUSH_S a METRICS_DIR/<pid>.json; /metrics suma los de todos (los de
+# workers ya muertos también, para que los contadores no retrocedan).
+METRICS_DIR = os.path.join(STATE_DIR, "metrics")
+METRICS_FLUSH_S = 5.0
+# Ficheros de workers muertos que llevan más de esto sin tocarse se borran.
+METRICS_KEEP_DEAD_S = 3600.0
+# Límites de los histogramas de latencia, en segundos.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRICS_HELP: dict[str, tuple[str, str]] = {
+    "hyperdrive_http_request_duration_seconds": ("histogram", "Latencia de las peticiones HTTP por ruta."),
+    "hyperdrive_command_duration_seconds": ("histogram", "Duración de los comandos externos por ejecutable."),
+    "hyperdrive_command_timeouts_total": ("counter", "Comandos externos cortados por timeout (rc 124)."),
+    "hyperdrive_command_failures_total": ("counter", "Comandos externos terminados con error."),
+    "hyperdrive_enumeration_duration_seconds": ("histogram", "Duración de la enumeración de dispositivos."),
+    "hyperdrive_usage_probe_duration_seconds": ("histogram", "Duración de cada sondeo de uso (statvfs)."),
+    "hyperdrive_usage_probe_timeouts_total": ("counter", "Sondeos de uso que no respondieron a tiempo."),
+}
+
+_MetricKey = tuple[tuple[str, str], ...]
+
+
+class _Metrics:
+    """Contadores e histogramas de este proceso (etiquetas como tuplas ordenadas)."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pid: int | None = None
+        self._counters: dict[str, dict[_MetricKey, float]] = {}
+        # Por serie: cuentas acumuladas por bucket + suma + total.
+        self._histograms: dict[str, dict[_MetricKey, list[float]]] = {}
+        self._dirty = False
+
+    def _ensure_process(self) -> None:
+        # Llamado con el lock tomado. Tras un fork empezamos de cero con hilo propio.
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        self._pid = pid
+        self._counters = {}
+        self._histograms = {}
+        threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True).start()
+
+    def inc(self, name: str, labels: dict[str, str], value: float = 1.0) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._ensure_process()
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+            self._dirty = True
+
+    def observe(self, name: str, labels: dict[str, str], seconds: float) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._ensure_process()
+            series = self._histograms.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = series[key] = [0.0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+            self._dirty = True
+
+    def dump(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "counters": {n: [[list(k), v] for k, v in s.items()] for n, s in self._counters.items()},
+                "histograms": {n: [[list(k), list(h)] for k, h in s.items()] for n, s in self._histograms.items()},
+            }
+
+    def _flush_loop(self) -> None:
+        pid = os.getpid()
+        path = os.path.join(METRICS_DIR, f"{pid}.json")
+        while self._pid == pid:
+            time.sleep(METRICS_FLUSH_S)
+            with self._lock:
+                dirty, self._dirty = self._dirty, False
+            if not dirty:
+                continue
+            try:
+                _write_json_atomic(path, self.dump())
+            except OSError:
+                pass
+
+    def merged(self) -> dict[str, Any]:
+        """Suma de todos los workers (este, en memoria; los demás, desde su fichero)."""
+
+        dumps = [self.dump()]
+        me = f"{os.getpid()}.json"
+        try:
+            names = os.listdir(METRICS_DIR)
+        except OSError:
+            names = []
+        for name in names:
+            if name == me or not name.endswith(".json"):
+                continue
+            path = os.path.join(METRICS_DIR, name)
+            try:
+                pid = int(name[:-5])
+                if not _pid_alive(pid) and time.time() - os.path.getmtime(path) > METRICS_KEEP_DEAD_S:
+                    os.unlink(path)
+                    continue
+                with open(path, "r", encoding="utf-8") as f:
+                    dumps.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+        counters: dict[str, dict[_MetricKey, float]] = {}
+        histograms: dict[str, dict[_MetricKey, list[float]]] = {}
+        for d in dumps:
+            for n, series in (d.get("counters") or {}).items():
+                out = counters.setdefault(n, {})
+                for labels, v in series:
+                    k = tuple((str(a), str(b)) for a, b in labels)
+                    out[k] = out.get(k, 0.0) + float(v)
+            for n, series in (d.get("histograms") or {}).items():
+                out_h = histograms.setdefault(n, {})
+                for labels, h in series:
+                    k = tuple((str(a), str(b)) for a, b in labels)
+                    acc = out_h.get(k)
+                    if acc is None or len(acc) != len(h):
+                        out_h[k] = [float(x) for x in h]
+                    else:
+                        for i, x in enumerate(h):
+                            acc[i] += float(x)
+        return {"counters": counters, "histograms": histograms}
+
+
+_metrics = _Metrics()
+
+
+def _prom_escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _prom_labels(labels: _MetricKey | list[tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_prom_escape(v)}"' for k, v in labels) + "}"
+
+
+def _prom_number(v: float) -> str:
+    v = float(v)
+    if v == math.inf:
+        return "+Inf"
+    return str(int(v)) if v.is_integer() else repr(v)
+
+
+def _command_name(args: list[str]) -> str:
+    return os.path.basename(args[0]) if args else "-"
+
+
+def _record_command(args: list[str], seconds: float, rc: int) -> None:
+    labels = {"command": _command_name(args)}
+    _metrics.observe("hyperdrive_command_duration_seconds", labels, seconds)
+    if rc == 124:
+        _metrics.inc("hyperdrive_command_timeouts_total", labels)
+    elif rc != 0:
+        _metrics.inc("hyperdrive_command_failures_total", labels)
+
+
+# ---- Trazas por request (Server-Timing, /debug/slow) ----
+
+# Cada request lleva en `g.trace` un árbol de spans (lsblk, fstab, samba, usage,
+# comandos, render...). Al terminar se resume en la cabecera Server-Timing y,
+# si está entre las más lentas, se guarda con su árbol para /debug/slow.
+SLOW_REQUESTS_KEEP = int(os.getenv("DISKMANAGER_SLOW_REQUESTS", "20"))
+SLOW_DIR = os.path.join(STATE_DIR, "slow")
+# cProfile por request (?profile=1) solo si se habilita explícitamente.
+PROFILE_ENABLED = os.getenv("DISKMANAGER_PROFILE", "0") == "1"
+PROFILE_KEEP = 10
+PROFILE_TOP_N = 40
+
+
+def _new_span(name: str, started: float) -> dict[str, Any]:
+    return {"name": name, "start_ms": 0.0, "ms": 0.0, "children": [], "_t0": started}
+
+
+@contextmanager
+def span(name: str):
+    """Mide el bloque como hijo del span actual del request (no-op fuera de un request)."""
+
+    trace = g.get("trace") if has_request_context() else None
+    if trace is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    node = _new_span(name, t0)
+    node["start_ms"] = round((t0 - trace["root"]["_t0"]) * 1000, 3)
+    trace["stack"][-1]["children"].append(node)
+    trace["stack"].append(node)
+    try:
+        yield
+    finally:
+        node["ms"] = round((time.perf_counter() - t0) * 1000, 3)
+        trace["stack"].pop()
+
+
+def traced(name: str) -> Callable:
+    """Decorador: cada llamada a la función es un span `name`."""
+
+    def deco(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return deco
+
+
+def _strip_span(node: dict[str, Any]) -> dict[str, Any]:
+    """Copia serializable del árbol (sin los tiempos internos)."""
+
+    return {
+        "name": node["name"],
+        "start_ms": node["start_ms"],
+        "ms": node["ms"],
+        "children": [_strip_span(c) for c in node["children"]],
+    }
+
+
+def _server_timing(root: dict[str, Any], profiled: bool) -> str:
+    """Cabecera Server-Timing: duración total y acumulada por nombre de span."""
+
+    totals: dict[str, list[float]] = {}
+
+    def walk(node: dict[str, Any]) -> None:
+        for c in node["children"]:
+            acc = totals.setdefault(c["name"], [0.0, 0])
+            acc[0] += c["ms"]
+            acc[1] += 1
+            walk(c)
+
+    walk(root)
+    parts = [f"total;dur={root['ms']:.1f}"]
+    for name, (ms, n) in sorted(totals.items(), key=lambda kv: -kv[1][0]):
+        token = re.sub(r"[^A-Za-z0-9._-]", "_", name)
+        parts.append(f'{token};dur={ms:.1f};desc="x{n}"' if n > 1 else f"{token};dur={ms:.1f}")
+    if profiled:
+        parts.append('profile;desc="/debug/slow"')
+    return ", ".join(parts)
+
+
+# cProfile no admite dos perfiles activos a la vez: uno como mucho por proceso.
+_profile_lock = threading.Lock()
+
+
+def _start_profiler() -> cProfile.Profile | None:
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:
+        # Otra herramienta de profiling activa (depurador...).
+        _profile_lock.release()
+        return None
+    return prof
+
+
+def _stop_profiler(prof: cProfile.Profile | None) -> str | None:
+    if prof is None:
         return None
+    try:
+        prof.disable()
+    finally:
+        _profile_lock.release()
+    out = io.StringIO()
+    pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    return out.getvalue()
 
-    name_to_parent: dict[str, str] = {}
-    for p in parts:
-        n = (p.get("name") or "").strip()
-        parent = (p.get("pkname") or "").strip()
-        if n and parent:
-            name_to_parent[n] = parent
 
-    cur = root_name
-    seen: set[str] = set()
-    while True:
-        parent = name_to_parent.get(cur)
-        if not parent:
-            return cur
-        if parent in seen:
-            return parent
-        seen.add(parent)
-        cur = parent
+class _SlowRequests:
+    """Las N requests más lentas de este worker (+ los últimos perfiles pedidos).
+
+    Se vuelcan a SLOW_DIR/<pid>.json cuando cambian para que /debug/slow pueda
+    enseñar las de todos los workers.
+    """
+
+    def __init__(self, keep: int) -> None:
+        self._lock = threading.Lock()
+        self._keep = max(1, keep)
+        self._pid: int | None = None
+        self._slowest: list[tuple[float, int, dict[str, Any]]] = []
+        self._profiles: list[dict[str, Any]] = []
+        self._seq = 0
+
+    def record(self, entry: dict[str, Any]) -> None:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._slowest = []
+                self._profiles = []
+            changed = False
+            if entry.get("profile"):
+                self._profiles = (self._profiles + [entry])[-PROFILE_KEEP:]
+                changed = True
+            if len(self._slowest) < self._keep or entry["ms"] > self._slowest[0][0]:
+                self._seq += 1
+                item = (entry["ms"], self._seq, {k: v for k, v in entry.items() if k != "profile"})
+                if len(self._slowest) < self._keep:
+                    heapq.heappush(self._slowest, item)
+                else:
+                    heapq.heapreplace(self._slowest, item)
+                changed = True
+            if not changed:
+                return
+            data = self._dump_locked()
+        try:
+            _write_json_atomic(os.path.join(SLOW_DIR, f"{os.getpid()}.json"), data)
+        except OSError:
+            pass
+
+    def _dump_locked(self) -> dict[str, Any]:
+        return {"slowest": [e for _ms, _seq, e in self._slowest], "profiles": list(self._profiles)}
+
+    def merged(self) -> dict[str, Any]:
+        with self._lock:
+            dumps = [self._dump_locked()]
+        me = f"{os.getpid()}.json"
+        try:
+            names = os.listdir(SLOW_DIR)
+        except OSError:
+            names = []
+        for name in names:
+            if name == me or not name.endswith(".json"):
+                continue
+            try:
+                if not _pid_alive(int(name[:-5])):
+                    continue
+                with open(os.path.join(SLOW_DIR, name), "r", encoding="utf-8") as f:
+                    dumps.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        slowest = sorted((e for d in dumps for e in d.get("slowest") or []), key=lambda e: -e.get("ms", 0))
+        profiles = sorted((e for d in dumps for e in d.get("profiles") or []), key=lambda e: -e.get("at", 0))
+        return {"slowest": slowest[: self._keep], "profiles": profiles[:PROFILE_KEEP]}
+
+
+_slow_requests = _SlowRequests(SLOW_REQUESTS_KEEP)
+
+
+def render_page(template: str, **context: Any) -> str:
+    with span("render"):
+        return render_template(template, **context)
+
+
+def _run(args: list[str], *, timeout_s: int = 10, input: str | None = None) -> subprocess.CompletedProcess:
+    started = time.perf_counter()
+    rc = -1  # Si ni siquiera arranca (ejecutable ausente...), cuenta como fallo.
+    try:
+        with span(f"run.{_command_name(args)}"):
+            cp = _backend.run(args, timeout_s=timeout_s, input=input)
+        rc = cp.returncode
+        return cp
+    finally:
+        _record_command(args, time.perf_counter() - started, rc)
 
 
-def _run(args: list[str], *, timeout_s: int = 10) -> subprocess.CompletedProcess:
+def _run_process(args: list[str], *, timeout_s: int = 10, input: str | None = None) -> subprocess.CompletedProcess:
     try:
         return subprocess.run(
             args,
+            input=input,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True,
@@ -160,29 +570,350 @@ def _run(args: list[str], *, timeout_s: int = 10) -> subprocess.CompletedProcess
         return subprocess.CompletedProcess(args=args, returncode=124, stdout=stdout, stderr=detail)
 
 
-def _kernel_filesystems() -> set[str]:
+def _kill_process_group(proc: subprocess.Popen) -> None:
+    for sig, wait_s in ((signal.SIGTERM, 5), (signal.SIGKILL, 5)):
+        try:
+            os.killpg(proc.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+        try:
+            proc.wait(timeout=wait_s)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def _run_streaming_process(
+    args: list[str],
+    *,
+    timeout_s: int,
+    on_output: Callable[[str], None],
+    should_cancel: Callable[[], bool],
+) -> tuple[int, str]:
+    """Ejecuta `args` entregando la salida línea a línea; se puede cancelar.
+
+    mkfs reescribe la línea de progreso con \\r o \\b, así que partimos también
+    por ellos. Devuelve (returncode, últimas líneas); 124 = timeout, 130 = cancelado.
+    """
+
+    try:
+        proc = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+    except OSError as e:
+        return 127, str(e)
+
+    assert proc.stdout is not None
+    fd = proc.stdout.fileno()
+    poller = select.poll()
+    poller.register(fd, select.POLLIN | select.POLLHUP)
+    deadline = time.monotonic() + timeout_s
+    tail: list[str] = []
+    buf = b""
+    eof = False
+    rc: int | None = None
+
+    def emit(raw: bytes) -> None:
+        line = raw.decode("utf-8", errors="replace").strip()
+        if line:
+            tail.append(line)
+            del tail[:-40]
+            on_output(line)
+
+    try:
+        while rc is None:
+            if should_cancel():
+                _kill_process_group(proc)
+                rc = 130
+                break
+            if time.monotonic() > deadline:
+                _kill_process_group(proc)
+                tail.append(f"Timeout tras {timeout_s}s: {' '.join(args)}")
+                rc = 124
+                break
+            if eof:
+                try:
+                    rc = proc.wait(timeout=0.5)
+                except subprocess.TimeoutExpired:
+                    pass
+                continue
+            if not poller.poll(500):
+                continue
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                eof = True
+                continue
+            pieces = re.split(rb"[\r\n\b]+", buf + chunk)
+            buf = pieces.pop()
+            for piece in pieces:
+                emit(piece)
+        if buf:
+            emit(buf)
+    finally:
+        proc.stdout.close()
+    return rc, "\n".join(tail)
+
+
+# ---- Backend del sistema ----
+
+# Todo lo que toca el host (comandos, /etc/fstab, smb.conf, mountinfo, /dev,
+# statvfs, euid) pasa por `_backend`. Así se puede sustituir por uno simulado
+# (bench/fake_backend.py) para medir o cargar la capa web sin root ni discos.
+
+
+class SystemBackend:
+    """Implementación real: el sistema en el que corre la app."""
+
+    # Hay un kernel de verdad detrás: uevents por netlink, poll de mountinfo y sysfs.
+    kernel = True
+
+    def run(self, args: list[str], *, timeout_s: int = 10, input: str | None = None) -> subprocess.CompletedProcess:
+        return _run_process(args, timeout_s=timeout_s, input=input)
+
+    def run_streaming(
+        self,
+        args: list[str],
+        *,
+        timeout_s: int,
+        on_output: Callable[[str], None],
+        should_cancel: Callable[[], bool],
+    ) -> tuple[int, str]:
+        return _run_streaming_process(args, timeout_s=timeout_s, on_output=on_output, should_cancel=should_cancel)
+
+    def which(self, tool: str) -> str | None:
+        return shutil.which(tool)
+
+    def read_text(self, path: str) -> str:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return f.read()
+
+    def write_text(self, path: str, text: str) -> None:
+        _atomic_write_text(path, text)
+
+    def write_temp(self, directory: str, prefix: str, text: str) -> str:
+        """Fichero temporal nuevo en `directory` con `text`. Devuelve su ruta."""
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=prefix)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        return tmp_path
+
+    def remove(self, path: str) -> None:
+        os.unlink(path)
+
+    def signature(self, path: str) -> tuple[int, int, int] | None:
+        return _file_signature(path)
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(path)
+
+    def is_block_device(self, path: str) -> bool:
+        """True si `path` es un dispositivo de bloque; OSError si no existe."""
+
+        return stat.S_ISBLK(os.stat(path).st_mode)
+
+    def isdir(self, path: str) -> bool:
+        return os.path.isdir(path)
+
+    def listdir(self, path: str) -> list[str]:
+        return os.listdir(path)
+
+    def makedirs(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+
+    def rmdir(self, path: str) -> None:
+        os.rmdir(path)
+
+    def disk_usage(self, path: str) -> tuple[int, int, int]:
+        total, used, free = shutil.disk_usage(path)
+        return total, used, free
+
+    def geteuid(self) -> int:
+        return os.geteuid() if hasattr(os, "geteuid") else 0
+
+    def kernel_module_available(self, module: str) -> bool | None:
+        """¿Existe el módulo (compilado dentro o como .ko) para este kernel? None si no se sabe."""
+
+        base = os.path.join("/lib/modules", os.uname().release)
+        want = module.replace("-", "_")
+        known = False
+        for name in ("modules.builtin", "modules.dep"):
+            try:
+                with open(os.path.join(base, name), "r", encoding="utf-8", errors="replace") as f:
+                    known = True
+                    for line in f:
+                        mod = os.path.basename(line.split(":", 1)[0].strip()).split(".ko", 1)[0]
+                        if mod.replace("-", "_") == want:
+                            return True
+            except OSError:
+                continue
+        return False if known else None
+
+
+_backend = SystemBackend()
+
+
+def set_backend(backend: SystemBackend) -> SystemBackend:
+    """Instala otro backend y vacía todo lo cacheado del anterior. Devuelve el anterior."""
+
+    global _backend, _smb_conf_cache, _disk_state, _usage_prober
+    previous, _backend = _backend, backend
+    _smb_conf_cache = None
+    _disk_state = _DiskStateTracker()
+    _usage_prober = _UsageProber(USAGE_MAX_WORKERS)
+    _capabilities.refresh()
+    _inventory.invalidate()
+    _mount_table.refresh()
+    return previous
+
+
+# ---- Capacidades del sistema (herramientas, kernel) ----
+
+# Herramientas externas que usa la app; se sondean todas juntas y cada helper
+# solo consulta el registro en memoria.
+KNOWN_TOOLS = (
+    "udevadm",
+    "testparm",
+    "systemctl",
+    "smbcontrol",
+    "smbstatus",
+    "parted",
+    "sgdisk",
+    "sfdisk",
+    "wipefs",
+    "partprobe",
+    "modprobe",
+    "mkfs.ext4",
+    "mkfs.xfs",
+    "mkfs.exfat",
+    "mkfs.vfat",
+    "mkfs.ntfs",
+    "mount.ntfs-3g",
+)
+# Módulos que podemos necesitar cargar bajo demanda.
+KNOWN_MODULES = ("ntfs3",)
+# Cada cuánto, como mucho, se mira si cambió PATH o se instalaron paquetes.
+CAPABILITIES_RECHECK_S = 5.0
+DPKG_STATUS_PATH = "/var/lib/dpkg/status"
+
+
+def _read_kernel_filesystems() -> set[str]:
     fs: set[str] = set()
     try:
-        with open("/proc/filesystems", "r", encoding="utf-8", errors="replace") as f:
-            for raw in f:
-                line = raw.strip()
-                if not line:
-                    continue
-                # Formato típico: "nodev\tproc" o "ext4"
-                parts = line.split()
-                fs.add(parts[-1])
+        for raw in _backend.read_text("/proc/filesystems").splitlines():
+            line = raw.strip()
+            if not line:
+                continue
+            # Formato típico: "nodev\tproc" o "ext4"
+            parts = line.split()
+            fs.add(parts[-1])
     except Exception:
         return set()
     return fs
 
 
-def _try_modprobe(module: str) -> None:
-    # Best-effort: si no existe modprobe o no hay permisos, no hacemos nada.
-    if not module:
-        return
-    if not shutil.which("modprobe"):
-        return
-    _run(["modprobe", module], timeout_s=8)
+class _Capabilities:
+    """Registro de herramientas, filesystems del kernel y módulos disponibles.
+
+    Se sondea una vez (al primer uso) y se vuelve a sondear si cambia PATH, algún
+    directorio de PATH o la base de datos de paquetes, o a petición (`refresh`).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._tools: dict[str, str | None] = {}
+        self._filesystems: frozenset[str] = frozenset()
+        self._modules: dict[str, bool | None] = {}
+        self._trigger: tuple | None = None
+        self._checked_at = 0.0
+        self.probed_at = 0.0
+
+    @staticmethod
+    def _trigger_key() -> tuple:
+        path = os.environ.get("PATH", "")
+        dirs = tuple(_file_signature(d) for d in path.split(os.pathsep) if d)
+        return (path, dirs, _file_signature(DPKG_STATUS_PATH), os.uname().release)
+
+    def refresh(self) -> None:
+        trigger = self._trigger_key()
+        tools = {t: _backend.which(t) for t in KNOWN_TOOLS}
+        filesystems = frozenset(_read_kernel_filesystems())
+        modules = {m: _backend.kernel_module_available(m) for m in KNOWN_MODULES}
+        with self._lock:
+            self._tools = tools
+            self._filesystems = filesystems
+            self._modules = modules
+            self._trigger = trigger
+            self._checked_at = time.monotonic()
+            self.probed_at = time.time()
+
+    def _ensure_fresh(self) -> None:
+        now = time.monotonic()
+        if self._trigger is not None and now - self._checked_at < CAPABILITIES_RECHECK_S:
+            return
+        with self._lock:
+            self._checked_at = now
+            current = self._trigger
+        if current is None or self._trigger_key() != current:
+            self.refresh()
+
+    def which(self, tool: str) -> str | None:
+        self._ensure_fresh()
+        with self._lock:
+            if tool in self._tools:
+                return self._tools[tool]
+        # Herramienta fuera de KNOWN_TOOLS: la sondeamos una vez y queda registrada.
+        found = _backend.which(tool)
+        with self._lock:
+            self._tools[tool] = found
+        return found
+
+    def has(self, tool: str) -> bool:
+        return self.which(tool) is not None
+
+    def filesystems(self) -> frozenset[str]:
+        self._ensure_fresh()
+        return self._filesystems
+
+    def has_filesystem(self, fstype: str) -> bool:
+        return fstype in self.filesystems()
+
+    def ensure_filesystem(self, fstype: str, module: str | None = None) -> bool:
+        """True si el kernel soporta `fstype`, cargando su módulo si hace falta (best-effort)."""
+
+        if self.has_filesystem(fstype):
+            return True
+        module = module or fstype
+        with self._lock:
+            available = self._modules.get(module)
+        # Solo intentamos modprobe si el módulo existe (o no sabemos si existe).
+        if available is False or not self.has("modprobe"):
+            return False
+        _run(["modprobe", module], timeout_s=8)
+        filesystems = frozenset(_read_kernel_filesystems())
+        with self._lock:
+            self._filesystems = filesystems
+            if fstype not in filesystems:
+                # No reintentamos en cada montaje; un refresh lo vuelve a permitir.
+                self._modules[module] = False
+        return fstype in filesystems
+
+    def public(self) -> dict[str, Any]:
+        self._ensure_fresh()
+        with self._lock:
+            return {
+                "probed_at": self.probed_at,
+                "tools": {t: p for t, p in sorted(self._tools.items())},
+                "filesystems": sorted(self._filesystems),
+                "modules": dict(self._modules),
+            }
+
+
+_capabilities = _Capabilities()
 
 
 def _mount_ntfs(dev_path: str, mountpoint: str) -> subprocess.CompletedProcess:
@@ -197,17 +928,13 @@ def _mount_ntfs(dev_path: str, mountpoint: str) -> subprocess.CompletedProcess:
     uid, gid = _default_uid_gid()
     options = f"defaults,nofail,uid={uid},gid={gid}"
 
-    fs = _kernel_filesystems()
-    if "ntfs3" not in fs:
-        _try_modprobe("ntfs3")
-        fs = _kernel_filesystems()
-    if "ntfs3" in fs:
+    if _capabilities.ensure_filesystem("ntfs3"):
         cp = _run(["mount", "-t", "ntfs3", "-o", options, dev_path, mountpoint], timeout_s=25)
         if cp.returncode == 0:
             return cp
 
     # ntfs-3g depende del helper mount.ntfs-3g (paquete ntfs-3g)
-    if shutil.which("mount.ntfs-3g"):
+    if _capabilities.has("mount.ntfs-3g"):
         cp = _run(["mount", "-t", "ntfs-3g", "-o", options, dev_path, mountpoint], timeout_s=25)
         if cp.returncode == 0:
             return cp
@@ -215,6 +942,17 @@ def _mount_ntfs(dev_path: str, mountpoint: str) -> subprocess.CompletedProcess:
     return _run(["mount", "-o", options, dev_path, mountpoint], timeout_s=25)
 
 
+def _mount_device_at(dev_path: str, fstype: str, mountpoint: str) -> subprocess.CompletedProcess:
+    """Montaje directo (sin fstab) de `dev_path` en `mountpoint`."""
+
+    _backend.makedirs(mountpoint)
+    if (fstype or "").lower() in {"ntfs", "ntfs3"}:
+        return _mount_ntfs(dev_path, mountpoint)
+    if _capabilities.has("udevadm"):
+        _run(["udevadm", "settle"], timeout_s=10)
+    return _run(["mount", dev_path, mountpoint], timeout_s=30)
+
+
 def _truncate(text: str, *, limit: int = 1200) -> str:
     text = (text or "").strip()
     if len(text) <= limit:
@@ -223,7 +961,7 @@ def _truncate(text: str, *, limit: int = 1200) -> str:
 
 
 def _require_root() -> tuple[bool, str]:
-    if hasattr(os, "geteuid") and os.geteuid() != 0:
+    if _backend.geteuid() != 0:
         return (
             False,
             "Permiso denegado: ejecuta la app como root (ej: sudo python app.py) para montar/desmontar o editar /etc/fstab/Samba.",
@@ -302,8 +1040,8 @@ def _cleanup_mount_dir(path: str) -> None:
     if not _looks_safe_mountpoint(path):
         return
     try:
-        if os.path.isdir(path) and not os.listdir(path):
-            os.rmdir(path)
+        if _backend.isdir(path) and not _backend.listdir(path):
+            _backend.rmdir(path)
     except Exception:
         return
 
@@ -332,265 +1070,907 @@ def _remove_diskmanager_fstab_block(lines: list[str], entry_idx: int) -> None:
                 del lines[blank_idx]
 
 
-def _apply_samba_reload() -> None:
-    # En algunas distros `reload` no aplica cambios o el unit name es distinto.
-    # Intentamos reload y si falla, hacemos fallback a restart.
-    if not shutil.which("systemctl"):
-        return
+# ---- Bloqueos entre workers (fcntl) ----
 
-    units = ["smbd", "smb", "nmbd"]
+# Con varios workers de gunicorn, dos POST concurrentes pueden leer-modificar-
+# escribir el mismo fichero y perder uno de los cambios. Estos locks (flock
+# sobre ficheros en LOCKS_DIR) serializan a los escritores entre procesos e
+# hilos; los lectores toman el lock compartido solo mientras leen.
+LOCKS_DIR = os.path.join(STATE_DIR, "locks")
+LOCK_TIMEOUT_S = float(os.getenv("DISKMANAGER_LOCK_TIMEOUT_S", "30"))
+# Un lector nunca espera más que esto: las escrituras son por rename atómico,
+# así que leer sin lock da una versión completa (como mucho, la anterior).
+READ_LOCK_TIMEOUT_S = 2.0
+DEVICE_LOCK_TIMEOUT_S = float(os.getenv("DISKMANAGER_DEVICE_LOCK_TIMEOUT_S", "10"))
 
-    reloaded_any = False
-    for u in units:
-        cp = _run(["systemctl", "reload", u], timeout_s=15)
-        if cp.returncode == 0:
-            reloaded_any = True
+# Orden de adquisición (para no interbloquearse): dev-* -> fstab -> smb.conf -> samba-apply.
+LOCK_FSTAB = "fstab"
+LOCK_SMB_CONF = "smb.conf"
+LOCK_JOBS = "jobs"
 
-    if reloaded_any:
-        return
+_held_locks = threading.local()
 
-    # Fallback: restart (más agresivo, pero más fiable para aplicar smb.conf)
-    for u in units:
-        _run(["systemctl", "restart", u], timeout_s=25)
 
+class LockBusy(Exception):
+    """No se obtuvo el lock dentro del plazo (otra operación lo tiene)."""
 
-def _norm_path(p: str) -> str:
-    p = (p or "").strip()
-    if p.endswith("/") and len(p) > 1:
-        p = p.rstrip("/")
-    return p
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self.name = name
 
 
-def _samba_enabled_share_for_path(path: str) -> bool:
-    target = _norm_path(path)
-    if not target:
-        return False
-    for s in samba_shares():
-        if not s.get("enabled"):
-            continue
-        if _norm_path(s.get("path") or "") == target:
-            return True
-    return False
+def _lock_fd(name: str) -> int | None:
+    try:
+        os.makedirs(LOCKS_DIR, mode=0o700, exist_ok=True)
+        return os.open(os.path.join(LOCKS_DIR, name + ".lock"), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+    except OSError:
+        # Sin STATE_DIR escribible (p.ej. ejecutando sin root en desarrollo) no
+        # hay nadie con quien competir por escribir: seguimos sin lock.
+        return None
 
 
-def _samba_share_exists_for_path(path: str) -> bool:
-    target = _norm_path(path)
-    if not target:
-        return False
-    for s in samba_shares():
-        if _norm_path(s.get("path") or "") == target:
-            return True
-    return False
+@contextmanager
+def state_lock(name: str, *, shared: bool = False, timeout_s: float | None = None):
+    """Lock con nombre, compartido (lectores) o exclusivo (escritores).
 
+    Reentrante dentro del mismo hilo; no permite subir de compartido a exclusivo.
+    """
 
-def _write_samba_conf_lines(lines: list[str]) -> tuple[bool, str, str]:
-    """Escribe smb.conf de forma segura. Returns (ok, backup_path, error_details)."""
+    if getattr(_held_locks, "pid", None) != os.getpid():
+        # Tras un fork el hijo hereda el thread-local, pero no es dueño de esos locks.
+        _held_locks.pid = os.getpid()
+        _held_locks.held = {}
+    held: dict[str, list[Any]] = _held_locks.held
+    cur = held.get(name)
+    if cur is not None:
+        if not shared and not cur[1]:
+            raise RuntimeError(f"No se puede pasar el lock '{name}' de compartido a exclusivo.")
+        cur[2] += 1
+        try:
+            yield
+        finally:
+            cur[2] -= 1
+        return
 
-    smb_conf = "/etc/samba/smb.conf"
-    if not os.path.exists(smb_conf):
-        return (False, "", "No existe /etc/samba/smb.conf")
+    fd = _lock_fd(name)
+    if fd is None:
+        yield
+        return
 
-    backup = f"/etc/samba/smb.conf.bak.diskmanager.{int(time.time())}"
-    tmp_path = ""
+    op = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB
+    deadline = time.monotonic() + (LOCK_TIMEOUT_S if timeout_s is None else timeout_s)
+    delay = 0.01
     try:
-        with tempfile.NamedTemporaryFile(
-            mode="w",
-            encoding="utf-8",
-            delete=False,
-            dir=os.path.dirname(smb_conf),
-            prefix=".smb.conf.diskmanager.",
-        ) as tf:
-            tf.writelines(lines)
-            tmp_path = tf.name
-
-        if shutil.which("testparm"):
-            cp = _run(["testparm", "-s", tmp_path], timeout_s=25)
-            if cp.returncode != 0:
-                err = _truncate((cp.stderr or cp.stdout or ""))
-                try:
-                    os.unlink(tmp_path)
-                except Exception:
-                    pass
-                return (False, "", f"Configuración Samba inválida (testparm):\n{err}")
-
-        shutil.copy2(smb_conf, backup)
+        while True:
+            try:
+                fcntl.flock(fd, op)
+                break
+            except BlockingIOError:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise LockBusy(name) from None
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 0.2)
+        held[name] = [fd, not shared, 1]
         try:
-            st = os.stat(smb_conf)
-            os.chmod(tmp_path, st.st_mode)
-        except Exception:
-            pass
-        os.replace(tmp_path, smb_conf)
-        tmp_path = ""
-        return (True, backup, "")
+            yield
+        finally:
+            del held[name]
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
 
-    except Exception as e:
-        if tmp_path:
-            try:
-                os.unlink(tmp_path)
-            except Exception:
-                pass
-        if os.path.exists(backup):
-            try:
-                shutil.copy2(backup, smb_conf)
-            except Exception:
-                pass
-        return (False, "", _truncate(str(e)))
 
+@contextmanager
+def read_lock(name: str):
+    """Lock compartido para leer; si un escritor tarda, se lee igualmente."""
 
-def _find_share_block_by_path(lines: list[str], target_path: str) -> tuple[int, int] | None:
-    """Encuentra el bloque [share] cuyo 'path' coincide con `target_path`.
+    acquired = False
+    try:
+        with state_lock(name, shared=True, timeout_s=READ_LOCK_TIMEOUT_S):
+            acquired = True
+            yield
+    except LockBusy:
+        if acquired:
+            raise
+        yield
 
-    Robustez:
-    - No depende del espaciado ("path=/x" vs "path = /x")
-    - Normaliza trailing slashes
-    """
 
-    tp = _norm_path(target_path)
-    if not tp:
-        return None
+def locked(*names: str):
+    """Decorador: ejecuta la vista con los locks exclusivos `names` (en ese orden)."""
 
-    start: int | None = None
-    name: str | None = None
+    def deco(fn: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with ExitStack() as stack:
+                for name in names:
+                    stack.enter_context(state_lock(name))
+                return fn(*args, **kwargs)
 
-    def block_has_path(a: int, b: int) -> bool:
-        for raw in lines[a:b]:
-            s = raw.strip()
-            if not s or s.startswith("#") or s.startswith(";"):
-                continue
-            if "=" not in s:
-                continue
-            k, v = [p.strip() for p in s.split("=", 1)]
-            if k.lower() == "path":
-                return _norm_path(v) == tp
-        return False
+        return wrapper
 
-    for i, raw in enumerate(lines):
-        line = raw.strip()
-        if line.startswith("[") and line.endswith("]"):
-            if start is not None and name and name.lower() != "global":
-                if block_has_path(start, i):
-                    return (start, i)
-            start = i
-            name = line[1:-1].strip()
+    return deco
 
-    if start is not None and name and name.lower() != "global":
-        if block_has_path(start, len(lines)):
-            return (start, len(lines))
 
-    return None
+def device_locked(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """Decorador: lock del disco físico del `id` del body JSON durante la vista.
 
+    Plazo corto: si el disco está ocupado (p.ej. formateándose), mejor un 409
+    rápido que dejar la petición colgada.
+    """
 
-def _set_share_available_by_path(target_path: str, enable: bool, *, restart: bool = True) -> tuple[bool, str]:
-    """Activa/desactiva un share existente por su path usando 'available = yes/no'.
+    @functools.wraps(fn)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        dev_id = str((request.get_json(silent=True) or {}).get("id") or "").strip()
+        if not DEVICE_ID_RE.match(dev_id):
+            return fn(*args, **kwargs)
+        with state_lock(device_lock_name(dev_id), timeout_s=DEVICE_LOCK_TIMEOUT_S):
+            return fn(*args, **kwargs)
 
-    Returns: (changed, details). If no share exists for the path, changed=False.
-    """
+    return wrapper
 
-    smb_conf = "/etc/samba/smb.conf"
-    if not os.path.exists(smb_conf):
-        return (False, "Samba no instalado (no smb.conf).")
 
-    try:
-        with open(smb_conf, "r", encoding="utf-8", errors="replace") as f:
-            lines = f.readlines()
-    except Exception as e:
-        return (False, f"No se pudo leer smb.conf: {e}")
+def device_lock_name(dev_id: str) -> str:
+    """Lock por disco físico: particiones del mismo disco comparten lock."""
 
-    block = _find_share_block_by_path(lines, target_path)
-    if not block:
-        return (False, "No hay share existente para ese path.")
+    disk = inventory_graph().physical_disk(dev_id) or dev_id
+    return f"dev-{disk}"
 
-    a, b = block
-    desired = "yes" if enable else "no"
-    changed = False
 
-    # Buscar y actualizar (o insertar) la línea 'available'.
-    for i in range(a + 1, b):
-        raw = lines[i]
-        stripped = raw.strip()
-        if not stripped or stripped.startswith("#") or stripped.startswith(";"):
-            continue
-        if "=" not in stripped:
-            continue
-        k, v = [p.strip() for p in stripped.split("=", 1)]
-        if k.lower() == "available":
-            if v.lower() == desired:
-                return (False, f"Share ya estaba available={desired}.")
-            indent = re.match(r"^\s*", raw).group(0)
-            lines[i] = f"{indent}available = {desired}\n"
-            changed = True
-            break
-
-    if not changed:
-        # Insertar justo después del header del share.
-        lines.insert(a + 1, f"   available = {desired}\n")
-        changed = True
-
-    ok, backup, err = _write_samba_conf_lines(lines)
-    if not ok:
-        return (False, f"No se aplicaron cambios en Samba. {err}")
+@app.errorhandler(LockBusy)
+def _lock_busy(e: LockBusy):
+    return (
+        jsonify(
+            {
+                "ok": False,
+                "message": "Hay otra operación en curso sobre este recurso; inténtalo de nuevo en unos segundos.",
+                "details": f"Recurso ocupado: {e.name}",
+            }
+        ),
+        409,
+    )
 
-    if restart:
-        _apply_samba_restart()
-    return (True, f"Share actualizado (available={desired}). Backup: {backup}")
 
+# ---- Single-flight e idempotencia ----
 
-def _remove_share_block_by_path(target_path: str) -> tuple[bool, str]:
-    """Elimina el bloque del share que apunta a `path = <target_path>`.
 
-    Returns: (changed, details). If no share exists for the path, changed=False.
+class _SingleFlight:
+    """Coalesce llamadas concurrentes con la misma clave en un único cálculo.
+
+    El primero ejecuta `fn`; los que llegan mientras tanto esperan y reciben
+    el mismo resultado (o la misma excepción). No cachea nada después.
     """
 
-    smb_conf = "/etc/samba/smb.conf"
-    if not os.path.exists(smb_conf):
-        return (False, "Samba no instalado (no smb.conf).")
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: dict[Any, list[Any]] = {}
+
+    def do(self, key: Any, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                # [evento, resultado, excepción]
+                call = self._calls[key] = [threading.Event(), None, None]
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        try:
+            call[1] = fn()
+            return call[1]
+        except BaseException as e:
+            call[2] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call[0].set()
 
-    try:
-        with open(smb_conf, "r", encoding="utf-8", errors="replace") as f:
-            lines = f.readlines()
-    except Exception as e:
-        return (False, f"No se pudo leer smb.conf: {e}")
 
-    block = _find_share_block_by_path(lines, target_path)
-    if not block:
-        return (False, "No había share para ese path.")
+_singleflight = _SingleFlight()
 
-    a, b = block
-    del lines[a:b]
+IDEMPOTENCY_DIR = os.path.join(STATE_DIR, "idempotency")
+IDEMPOTENCY_TTL_S = float(os.getenv("DISKMANAGER_IDEMPOTENCY_TTL_S", "600"))
+IDEMPOTENCY_KEY_MAX = 200
+# Limpiar caducadas recorre todo el directorio: como mucho una vez por intervalo
+# y proceso, y en un hilo aparte (nunca en el camino de la petición).
+IDEMPOTENCY_PRUNE_INTERVAL_S = IDEMPOTENCY_TTL_S / 10
+
+_idempotency_prune_lock = threading.Lock()
+_idempotency_pruned_at = 0.0
 
-    ok, backup, err = _write_samba_conf_lines(lines)
-    if not ok:
-        return (False, f"No se aplicaron cambios en Samba. {err}")
 
-    _apply_samba_restart()
-    return (True, f"Share eliminado. Backup: {backup}")
+def _maybe_prune_idempotency(now: float) -> None:
+    global _idempotency_pruned_at
+    with _idempotency_prune_lock:
+        if now - _idempotency_pruned_at < IDEMPOTENCY_PRUNE_INTERVAL_S:
+            return
+        _idempotency_pruned_at = now
+    threading.Thread(target=_prune_idempotency, args=(now,), name="idempotency-prune", daemon=True).start()
 
 
-def _apply_samba_restart() -> None:
-    # Reinicio best-effort: intentamos varios unit names.
-    if not shutil.which("systemctl"):
+def _prune_idempotency(now: float) -> None:
+    try:
+        names = os.listdir(IDEMPOTENCY_DIR)
+    except OSError:
         return
-    for u in ["smbd", "smb", "nmbd"]:
-        _run(["systemctl", "restart", u], timeout_s=25)
+    for name in names:
+        path = os.path.join(IDEMPOTENCY_DIR, name)
+        try:
+            if now - os.stat(path).st_mtime > IDEMPOTENCY_TTL_S:
+                os.unlink(path)
+        except OSError:
+            pass
 
 
-def _format_commands(fstype: str, dev_path: str, label: str | None) -> list[str] | None:
-    fs = (fstype or "").strip().lower()
-    safe_label = (label or "").strip()
-    if safe_label:
-        safe_label = re.sub(r"[^A-Za-z0-9._-]", "_", safe_label)[:32]
+def _read_idempotency(path: str, now: float) -> dict[str, Any] | None:
+    """Registro de una clave (respuesta guardada o marca "en curso"), o None si no hay o caducó."""
 
-    if fs == "ext4":
-        if not shutil.which("mkfs.ext4"):
-            return None
-        args = ["mkfs.ext4", "-F"]
-        if safe_label:
-            args += ["-L", safe_label]
-        return args + [dev_path]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(stored, dict) or now - float(stored.get("at") or 0) > IDEMPOTENCY_TTL_S:
+        return None
+    if stored.get("pending") and not _pid_alive(int(stored.get("pid") or 0)):
+        # El worker que la estaba ejecutando murió: la clave vuelve a estar libre.
+        return None
+    return stored
 
-    if fs == "xfs":
-        if not shutil.which("mkfs.xfs"):
-            return None
+
+def idempotent(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """Decorador para POST con cabecera `Idempotency-Key`.
+
+    La primera petición con una clave deja una marca "en curso" en
+    IDEMPOTENCY_DIR (compartido entre workers), se ejecuta y guarda ahí su
+    respuesta. Los duplicados, incluso si llegan mientras la primera sigue en
+    curso, esperan (hasta LOCK_TIMEOUT_S; luego 409 con Retry-After) y reciben
+    esa misma respuesta sin repetir `mount`, `parted` o el apply de Samba. Ni
+    los 5xx ni los 409 (recurso ocupado) se guardan: reintentar debe volver a
+    ejecutarse.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        key = (request.headers.get("Idempotency-Key") or "").strip()
+        if not key:
+            return fn(*args, **kwargs)
+        if len(key) > IDEMPOTENCY_KEY_MAX:
+            return jsonify({"ok": False, "message": "Idempotency-Key demasiado larga."}), 400
+
+        digest = hashlib.sha256(f"{request.method} {request.path} {key}".encode()).hexdigest()
+        body_hash = hashlib.sha256(request.get_data()).hexdigest()
+        path = os.path.join(IDEMPOTENCY_DIR, digest + ".json")
+
+        deadline = time.monotonic() + LOCK_TIMEOUT_S
+        while True:
+            # Lock por tramo del hash (256 ficheros como mucho), solo para mirar y
+            # reclamar la clave: el handler corre fuera, así dos claves distintas
+            # del mismo tramo no se esperan entre sí.
+            with state_lock(f"idem-{digest[:2]}"):
+                now = time.time()
+                stored = _read_idempotency(path, now)
+                if stored is None:
+                    try:
+                        _write_json_atomic(path, {"at": now, "body": body_hash, "pending": True, "pid": os.getpid()})
+                    except OSError:
+                        pass
+                    break
+            if stored.get("body") != body_hash:
+                return (
+                    jsonify({"ok": False, "message": "Idempotency-Key ya usada con otra petición distinta."}),
+                    422,
+                )
+            if not stored.get("pending"):
+                resp = app.response_class(stored["data"], status=stored["status"], mimetype=stored["mimetype"])
+                resp.headers["Idempotent-Replayed"] = "true"
+                return resp
+            if time.monotonic() >= deadline:
+                resp = jsonify({"ok": False, "message": "La petición original con esta Idempotency-Key sigue en curso."})
+                resp.status_code = 409
+                resp.headers["Retry-After"] = "5"
+                return resp
+            time.sleep(0.1)
+
+        try:
+            resp = app.make_response(fn(*args, **kwargs))
+        except BaseException:
+            _discard_idempotency(path)
+            raise
+        if resp.status_code < 500 and resp.status_code != 409 and not resp.is_streamed:
+            try:
+                _write_json_atomic(
+                    path,
+                    {
+                        "at": now,
+                        "body": body_hash,
+                        "status": resp.status_code,
+                        "mimetype": resp.mimetype,
+                        "data": resp.get_data(as_text=True),
+                    },
+                )
+                _maybe_prune_idempotency(now)
+            except OSError:
+                _discard_idempotency(path)
+        else:
+            _discard_idempotency(path)
+        return resp
+
+    return wrapper
+
+
+def _discard_idempotency(path: str) -> None:
+    """Quita la marca "en curso": el siguiente intento con la clave se ejecuta de nuevo."""
+
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+# ---- Aplicación de cambios de Samba ----
+
+# Ráfagas de cambios (varios shares, montar + compartir...) se agrupan en un
+# único apply; el tope evita aplazarlo indefinidamente si no paran de llegar.
+SAMBA_APPLY_DEBOUNCE_S = float(os.getenv("DISKMANAGER_SAMBA_APPLY_DEBOUNCE_S", "0.5"))
+SAMBA_APPLY_MAX_DELAY_S = 3.0
+# Lote pendiente y último resultado, compartidos por todos los workers.
+SAMBA_APPLY_PATH = os.path.join(STATE_DIR, "samba-apply.json")
+LOCK_SAMBA_APPLY = "samba-apply"
+# Cada cuánto mira un hilo ocioso si otro worker dejó un lote (o un resultado).
+SAMBA_APPLY_IDLE_S = 1.0
+# Sondeo de `request(wait=True)` mientras espera su resultado.
+SAMBA_APPLY_POLL_S = 0.1
+# "reload" (por defecto): recarga sin cortar sesiones; "restart": comportamiento antiguo.
+SAMBA_APPLY_MODE = os.getenv("DISKMANAGER_SAMBA_APPLY", "reload").strip().lower()
+
+
+def _samba_session_count() -> int | None:
+    """Sesiones SMB activas según `smbstatus -b` (None si no se puede saber)."""
+
+    if not _capabilities.has("smbstatus"):
+        return None
+    cp = _run(["smbstatus", "-b"], timeout_s=10)
+    if cp.returncode != 0:
+        return None
+    lines = (cp.stdout or "").splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith("---"):
+            return sum(1 for x in lines[i + 1 :] if x.strip())
+    return 0
+
+
+def _samba_global_section(lines: list[str]) -> list[str]:
+    """Líneas efectivas de [global], normalizadas para comparar versiones de smb.conf."""
+
+    out: list[str] = []
+    in_global = False
+    for raw in lines:
+        s = raw.strip()
+        if s.startswith("[") and s.endswith("]"):
+            in_global = s[1:-1].strip().lower() == "global"
+            continue
+        if in_global and s and not s.startswith(("#", ";")):
+            out.append(re.sub(r"\s*=\s*", " = ", s).lower())
+    return out
+
+
+def _apply_samba_now(restart: bool) -> dict[str, Any]:
+    sessions = _samba_session_count()
+    if not restart:
+        # reload-config relee smb.conf en todos los smbd sin cortar sesiones.
+        if _capabilities.has("smbcontrol"):
+            cp = _run(["smbcontrol", "all", "reload-config"], timeout_s=15)
+            if cp.returncode == 0:
+                return {"ok": True, "mode": "reload", "sessions": sessions, "dropped": 0}
+        if _capabilities.has("systemctl"):
+            for u in ("smbd", "smb"):
+                if _run(["systemctl", "reload", u], timeout_s=15).returncode == 0:
+                    return {"ok": True, "mode": "reload", "sessions": sessions, "dropped": 0}
+
+    # Restart: necesario si cambió [global] (interfaces, puertos...) o si no se pudo recargar.
+    if not _capabilities.has("systemctl"):
+        return {"ok": False, "mode": "none", "sessions": sessions, "dropped": 0}
+    restarted = False
+    for u in ("smbd", "smb", "nmbd"):
+        if _run(["systemctl", "restart", u], timeout_s=25).returncode == 0:
+            restarted = True
+    return {"ok": restarted, "mode": "restart", "sessions": sessions, "dropped": (sessions or 0) if restarted else 0}
+
+
+class _SambaApplier:
+    """Agrupa las peticiones de aplicar smb.conf de todos los workers en un único apply.
+
+    El lote pendiente vive en SAMBA_APPLY_PATH (bajo LOCK_SAMBA_APPLY): cada
+    `request()` lo amplía y el primer hilo que lo ve vencido lo reclama y lo
+    ejecuta; los demás workers ya lo encuentran vacío. `request()` no espera
+    (salvo `wait=True`): el resultado queda en el mismo fichero y /api/events lo
+    emite como evento "samba".
+    """
+
+    def __init__(self, debounce_s: float, path: str = "") -> None:
+        self._debounce_s = debounce_s
+        self._path = path or SAMBA_APPLY_PATH
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._seen = 0
+
+    def _read(self) -> dict[str, Any]:
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def last(self) -> tuple[int, dict[str, Any]]:
+        """(último lote aplicado, su resultado), de cualquier worker."""
+
+        state = self._read()
+        return int(state.get("applied") or 0), dict(state.get("result") or {})
+
+    def mark_restart(self) -> None:
+        """El próximo apply debe ser un restart (p.ej. cambió [global])."""
+
+        with state_lock(LOCK_SAMBA_APPLY):
+            state = self._read()
+            state["restart"] = True
+            _write_json_atomic(self._path, state)
+
+    def request(self, *, restart: bool = False, wait: bool = False, timeout_s: float = 60.0) -> dict[str, Any]:
+        now = time.time()
+        try:
+            with state_lock(LOCK_SAMBA_APPLY):
+                state = self._read()
+                ticket = state["requested"] = int(state.get("requested") or 0) + 1
+                state["restart"] = bool(state.get("restart")) or restart or SAMBA_APPLY_MODE == "restart"
+                first_at = state.get("first_at") or now
+                state["first_at"] = first_at
+                state["due"] = min(now + self._debounce_s, first_at + SAMBA_APPLY_MAX_DELAY_S)
+                _write_json_atomic(self._path, state)
+        except (OSError, LockBusy):
+            # Sin estado compartido no se puede agrupar: se aplica ya, como antes.
+            return _apply_samba_now(restart or SAMBA_APPLY_MODE == "restart")
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="samba-apply", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        if not wait:
+            return {"ok": True, "mode": "pending"}
+        deadline = time.monotonic() + timeout_s
+        while time.monotonic() < deadline:
+            applied, result = self.last()
+            if applied >= ticket:
+                return result
+            with self._cond:
+                self._cond.wait(SAMBA_APPLY_POLL_S)
+        return {"ok": True, "mode": "pending"}
+
+    def _claim(self) -> tuple[int, bool] | None:
+        """Reclama el lote pendiente si ya venció. Returns (ticket, restart) o None."""
+
+        with state_lock(LOCK_SAMBA_APPLY):
+            state = self._read()
+            if not state.get("first_at") or float(state.get("due") or 0) > time.time():
+                return None
+            ticket, restart = int(state.get("requested") or 0), bool(state.get("restart"))
+            state.update(first_at=None, due=None, restart=False)
+            _write_json_atomic(self._path, state)
+        return ticket, restart
+
+    def _publish(self, ticket: int, result: dict[str, Any]) -> None:
+        with state_lock(LOCK_SAMBA_APPLY):
+            state = self._read()
+            if ticket > int(state.get("applied") or 0):
+                state.update(applied=ticket, result=result)
+                _write_json_atomic(self._path, state)
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                state = self._read()
+                applied = int(state.get("applied") or 0)
+                if applied != self._seen:
+                    # Lo aplicó este u otro worker: que los streams de este lo emitan.
+                    self._seen = applied
+                    _changes.notify("samba")
+                    with self._cond:
+                        self._cond.notify_all()
+                delay = float(state.get("due") or 0) - time.time() if state.get("first_at") else SAMBA_APPLY_IDLE_S
+                if delay > 0:
+                    with self._cond:
+                        self._cond.wait(min(delay, SAMBA_APPLY_IDLE_S))
+                    continue
+                claimed = self._claim()
+                if claimed is None:
+                    continue
+                ticket, restart = claimed
+                try:
+                    result = _apply_samba_now(restart)
+                except Exception as e:
+                    result = {"ok": False, "mode": "error", "sessions": None, "dropped": 0, "error": str(e)}
+                self._publish(ticket, result)
+            except Exception:
+                # LockBusy o un fallo de E/S puntual: se reintenta en la siguiente vuelta.
+                time.sleep(SAMBA_APPLY_IDLE_S)
+
+
+_samba_applier = _SambaApplier(SAMBA_APPLY_DEBOUNCE_S)
+
+
+def _apply_samba_config(*, restart: bool = False) -> dict[str, Any]:
+    """Aplica smb.conf (agrupado con otros cambios cercanos); ver `_SambaApplier`."""
+
+    return _samba_applier.request(restart=restart)
+
+
+def _samba_apply_summary(result: dict[str, Any]) -> str:
+    mode = result.get("mode")
+    sessions = result.get("sessions")
+    if mode == "reload":
+        if sessions:
+            return f"Samba recargado ({sessions} sesión(es) activa(s) conservada(s))."
+        return "Samba recargado."
+    if mode == "restart":
+        if not result.get("ok"):
+            return "No se pudo reiniciar Samba."
+        if sessions:
+            return f"Samba reiniciado: {result.get('dropped', 0)} sesión(es) cortada(s)."
+        return "Samba reiniciado."
+    if mode == "pending":
+        return "Samba aplicará los cambios en unos segundos."
+    return "Samba no se pudo recargar (¿systemctl/smbcontrol disponibles?)."
+
+
+def _norm_path(p: str) -> str:
+    p = (p or "").strip()
+    if p.endswith("/") and len(p) > 1:
+        p = p.rstrip("/")
+    return p
+
+
+def _samba_enabled_share_for_path(path: str, snap: "SystemSnapshot | None" = None) -> bool:
+    target = _norm_path(path)
+    if not target:
+        return False
+    return target in (snap or system_snapshot()).enabled_share_paths
+
+
+def _samba_share_exists_for_path(path: str, snap: "SystemSnapshot | None" = None) -> bool:
+    target = _norm_path(path)
+    if not target:
+        return False
+    return target in (snap or system_snapshot()).share_paths
+
+
+def _write_samba_conf_lines(lines: list[str]) -> tuple[bool, str, str]:
+    """Escribe smb.conf de forma segura. Returns (ok, backup_path, error_details)."""
+
+    with state_lock(LOCK_SMB_CONF):
+        return _write_samba_conf_lines_locked(lines)
+
+
+def _write_samba_conf_lines_locked(lines: list[str]) -> tuple[bool, str, str]:
+    status, backup, err = _replace_samba_conf_locked(lines)
+    if status == "invalid":
+        return (False, "", f"Configuración Samba inválida (testparm):\n{err}")
+    return (status == "ok", backup, err)
+
+
+def _check_samba_conf(text: str) -> str | None:
+    """Valida un smb.conf con testparm. Devuelve el error, o None si es válido (o no hay testparm)."""
+
+    if not _capabilities.has("testparm"):
+        return None
+    try:
+        tmp_path = _backend.write_temp(os.path.dirname(SMB_CONF_PATH), ".smb.conf.diskmanager.", text)
+    except OSError as e:
+        return _truncate(str(e))
+    try:
+        cp = _run(["testparm", "-s", tmp_path], timeout_s=25)
+    finally:
+        try:
+            _backend.remove(tmp_path)
+        except OSError:
+            pass
+    if cp.returncode != 0:
+        return _truncate(cp.stderr or cp.stdout or "")
+    return None
+
+
+def _replace_samba_conf_locked(lines: list[str]) -> tuple[str, str, str]:
+    """Valida con testparm, guarda backup y reemplaza smb.conf (llamar con LOCK_SMB_CONF).
+
+    Returns: (estado, backup_path, detalle) con estado "ok", "missing", "invalid" o "error".
+    """
+
+    smb_conf = SMB_CONF_PATH
+    if not _backend.exists(smb_conf):
+        return ("missing", "", "No existe /etc/samba/smb.conf")
+    text = "".join(lines)
+    err = _check_samba_conf(text)
+    if err is not None:
+        return ("invalid", "", err)
+
+    backup = f"{smb_conf}.bak.diskmanager.{int(time.time())}"
+    try:
+        old = _backend.read_text(smb_conf)
+        _backend.write_text(backup, old)
+        # Escritura atómica: si falla, smb.conf queda como estaba.
+        _backend.write_text(smb_conf, text)
+    except Exception as e:
+        return ("error", "", _truncate(str(e)))
+    system_snapshot().invalidate("samba")
+    if _samba_global_section(old.splitlines(keepends=True)) != _samba_global_section(lines):
+        # [global] (interfaces, puertos, seguridad...) no siempre se aplica con reload.
+        _samba_applier.mark_restart()
+    return ("ok", backup, "")
+
+
+# ---- Modelo de smb.conf ----
+
+# Secciones que no son shares de usuario (no se listan en la UI).
+_SAMBA_SYSTEM_SECTIONS = {"global", "printers", "print$", "ipc$"}
+_SAMBA_TRUE = {"yes", "true", "1"}
+
+
+class SmbSection:
+    """Una sección de smb.conf: [start, end) en `SmbConf.lines` + parámetros."""
+
+    __slots__ = ("name", "start", "end", "params")
+
+    def __init__(self, name: str, start: int) -> None:
+        self.name = name
+        self.start = start
+        self.end = start + 1
+        # clave en minúsculas -> (índice de línea, valor). Como Samba, gana la última.
+        self.params: dict[str, tuple[int, str]] = {}
+
+    def get(self, key: str, default: str = "") -> str:
+        item = self.params.get(key)
+        return item[1] if item else default
+
+    def flag(self, key: str) -> bool | None:
+        item = self.params.get(key)
+        return None if item is None else item[1].lower() in _SAMBA_TRUE
+
+    @property
+    def is_system(self) -> bool:
+        return self.name.lower() in _SAMBA_SYSTEM_SECTIONS
+
+
+class SmbConf:
+    """smb.conf parseado: líneas originales + rangos de sección + índices.
+
+    Las ediciones trabajan sobre `lines` (comentarios y formato se conservan) y
+    reindexan; la escritura sigue pasando por `_write_samba_conf_lines`.
+    """
+
+    def __init__(self, lines: list[str]) -> None:
+        self.lines = lines
+        self._reindex()
+
+    def _reindex(self) -> None:
+        self.sections: list[SmbSection] = []
+        self.by_name: dict[str, SmbSection] = {}
+        self.by_path: dict[str, SmbSection] = {}
+        current: SmbSection | None = None
+        for i, raw in enumerate(self.lines):
+            line = raw.strip()
+            if not line or line.startswith(("#", ";")):
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                if current is not None:
+                    current.end = i
+                current = SmbSection(line[1:-1].strip(), i)
+                self.sections.append(current)
+                continue
+            if current is not None and "=" in line:
+                k, v = [p.strip() for p in line.split("=", 1)]
+                current.params[k.lower()] = (i, v)
+        if current is not None:
+            current.end = len(self.lines)
+
+        for sec in self.sections:
+            if sec.name.lower() == "global":
+                continue
+            self.by_name.setdefault(sec.name.lower(), sec)
+            path = _norm_path(sec.get("path"))
+            if path:
+                self.by_path.setdefault(path, sec)
+
+    def copy(self) -> "SmbConf":
+        return SmbConf(list(self.lines))
+
+    def share_by_name(self, name: str) -> SmbSection | None:
+        return self.by_name.get((name or "").strip().lower())
+
+    def share_by_path(self, path: str) -> SmbSection | None:
+        return self.by_path.get(_norm_path(path))
+
+    def shares(self) -> list[dict[str, Any]]:
+        out: list[dict[str, Any]] = []
+        for sec in self.sections:
+            if sec.is_system:
+                continue
+            # Alias que se pisan entre sí: como Samba, gana el que aparece más tarde.
+            public = [(i, v.lower() in _SAMBA_TRUE) for k, (i, v) in sec.params.items() if k in {"guest ok", "public"}]
+            read_only = [
+                (i, (v.lower() in _SAMBA_TRUE) == (k == "read only"))
+                for k, (i, v) in sec.params.items()
+                if k in {"read only", "writable"}
+            ]
+            out.append(
+                {
+                    "name": sec.name,
+                    "path": sec.get("path"),
+                    "public": max(public)[1] if public else False,
+                    "read_only": max(read_only)[1] if read_only else False,
+                    # Si está deshabilitado, mantenemos el bloque pero no se sirve.
+                    "enabled": sec.flag("available") is not False,
+                }
+            )
+        return out
+
+    def set_available(self, sec: SmbSection, enable: bool) -> bool:
+        """Pone 'available = yes/no' en la sección. Returns: changed."""
+
+        if (sec.flag("available") is not False) == enable:
+            return False
+        desired = "yes" if enable else "no"
+        item = sec.params.get("available")
+        if item is not None:
+            idx = item[0]
+            raw = self.lines[idx]
+            indent = raw[: len(raw) - len(raw.lstrip())]
+            self.lines[idx] = f"{indent}available = {desired}\n"
+        else:
+            # Insertar justo después del header del share.
+            self.lines.insert(sec.start + 1, f"   available = {desired}\n")
+        self._reindex()
+        return True
+
+    def remove(self, sec: SmbSection) -> None:
+        del self.lines[sec.start : sec.end]
+        self._reindex()
+
+    def append(self, text: str) -> None:
+        if self.lines and not self.lines[-1].endswith("\n"):
+            self.lines[-1] += "\n"
+        # Línea a línea: si no, _reindex no vería la sección recién añadida.
+        self.lines.extend(text.splitlines(keepends=True))
+        self._reindex()
+
+
+_smb_conf_lock = threading.Lock()
+_smb_conf_cache: tuple[tuple[int, int, int], SmbConf] | None = None
+
+
+def load_smb_conf(*, for_edit: bool = False) -> SmbConf | None:
+    """smb.conf parseado, cacheado por (inodo, mtime, tamaño).
+
+    Con `for_edit=True` devuelve una copia propia que el caller puede modificar.
+    None si no existe o no se puede leer.
+    """
+
+    global _smb_conf_cache
+    sig = _backend.signature(SMB_CONF_PATH)
+    if sig is None:
+        return None
+    with _smb_conf_lock:
+        cached = _smb_conf_cache
+    if cached is None or cached[0] != sig:
+        try:
+            with read_lock(LOCK_SMB_CONF):
+                conf = SmbConf(_backend.read_text(SMB_CONF_PATH).splitlines(keepends=True))
+        except OSError:
+            return None
+        with _smb_conf_lock:
+            _smb_conf_cache = (sig, conf)
+        cached = (sig, conf)
+    return cached[1].copy() if for_edit else cached[1]
+
+
+def _samba_share_block(mountpoint: str, name_hint: str) -> str:
+    server_user = _default_server_user()
+    share_name = _safe_share_name(os.path.basename(mountpoint) or name_hint)
+    return (
+        "\n"
+        f"[{share_name}]\n"
+        f"   path = {mountpoint}\n"
+        "   browseable = yes\n"
+        "   read only = no\n"
+        "   guest ok = yes\n"
+        "   public = yes\n"
+        f"   force user = {server_user}\n"
+        "   create mask = 0775\n"
+        "   directory mask = 0775\n"
+        f"   dfree command = /bin/df -P {mountpoint}\n"
+    )
+
+
+def _set_share_available_by_path(target_path: str, enable: bool, *, restart: bool = True) -> tuple[bool, str]:
+    """Activa/desactiva un share existente por su path usando 'available = yes/no'.
+
+    Returns: (changed, details). If no share exists for the path, changed=False.
+    """
+
+    if not _backend.exists(SMB_CONF_PATH):
+        return (False, "Samba no instalado (no smb.conf).")
+
+    # Comprobación sobre el modelo cacheado: el caso habitual (nada que cambiar)
+    # no copia ni reescribe nada.
+    conf = load_smb_conf()
+    if conf is None:
+        return (False, "No se pudo leer smb.conf.")
+    sec = conf.share_by_path(target_path)
+    if sec is None:
+        return (False, "No hay share existente para ese path.")
+
+    desired = "yes" if enable else "no"
+    if (sec.flag("available") is not False) == enable:
+        return (False, f"Share ya estaba available={desired}.")
+
+    with state_lock(LOCK_SMB_CONF):
+        # Releer bajo el lock: otro worker puede haber escrito mientras tanto.
+        conf = load_smb_conf(for_edit=True)
+        sec = conf.share_by_path(target_path) if conf else None
+        if conf is None or sec is None or not conf.set_available(sec, enable):
+            return (False, f"Share ya estaba available={desired}.")
+        ok, backup, err = _write_samba_conf_lines(conf.lines)
+    if not ok:
+        return (False, f"No se aplicaron cambios en Samba. {err}")
+
+    summary = _samba_apply_summary(_apply_samba_config()) if restart else ""
+    return (True, f"Share actualizado (available={desired}). Backup: {backup}. {summary}".strip())
+
+
+def _remove_share_block_by_path(target_path: str) -> tuple[bool, str]:
+    """Elimina el bloque del share que apunta a `path = <target_path>`.
+
+    Returns: (changed, details). If no share exists for the path, changed=False.
+    """
+
+    if not _backend.exists(SMB_CONF_PATH):
+        return (False, "Samba no instalado (no smb.conf).")
+
+    with state_lock(LOCK_SMB_CONF):
+        conf = load_smb_conf(for_edit=True)
+        if conf is None:
+            return (False, "No se pudo leer smb.conf.")
+        sec = conf.share_by_path(target_path)
+        if sec is None:
+            return (False, "No había share para ese path.")
+        conf.remove(sec)
+        ok, backup, err = _write_samba_conf_lines(conf.lines)
+    if not ok:
+        return (False, f"No se aplicaron cambios en Samba. {err}")
+
+    summary = _samba_apply_summary(_apply_samba_config())
+    return (True, f"Share eliminado. Backup: {backup}. {summary}")
+
+
+def _format_commands(fstype: str, dev_path: str, label: str | None) -> list[str] | None:
+    fs = (fstype or "").strip().lower()
+    safe_label = (label or "").strip()
+    if safe_label:
+        safe_label = re.sub(r"[^A-Za-z0-9._-]", "_", safe_label)[:32]
+
+    if fs == "ext4":
+        if not _capabilities.has("mkfs.ext4"):
+            return None
+        args = ["mkfs.ext4", "-F"]
+        if safe_label:
+            args += ["-L", safe_label]
+        return args + [dev_path]
+
+    if fs == "xfs":
+        if not _capabilities.has("mkfs.xfs"):
+            return None
         args = ["mkfs.xfs", "-f"]
         if safe_label:
             args += ["-L", safe_label]
@@ -598,7 +1978,7 @@ def _format_commands(fstype: str, dev_path: str, label: str | None) -> list[str]
 
     if fs in {"exfat", "exfatprogs"}:
         # exfatprogs suele exponer mkfs.exfat
-        if not shutil.which("mkfs.exfat"):
+        if not _capabilities.has("mkfs.exfat"):
             return None
         args = ["mkfs.exfat"]
         if safe_label:
@@ -606,7 +1986,7 @@ def _format_commands(fstype: str, dev_path: str, label: str | None) -> list[str]
         return args + [dev_path]
 
     if fs in {"vfat", "fat32"}:
-        if not shutil.which("mkfs.vfat"):
+        if not _capabilities.has("mkfs.vfat"):
             return None
         args = ["mkfs.vfat", "-F", "32"]
         if safe_label:
@@ -615,7 +1995,7 @@ def _format_commands(fstype: str, dev_path: str, label: str | None) -> list[str]
 
     if fs == "ntfs":
         # mkfs.ntfs suele venir con ntfs-3g.
-        if not shutil.which("mkfs.ntfs"):
+        if not _capabilities.has("mkfs.ntfs"):
             return None
         # Usamos quick format (-Q) para que no tarde muchísimo en discos grandes.
         # (-F) fuerza incluso si ya hay firma previa.
@@ -627,9 +2007,18 @@ def _format_commands(fstype: str, dev_path: str, label: str | None) -> list[str]
     return None
 
 
-def _wipe_and_single_partition(disk_name: str, *, msftdata: bool = False) -> tuple[bool, str, str]:
+def _wipe_and_single_partition(
+    disk_name: str,
+    *,
+    msftdata: bool = False,
+    on_step: Callable[[str], None] | None = None,
+    should_cancel: Callable[[], bool] | None = None,
+) -> tuple[bool, str, str]:
     """Borra tabla de particiones del disco y crea una única partición.
 
+    `on_step` recibe cada paso completado (para informar progreso) y
+    `should_cancel` se consulta antes de cada operación destructiva.
+
     Returns: (ok, new_partition_path, details)
     """
 
@@ -639,16 +2028,15 @@ def _wipe_and_single_partition(disk_name: str, *, msftdata: bool = False) -> tup
 
     disk_path = f"/dev/{disk_name}"
     try:
-        st = os.stat(disk_path)
-        if not stat.S_ISBLK(st.st_mode):
+        if not _backend.is_block_device(disk_path):
             return (False, "", f"{disk_path} no es un dispositivo de bloque.")
     except Exception as e:
         return (False, "", f"No se pudo validar {disk_path}: {e}")
 
     # Herramientas: preferimos sgdisk (zap-all) y parted (mklabel/mkpart).
-    has_parted = bool(shutil.which("parted"))
-    has_sgdisk = bool(shutil.which("sgdisk"))
-    has_sfdisk = bool(shutil.which("sfdisk"))
+    has_parted = _capabilities.has("parted")
+    has_sgdisk = _capabilities.has("sgdisk")
+    has_sfdisk = _capabilities.has("sfdisk")
     if not has_parted and not has_sfdisk:
         return (
             False,
@@ -658,23 +2046,39 @@ def _wipe_and_single_partition(disk_name: str, *, msftdata: bool = False) -> tup
 
     steps: list[str] = []
 
+    def step(msg: str) -> None:
+        steps.append(msg)
+        if on_step:
+            on_step(msg)
+
+    def cancelled() -> bool:
+        return bool(should_cancel and should_cancel())
+
+    if cancelled():
+        return (False, "", "Cancelado antes de empezar.")
+
     # Intentamos desmontar cualquier cosa colgada del disco (best-effort, debería estar desmontado ya).
     _run(["umount", "-A", disk_path], timeout_s=10)
 
     # Limpiar firmas/metadata.
-    if shutil.which("wipefs"):
+    if cancelled():
+        return (False, "", "Cancelado.")
+    if _capabilities.has("wipefs"):
         cp = _run(["wipefs", "-a", disk_path], timeout_s=60)
         if cp.returncode == 0:
-            steps.append("wipefs: OK")
+            step("wipefs: OK")
         else:
-            steps.append("wipefs: fallo (continuando)")
+            step("wipefs: fallo (continuando)")
 
     if has_sgdisk:
         cp = _run(["sgdisk", "--zap-all", disk_path], timeout_s=120)
         if cp.returncode == 0:
-            steps.append("sgdisk --zap-all: OK")
+            step("sgdisk --zap-all: OK")
         else:
-            steps.append("sgdisk --zap-all: fallo (continuando)")
+            step("sgdisk --zap-all: fallo (continuando)")
+
+    if cancelled():
+        return (False, "", "Cancelado tras borrar firmas: el disco queda sin tabla de particiones.")
 
     # Crear tabla GPT + partición única (1MiB..100%).
     if has_parted:
@@ -683,68 +2087,54 @@ def _wipe_and_single_partition(disk_name: str, *, msftdata: bool = False) -> tup
         if cp1.returncode != 0 or cp2.returncode != 0:
             err = _truncate(((cp1.stderr or cp1.stdout or "") + "\n" + (cp2.stderr or cp2.stdout or "")).strip())
             return (False, "", f"Error particionando con parted:\n{err}")
-        steps.append("parted: GPT + 1 partición: OK")
+        step("parted: GPT + 1 partición: OK")
 
         # Para discos que quieres usar en Windows, marcar como "Microsoft basic data".
         # Si se queda como tipo Linux, Windows a veces no asigna letra.
         if msftdata:
             cp3 = _run(["parted", "-s", disk_path, "set", "1", "msftdata", "on"], timeout_s=30)
             if cp3.returncode == 0:
-                steps.append("parted: msftdata=on: OK")
+                step("parted: msftdata=on: OK")
             else:
-                steps.append("parted: msftdata=on: fallo (continuando)")
+                step("parted: msftdata=on: fallo (continuando)")
     else:
         # Fallback sfdisk: GPT + una partición ocupando todo.
         script = "label: gpt\n,\n"
-        cp = subprocess.run(
-            ["sfdisk", disk_path],
-            input=script,
-            text=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            timeout=90,
-            check=False,
-        )
+        cp = _run(["sfdisk", disk_path], timeout_s=90, input=script)
         if cp.returncode != 0:
             err = _truncate((cp.stderr or cp.stdout or "").strip())
             return (False, "", f"Error particionando con sfdisk:\n{err}")
-        steps.append("sfdisk: GPT + 1 partición: OK")
+        step("sfdisk: GPT + 1 partición: OK")
 
         if msftdata and has_sgdisk:
             # gdisk typecode 0700 = Microsoft basic data
             cp3 = _run(["sgdisk", "-t", "1:0700", disk_path], timeout_s=30)
             if cp3.returncode == 0:
-                steps.append("sgdisk: type 1=0700 (msftdata): OK")
+                step("sgdisk: type 1=0700 (msftdata): OK")
             else:
-                steps.append("sgdisk: type 1=0700: fallo (continuando)")
+                step("sgdisk: type 1=0700: fallo (continuando)")
 
     # Pedir al kernel que relea la tabla.
-    if shutil.which("partprobe"):
+    if _capabilities.has("partprobe"):
         _run(["partprobe", disk_path], timeout_s=30)
-    if shutil.which("udevadm"):
+    if _capabilities.has("udevadm"):
         _run(["udevadm", "settle"], timeout_s=30)
+    _invalidate_inventory()
 
     # Encontrar la nueva partición: la única child con pkname=disk_name.
-    parts = lsblk_partitions()
-    candidates = [p for p in parts if (p.get("type") == "part") and ((p.get("pkname") or "").strip() == disk_name)]
+    candidates = DeviceGraph(probe_partitions()).partitions_of(disk_name)
     if not candidates:
         # Reintento corto: a veces udev tarda.
-        if shutil.which("udevadm"):
+        if _capabilities.has("udevadm"):
             _run(["udevadm", "settle"], timeout_s=30)
-        parts = lsblk_partitions()
-        candidates = [p for p in parts if (p.get("type") == "part") and ((p.get("pkname") or "").strip() == disk_name)]
+        candidates = DeviceGraph(probe_partitions()).partitions_of(disk_name)
 
     if not candidates:
         return (False, "", f"No se encontró la partición nueva en {disk_path}.")
 
     # Elegir la partición más grande (por seguridad si el tool creó algo extra).
-    def size_key(p: dict[str, Any]) -> int:
-        # lsblk size viene tipo "489G"; reusamos el parser existente.
-        return _parse_size_to_bytes(p.get("size") or "0")
-
-    candidates.sort(key=size_key, reverse=True)
-    new_part = candidates[0]
-    new_path = (new_part.get("path") or "").strip() or f"/dev/{new_part.get('name') or ''}"
+    candidates.sort(key=lambda n: n.size_bytes or 0, reverse=True)
+    new_path = candidates[0].path
     if not new_path.startswith("/dev/"):
         return (False, "", "No se pudo determinar el path de la nueva partición.")
 
@@ -756,7 +2146,7 @@ def _available_format_options() -> list[dict[str, str]]:
     opts: list[dict[str, str]] = []
 
     def add(fstype: str, label: str, tool: str) -> None:
-        if shutil.which(tool):
+        if _capabilities.has(tool):
             opts.append({"fstype": fstype, "label": label})
 
     add("ext4", "ext4 (Linux)", "mkfs.ext4")
@@ -768,6 +2158,16 @@ def _available_format_options() -> list[dict[str, str]]:
     return opts
 
 
+def _fstab_block(uuid: str, mountpoint: str, fstype: str) -> str:
+    """Entrada fstab (con su cabecera '# diskmanager') para un disco gestionado."""
+
+    fstype_out, options_out, dump_out, passno_out = _fstab_fields_for_fstype(fstype)
+    # Marcar la entrada como "gestionada" para permitir reconexión segura vía mount -a -O.
+    if options_out and "x-diskmanager" not in options_out.split(","):
+        options_out = options_out + ",x-diskmanager"
+    return f"\n# diskmanager\nUUID={uuid}\t{mountpoint}\t{fstype_out}\t{options_out}\t{dump_out}\t{passno_out}\n"
+
+
 def _fstab_fields_for_fstype(fstype: str) -> tuple[str, str, str, str]:
     """Devuelve (fstype, options, dump, passno) para /etc/fstab."""
     fs = (fstype or "").strip().lower()
@@ -776,10 +2176,9 @@ def _fstab_fields_for_fstype(fstype: str) -> tuple[str, str, str, str]:
         uid, gid = _default_uid_gid()
         options = f"defaults,nofail,uid={uid},gid={gid}"
         # Elegir el mejor fstype disponible en este host.
-        kfs = _kernel_filesystems()
-        if "ntfs3" in kfs:
+        if _capabilities.has_filesystem("ntfs3"):
             return ("ntfs3", options, "0", "0")
-        if shutil.which("mount.ntfs-3g"):
+        if _capabilities.has("mount.ntfs-3g"):
             return ("ntfs-3g", options, "0", "0")
         return ("ntfs", options, "0", "0")
 
@@ -795,6 +2194,8 @@ class FstabEntry:
     dump: str
     passno: str
     raw: str
+    # Índice de la línea en el fichero (para editar sin volver a buscarla).
+    line: int = -1
 
     @property
     def uuid(self) -> str | None:
@@ -805,57 +2206,152 @@ class FstabEntry:
 
 def read_fstab_text() -> str:
     try:
-        with open("/etc/fstab", "r", encoding="utf-8", errors="replace") as f:
-            return f.read()
+        return _backend.read_text(FSTAB_PATH)
     except FileNotFoundError:
         return "# /etc/fstab no encontrado\n"
     except PermissionError:
         return "# Sin permisos para leer /etc/fstab\n"
 
 
+@traced("fstab")
 def parse_fstab() -> list[FstabEntry]:
-    entries: list[FstabEntry] = []
     try:
-        with open("/etc/fstab", "r", encoding="utf-8", errors="replace") as f:
-            for line in f:
-                raw = line.rstrip("\n")
-                stripped = raw.strip()
-                if not stripped or stripped.startswith("#"):
-                    continue
-                # /etc/fstab es whitespace-separated. Ignoramos columnas extra.
-                parts = stripped.split()
-                if len(parts) < 6:
-                    continue
-                spec, mountpoint, fstype, options, dump, passno = parts[:6]
-                entries.append(
-                    FstabEntry(
-                        spec=spec,
-                        mountpoint=mountpoint,
-                        fstype=fstype,
-                        options=options,
-                        dump=dump,
-                        passno=passno,
-                        raw=raw,
-                    )
-                )
+        return _singleflight.do(("fstab", _backend.signature(FSTAB_PATH)), _read_fstab_entries)
     except FileNotFoundError:
         return []
     except PermissionError:
         # Aun sin permisos para escribir, queremos que la UI pueda arrancar.
         return []
-    return entries
 
 
-def fstab_rows(entries: list[FstabEntry]) -> list[dict[str, str]]:
+def _read_fstab_entries() -> list[FstabEntry]:
+    with read_lock(LOCK_FSTAB):
+        return FstabStore.load().entries
+
+
+def _atomic_write_text(path: str, text: str) -> None:
+    """Reemplaza `path` sin ventana de fichero truncado, aunque se corte la luz.
+
+    temporal en el mismo directorio -> fsync -> rename -> fsync del directorio.
+    Conserva modo y propietario del fichero original.
+    """
+
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.diskmanager.")
+    try:
+        try:
+            st = os.stat(path)
+            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+            os.fchown(fd, st.st_uid, st.st_gid)
+        except OSError:
+            pass
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class FstabStore:
+    """/etc/fstab como líneas originales + entradas estructuradas e indexadas.
+
+    Comentarios, líneas en blanco y marcas '# diskmanager' se conservan tal
+    cual. Las ediciones se acumulan en memoria y `commit()` las escribe todas
+    de una vez (backup + escritura atómica).
+    """
+
+    def __init__(self, lines: list[str], path: str | None = None) -> None:
+        self.path = path or FSTAB_PATH
+        self.lines = lines
+        self.dirty = False
+        self._reindex()
+
+    @classmethod
+    def load(cls, path: str | None = None) -> "FstabStore":
+        path = path or FSTAB_PATH
+        return cls(_backend.read_text(path).splitlines(keepends=True), path)
+
+    def _reindex(self) -> None:
+        self.entries: list[FstabEntry] = []
+        self.by_uuid: dict[str, FstabEntry] = {}
+        self.by_mountpoint: dict[str, FstabEntry] = {}
+        for i, line in enumerate(self.lines):
+            raw = line.rstrip("\n")
+            stripped = raw.strip()
+            if not stripped or stripped.startswith("#"):
+                continue
+            # /etc/fstab es whitespace-separated. Ignoramos columnas extra;
+            # dump y passno son opcionales (valen 0 si faltan).
+            parts = stripped.split()
+            if len(parts) < 4:
+                continue
+            spec, mountpoint, fstype, options, dump, passno = (parts + ["0", "0"])[:6]
+            e = FstabEntry(spec, mountpoint, fstype, options, dump, passno, raw, i)
+            self.entries.append(e)
+            if e.uuid:
+                self.by_uuid.setdefault(e.uuid, e)
+            self.by_mountpoint.setdefault(_norm_path(mountpoint), e)
+
+    def add(self, uuid: str, mountpoint: str, fstype: str) -> None:
+        if self.lines and not self.lines[-1].endswith("\n"):
+            self.lines[-1] += "\n"
+        self.lines.extend(_fstab_block(uuid, mountpoint, fstype).splitlines(keepends=True))
+        self.dirty = True
+        self._reindex()
+
+    def remove(self, entries: list[FstabEntry]) -> int:
+        """Quita entradas (y su cabecera '# diskmanager'). Returns: cuántas."""
+
+        # De atrás hacia delante para no desplazar índices.
+        idxs = sorted({e.line for e in entries if 0 <= e.line < len(self.lines)}, reverse=True)
+        for idx in idxs:
+            _remove_diskmanager_fstab_block(self.lines, idx)
+        if idxs:
+            self.dirty = True
+            self._reindex()
+        return len(idxs)
+
+    def commit(self) -> tuple[bool, str, str]:
+        """Escribe los cambios pendientes. Returns (ok, backup_path, error_details)."""
+
+        if not self.dirty:
+            return (True, "", "")
+        backup = f"{self.path}.bak.diskmanager.{int(time.time())}"
+        try:
+            with state_lock(LOCK_FSTAB):
+                _backend.write_text(backup, _backend.read_text(self.path))
+                _backend.write_text(self.path, "".join(self.lines))
+        except LockBusy:
+            raise
+        except Exception as e:
+            return (False, "", str(e))
+        self.dirty = False
+        system_snapshot().invalidate("fstab")
+        return (True, backup, "")
+
+
+def fstab_rows(entries: list[FstabEntry], snap: "SystemSnapshot | None" = None) -> list[dict[str, str]]:
+    by_uuid = (snap or system_snapshot()).by_uuid
     rows: list[dict[str, str]] = []
     for e in entries:
         status = "OK"
         if e.uuid:
             # Si existe el symlink, el disco está presente.
-            if not os.path.exists(f"/dev/disk/by-uuid/{e.uuid}"):
+            if e.uuid not in by_uuid:
                 status = "FALTA_DISCO"
         elif e.spec.startswith("/dev/"):
-            if not os.path.exists(e.spec):
+            if not _backend.exists(e.spec):
                 status = "FALTA_DISCO"
         rows.append(
             {
@@ -871,17 +2367,13 @@ def fstab_rows(entries: list[FstabEntry]) -> list[dict[str, str]]:
     return rows
 
 
+# Usamos JSON para no depender de parsing frágil.
+LSBLK_ARGS = ["lsblk", "-J", "-o", "NAME,PATH,PKNAME,SIZE,FSTYPE,LABEL,UUID,MOUNTPOINT,TYPE,RM,HOTPLUG,TRAN"]
+
+
+@traced("lsblk")
 def lsblk_partitions() -> list[dict[str, Any]]:
-    # Usamos JSON para no depender de parsing frágil.
-    cp = _run(
-        [
-            "lsblk",
-            "-J",
-            "-o",
-            "NAME,PATH,PKNAME,SIZE,FSTYPE,LABEL,UUID,MOUNTPOINT,TYPE,RM,HOTPLUG,TRAN",
-        ],
-        timeout_s=10,
-    )
+    cp = _run(LSBLK_ARGS, timeout_s=10)
     if cp.returncode != 0:
         return []
     try:
@@ -904,57 +2396,751 @@ def lsblk_partitions() -> list[dict[str, Any]]:
     return parts
 
 
-def samba_shares() -> list[dict[str, Any]]:
-    smb_conf = "/etc/samba/smb.conf"
-    if not os.path.exists(smb_conf):
-        return []
-    try:
-        with open(smb_conf, "r", encoding="utf-8", errors="replace") as f:
-            lines = f.readlines()
-    except PermissionError:
-        return []
+# ---- Notificación de cambios ----
 
-    shares: list[dict[str, Any]] = []
-    current: dict[str, Any] | None = None
-    for raw in lines:
-        line = raw.strip()
-        if not line or line.startswith(";") or line.startswith("#"):
-            continue
-        if line.startswith("[") and line.endswith("]"):
-            name = line[1:-1].strip()
-            # Ignorar sección global y recursos de sistema (impresoras, IPC, etc.)
-            if name.lower() in {"global", "printers", "print$", "ipc$"}:
-                current = None
-                continue
-            current = {"name": name, "path": "", "public": False, "read_only": False, "enabled": True}
-            shares.append(current)
-            continue
-        if current is None:
-            continue
-        if "=" in line:
-            k, v = [p.strip() for p in line.split("=", 1)]
-            k_low = k.lower()
-            v_low = v.lower()
-            if k_low == "path":
-                current["path"] = v
-            elif k_low in {"guest ok", "public"}:
-                current["public"] = v_low in {"yes", "true", "1"}
-            elif k_low in {"read only", "writable"}:
-                if k_low == "read only":
-                    current["read_only"] = v_low in {"yes", "true", "1"}
-                else:
-                    current["read_only"] = not (v_low in {"yes", "true", "1"})
-            elif k_low == "available":
-                # Si está deshabilitado, mantenemos el bloque pero no se sirve.
-                current["enabled"] = v_low in {"yes", "true", "1"}
-    return shares
 
+class _ChangeNotifier:
+    """Contador global de cambios del sistema + Condition para esperar el siguiente.
 
-def _human_size(size_bytes: int) -> str:
-    if size_bytes == 0:
-        return "0B"
-    size_name = ("B", "KB", "MB", "GB", "TB", "PB")
-    i = int(math.floor(math.log(size_bytes, 1024)))
+    Lo alimentan el listener de uevents y el vigilante de mountinfo; sirve como
+    fuente de eventos barata para quien quiera reaccionar (p.ej. la UI).
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self.generation = 0
+        self.last_kind = ""
+        # Último cambio observado por este proceso (wall clock, comparable con mtimes).
+        self.changed_at = 0.0
+
+    def notify(self, kind: str) -> None:
+        with self._cond:
+            self.generation += 1
+            self.last_kind = kind
+            if kind != "shared":
+                self.changed_at = time.time()
+            self._cond.notify_all()
+
+    def wait(self, since: int, timeout_s: float) -> int:
+        """Bloquea hasta que `generation != since` o vence el timeout. Devuelve la generación."""
+
+        with self._cond:
+            self._cond.wait_for(lambda: self.generation != since, timeout=timeout_s)
+            return self.generation
+
+
+_changes = _ChangeNotifier()
+
+
+# ---- Tabla de montajes (mountinfo) ----
+
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+
+
+def _unescape_mount_field(text: str) -> str:
+    # mountinfo escapa espacio, tab, \n y '\\' como octal (p.ej. "\040").
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), text)
+
+
+class MountEntry:
+    __slots__ = ("mountpoint", "devno", "root", "fstype", "source", "options")
+
+    def __init__(self, mountpoint: str, devno: str, root: str, fstype: str, source: str, options: str) -> None:
+        self.mountpoint = mountpoint
+        self.devno = devno
+        self.root = root
+        self.fstype = fstype
+        self.source = source
+        self.options = options
+
+
+def _parse_mountinfo(text: str) -> list[MountEntry]:
+    entries: list[MountEntry] = []
+    for raw in text.splitlines():
+        # "36 35 98:0 /mnt1 /mnt/parent rw,noatime master:1 - ext3 /dev/root rw,errors=continue"
+        left, sep, right = raw.partition(" - ")
+        fields = left.split()
+        if not sep or len(fields) < 6:
+            continue
+        tail = right.split()
+        entries.append(
+            MountEntry(
+                mountpoint=_unescape_mount_field(fields[4]),
+                devno=fields[2],
+                root=_unescape_mount_field(fields[3]),
+                fstype=tail[0] if tail else "",
+                source=_unescape_mount_field(tail[1]) if len(tail) > 1 else "",
+                options=fields[5],
+            )
+        )
+    return entries
+
+
+class _MountTable:
+    """mountinfo parseado e indexado por mountpoint y por "maj:min".
+
+    Solo se vuelve a leer cuando poll() sobre /proc/self/mountinfo devuelve
+    POLLPRI/POLLERR, que es como el kernel avisa de que la tabla cambió.
+    Si no se puede vigilar, se relee en cada consulta (sigue siendo barato).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._by_mountpoint: dict[str, MountEntry] | None = None
+        self._by_devno: dict[str, list[MountEntry]] = {}
+        self._watcher_pid = 0
+        self._watching = False
+        self.generation = 0
+
+    def _load(self) -> tuple[dict[str, MountEntry], dict[str, list[MountEntry]]]:
+        try:
+            entries = _parse_mountinfo(_backend.read_text(MOUNTINFO_PATH))
+        except Exception:
+            entries = []
+        by_mp: dict[str, MountEntry] = {}
+        by_devno: dict[str, list[MountEntry]] = {}
+        for e in entries:
+            # Montajes apilados en el mismo path: manda el último (el visible).
+            by_mp[e.mountpoint] = e
+            by_devno.setdefault(e.devno, []).append(e)
+        return by_mp, by_devno
+
+    def _indexes(self) -> tuple[dict[str, MountEntry], dict[str, list[MountEntry]]]:
+        self._ensure_watcher()
+        with self._lock:
+            if self._watching and self._by_mountpoint is not None:
+                return self._by_mountpoint, self._by_devno
+        by_mp, by_devno = self._load()
+        with self._lock:
+            self._by_mountpoint, self._by_devno = by_mp, by_devno
+        return by_mp, by_devno
+
+    def refresh(self) -> None:
+        """Relectura inmediata (tras un mount/umount propio, sin esperar al vigilante)."""
+
+        by_mp, by_devno = self._load()
+        with self._lock:
+            self._by_mountpoint, self._by_devno = by_mp, by_devno
+
+    def by_mountpoint(self) -> dict[str, MountEntry]:
+        return self._indexes()[0]
+
+    def by_devno(self) -> dict[str, list[MountEntry]]:
+        return self._indexes()[1]
+
+    def is_mounted(self, mountpoint: str) -> bool:
+        return mountpoint in self.by_mountpoint()
+
+    def first_by_devno(self) -> dict[str, str]:
+        """"maj:min" -> primer mountpoint, priorizando la raíz del fs frente a binds."""
+
+        out: dict[str, str] = {}
+        for devno, entries in self.by_devno().items():
+            best = next((e for e in entries if e.root == "/"), entries[0])
+            out[devno] = best.mountpoint
+        return out
+
+    def first_by_source(self) -> dict[str, str]:
+        """Ruta canónica del origen ("/dev/sda3") -> mountpoint, para lo que no casa por "maj:min".
+
+        btrfs, y cualquier fs con número de dispositivo anónimo, aparece en
+        mountinfo como "0:NN": ahí solo el campo `source` dice qué nodo es.
+        Como libmount, se resuelven los symlinks (/dev/mapper/x -> /dev/dm-N,
+        /dev/disk/by-uuid/...). Si hay varios montajes del mismo origen
+        (subvolúmenes), gana "/", luego la raíz del fs, luego el primero.
+        """
+
+        ranked: dict[str, tuple[int, str]] = {}
+        for mp, e in self.by_mountpoint().items():
+            if not e.source.startswith("/dev/"):
+                continue
+            rank = 0 if mp == "/" else 1 if e.root == "/" else 2
+            keys = {e.source}
+            if _backend.kernel:
+                keys.add(os.path.realpath(e.source))
+            for key in keys:
+                if key not in ranked or rank < ranked[key][0]:
+                    ranked[key] = (rank, mp)
+        return {key: mp for key, (_rank, mp) in ranked.items()}
+
+    def root_on_block_device(self) -> bool:
+        """¿"/" está sobre un dispositivo de bloque? (no overlay, tmpfs, NFS...)."""
+
+        e = self.by_mountpoint().get("/")
+        if e is None:
+            return False
+        return e.source.startswith("/dev/") or not e.devno.startswith("0:")
+
+    def _ensure_watcher(self) -> None:
+        pid = os.getpid()
+        if self._watcher_pid == pid:
+            return
+        with self._lock:
+            if self._watcher_pid == pid:
+                return
+            self._watcher_pid = pid
+            self._by_mountpoint = None
+            if not _backend.kernel or not hasattr(select, "poll"):
+                self._watching = False
+                return
+            try:
+                f = open(MOUNTINFO_PATH, "rb")
+            except OSError:
+                self._watching = False
+                return
+            self._watching = True
+            t = threading.Thread(target=self._watch, args=(f,), name="mountinfo-watcher", daemon=True)
+            t.start()
+
+    def _watch(self, f: Any) -> None:
+        poller = select.poll()
+        poller.register(f.fileno(), select.POLLPRI | select.POLLERR)
+        while True:
+            try:
+                events = poller.poll()
+            except InterruptedError:
+                continue
+            except OSError:
+                self._watching = False
+                return
+            if not any(ev & (select.POLLPRI | select.POLLERR) for _fd, ev in events):
+                continue
+            by_mp, by_devno = self._load()
+            with self._lock:
+                self._by_mountpoint, self._by_devno = by_mp, by_devno
+                self.generation += 1
+            # El inventario incluye MOUNTPOINT: también queda viejo.
+            _invalidate_inventory()
+            _changes.notify("mounts")
+
+
+_mount_table = _MountTable()
+
+
+# ---- Enumerador nativo (sysfs + base de datos de udev) ----
+
+SYS_CLASS_BLOCK = "/sys/class/block"
+UDEV_DATA_DIR = "/run/udev/data"
+
+# auto: sysfs si hay base de datos de udev, si no lsblk. sysfs|lsblk: forzar uno.
+ENUMERATOR = (os.getenv("DISKMANAGER_ENUMERATOR") or "auto").strip().lower()
+
+
+def _read_sys(path: str) -> str:
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return f.read().strip()
+    except Exception:
+        return ""
+
+
+def _unescape_udev_value(text: str) -> str:
+    # ID_FS_LABEL_ENC usa escapes tipo "\x20".
+    return re.sub(r"\\x([0-9A-Fa-f]{2})", lambda m: chr(int(m.group(1), 16)), text)
+
+
+def _lsblk_human_size(n: int) -> str:
+    """Mismo formato que la columna SIZE de lsblk (base 1024, un decimal: "465.8G")."""
+
+    units = "BKMGTPE"
+    v = float(n)
+    i = 0
+    while v >= 1024 and i < len(units) - 1:
+        v /= 1024
+        i += 1
+    if i == 0:
+        return f"{n}B"
+    r = round(v, 1)
+    if r >= 1024 and i < len(units) - 1:
+        r = round(r / 1024, 1)
+        i += 1
+    return f"{r:g}{units[i]}"
+
+
+def _udev_properties(devno: str) -> dict[str, str]:
+    props: dict[str, str] = {}
+    try:
+        with open(os.path.join(UDEV_DATA_DIR, f"b{devno}"), "r", encoding="utf-8", errors="replace") as f:
+            for raw in f:
+                if raw.startswith("E:") and "=" in raw:
+                    k, v = raw[2:].rstrip("\n").split("=", 1)
+                    props[k] = v
+    except Exception:
+        return {}
+    return props
+
+
+def _sysfs_transport(sys_dir: str) -> str | None:
+    try:
+        dev_path = os.path.realpath(os.path.join(sys_dir, "device"))
+    except Exception:
+        return None
+    if "/usb" in dev_path:
+        return "usb"
+    if "/nvme" in dev_path:
+        return "nvme"
+    if "/ata" in dev_path:
+        return "sata"
+    if "/mmc_host/" in dev_path:
+        return "mmc"
+    return None
+
+
+def _sysfs_hotplug(sys_dir: str) -> bool:
+    # Igual que lsblk: algún ancestro del dispositivo se declara "removable".
+    try:
+        cur = os.path.realpath(os.path.join(sys_dir, "device"))
+    except Exception:
+        return False
+    while cur.startswith("/sys/devices/") and cur != "/sys/devices":
+        if _read_sys(os.path.join(cur, "removable")) == "removable":
+            return True
+        cur = os.path.dirname(cur)
+    return False
+
+
+def _sysfs_type(name: str, sys_dir: str) -> str:
+    if os.path.exists(os.path.join(sys_dir, "partition")):
+        return "part"
+    if name.startswith("dm-"):
+        dm_uuid = _read_sys(os.path.join(sys_dir, "dm", "uuid"))
+        prefix = dm_uuid.split("-", 1)[0].upper() if dm_uuid else ""
+        if prefix == "CRYPT":
+            return "crypt"
+        if prefix == "LVM":
+            return "lvm"
+        if prefix == "MPATH":
+            return "mpath"
+        if prefix.startswith("PART"):
+            return "part"
+        return "dm"
+    if name.startswith("md"):
+        level = _read_sys(os.path.join(sys_dir, "md", "level"))
+        return level or "md"
+    if name.startswith("loop"):
+        return "loop"
+    if name.startswith("sr"):
+        return "rom"
+    return "disk"
+
+
+@traced("sysfs")
+def sysfs_partitions() -> list[dict[str, Any]]:
+    """Mismos registros que `lsblk_partitions()` pero sin lanzar procesos.
+
+    Lee /sys/class/block (jerarquía, tamaño, RM), holders/slaves (dm/crypt/lvm),
+    /run/udev/data (FSTYPE/LABEL/UUID) y /proc/self/mountinfo (MOUNTPOINT).
+    Nunca toca el dispositivo en sí, así que un puente USB colgado no bloquea.
+    """
+
+    try:
+        names = sorted(os.listdir(SYS_CLASS_BLOCK))
+    except Exception:
+        return []
+
+    mounts = _mount_table.first_by_devno()
+    mounts_by_source = _mount_table.first_by_source()
+    nodes: dict[str, dict[str, Any]] = {}
+    sys_dirs: dict[str, str] = {}
+    child_names: dict[str, list[str]] = {}
+    has_parent: set[str] = set()
+
+    for kname in names:
+        sys_dir = os.path.realpath(os.path.join(SYS_CLASS_BLOCK, kname))
+        devno = _read_sys(os.path.join(sys_dir, "dev"))
+        if not devno:
+            continue
+        size_sectors = _read_sys(os.path.join(sys_dir, "size"))
+        size_b = int(size_sectors) * 512 if size_sectors.isdigit() else 0
+        t = _sysfs_type(kname, sys_dir)
+        if t == "loop" and size_b == 0:
+            # lsblk tampoco lista loops sin fichero asociado.
+            continue
+
+        props = _udev_properties(devno)
+        name = kname
+        path = f"/dev/{kname}"
+        if kname.startswith("dm-"):
+            dm_name = _read_sys(os.path.join(sys_dir, "dm", "name"))
+            if dm_name:
+                name = dm_name
+                path = f"/dev/mapper/{dm_name}"
+
+        label = props.get("ID_FS_LABEL_ENC")
+        label = _unescape_udev_value(label) if label else props.get("ID_FS_LABEL")
+        nodes[kname] = {
+            "name": name,
+            "path": path,
+            "pkname": None,
+            "size": _lsblk_human_size(size_b),
+            "fstype": props.get("ID_FS_TYPE") or None,
+            "label": label or None,
+            "uuid": props.get("ID_FS_UUID") or None,
+            # "maj:min" primero; si no (btrfs "0:NN"...), por el nodo: /dev/dm-N o /dev/mapper/<nombre>.
+            "mountpoint": mounts.get(devno) or mounts_by_source.get(f"/dev/{kname}") or mounts_by_source.get(path),
+            "type": t,
+            "rm": False,
+            "hotplug": False,
+            "tran": None,
+        }
+        sys_dirs[kname] = sys_dir
+
+        if t == "part":
+            parent = os.path.basename(os.path.dirname(sys_dir))
+            child_names.setdefault(parent, []).append(kname)
+            has_parent.add(kname)
+        try:
+            slaves = sorted(os.listdir(os.path.join(sys_dir, "slaves")))
+        except Exception:
+            slaves = []
+        for sl in slaves:
+            child_names.setdefault(sl, []).append(kname)
+            has_parent.add(kname)
+
+    # RM/HOTPLUG/TRAN son propiedades del disco físico; las heredan sus hijos.
+    for kname, node in nodes.items():
+        if kname in has_parent:
+            continue
+        sys_dir = sys_dirs[kname]
+        node["rm"] = _read_sys(os.path.join(sys_dir, "removable")) == "1"
+        node["tran"] = _sysfs_transport(sys_dir)
+        node["hotplug"] = bool(node["rm"]) or node["tran"] == "usb" or _sysfs_hotplug(sys_dir)
+
+    parts: list[dict[str, Any]] = []
+
+    def walk(kname: str, parent: dict[str, Any] | None, seen: frozenset[str]) -> dict[str, Any]:
+        # Copia por nivel: un dm con varios slaves aparece bajo cada uno (como en lsblk).
+        node = dict(nodes[kname])
+        if parent is not None:
+            node["pkname"] = parent["name"]
+            node["rm"] = parent["rm"]
+            node["hotplug"] = parent["hotplug"]
+            node["tran"] = parent["tran"]
+        children = [walk(ch, node, seen | {kname}) for ch in child_names.get(kname, []) if ch in nodes and ch not in seen]
+        if children:
+            node["children"] = children
+        if node["type"] in {"disk", "part", "crypt", "lvm"}:
+            parts.append(node)
+        return node
+
+    for kname in nodes:
+        if kname not in has_parent:
+            walk(kname, None, frozenset())
+
+    return parts
+
+
+def probe_partitions() -> list[dict[str, Any]]:
+    """Enumeración sin caché: sysfs/udev si es posible, `lsblk` como fallback."""
+
+    if ENUMERATOR == "lsblk":
+        return _timed_enumeration("lsblk", lsblk_partitions)
+    if ENUMERATOR == "sysfs" or (_backend.kernel and os.path.isdir(UDEV_DATA_DIR)):
+        parts = _timed_enumeration("sysfs", sysfs_partitions)
+        if parts:
+            return parts
+    return _timed_enumeration("lsblk", lsblk_partitions)
+
+
+def _timed_enumeration(name: str, fn: Callable[[], list[dict[str, Any]]]) -> list[dict[str, Any]]:
+    started = time.perf_counter()
+    try:
+        return fn()
+    finally:
+        _metrics.observe("hyperdrive_enumeration_duration_seconds", {"enumerator": name}, time.perf_counter() - started)
+
+
+# ---- Grafo de dispositivos indexado ----
+
+
+def _as_bool(value: Any) -> bool:
+    # lsblk antiguo devuelve "0"/"1"; el moderno, booleanos JSON.
+    if isinstance(value, str):
+        return value.strip().lower() in {"1", "true", "yes"}
+    try:
+        return bool(int(value or 0))
+    except (TypeError, ValueError):
+        return False
+
+
+class DeviceNode:
+    """Un registro de lsblk/sysfs con atributos tipados en lugar de un dict."""
+
+    __slots__ = (
+        "name",
+        "path",
+        "pkname",
+        "size",
+        "size_bytes",
+        "fstype",
+        "label",
+        "uuid",
+        "mountpoint",
+        "type",
+        "rm",
+        "hotplug",
+        "tran",
+        "children",
+        "ancestors",
+    )
+
+    def __init__(self, rec: dict[str, Any]) -> None:
+        self.name: str = (rec.get("name") or "").strip()
+        self.path: str = (rec.get("path") or "").strip() or f"/dev/{self.name}"
+        self.pkname: str = (rec.get("pkname") or "").strip()
+        self.size: str = str(rec.get("size") or "")
+        self.size_bytes: int | None = _parse_size_to_bytes(rec.get("size"))
+        self.fstype: str = (rec.get("fstype") or "").strip()
+        self.label: str = rec.get("label") or ""
+        self.uuid: str = (rec.get("uuid") or "").strip()
+        self.mountpoint: str = rec.get("mountpoint") or ""
+        self.type: str = (rec.get("type") or "").strip().lower()
+        self.rm: bool = _as_bool(rec.get("rm"))
+        self.hotplug: bool = _as_bool(rec.get("hotplug"))
+        self.tran: str = (rec.get("tran") or "").strip().lower()
+        # Nombres de hijos directos (particiones, crypt, lvm...).
+        self.children: tuple[str, ...] = tuple(
+            (ch.get("name") or "").strip() for ch in (rec.get("children") or []) if ch.get("name")
+        )
+        # Cadena de padres hasta el disco superior: ("sda3", "sda") para ubuntu-lv.
+        self.ancestors: tuple[str, ...] = ()
+
+    @property
+    def mounted(self) -> bool:
+        return bool(self.mountpoint)
+
+    @property
+    def is_external(self) -> bool:
+        # Solo mostramos discos "en crudo" si parecen externos/hotplug.
+        # (evita exponer discos internos sin particiones por accidente).
+        return self.rm or self.hotplug or self.tran == "usb"
+
+
+class DeviceGraph:
+    """Inventario construido una vez por snapshot, con índices O(1).
+
+    - by_name: nombre del kernel (o del mapper) -> nodo
+    - by_uuid / by_mountpoint: para cruzar con fstab y Samba
+    - children_of: padre -> nombres de hijos
+    - ancestors precalculados en cada nodo: detectar el disco del sistema es un lookup.
+    """
+
+    __slots__ = ("nodes", "by_name", "by_uuid", "by_mountpoint", "children_of", "root_disk", "root_unresolved")
+
+    def __init__(self, records: list[dict[str, Any]]) -> None:
+        self.nodes: list[DeviceNode] = []
+        self.by_name: dict[str, DeviceNode] = {}
+        self.by_uuid: dict[str, DeviceNode] = {}
+        self.by_mountpoint: dict[str, DeviceNode] = {}
+        self.children_of: dict[str, list[str]] = {}
+
+        for rec in records:
+            node = DeviceNode(rec)
+            if not node.name or node.name in self.by_name:
+                # Un dm con varios slaves aparece repetido: nos quedamos con el primero.
+                continue
+            self.nodes.append(node)
+            self.by_name[node.name] = node
+            if node.uuid:
+                self.by_uuid.setdefault(node.uuid, node)
+            if node.mountpoint:
+                self.by_mountpoint.setdefault(_norm_path(node.mountpoint), node)
+            if node.pkname:
+                self.children_of.setdefault(node.pkname, []).append(node.name)
+
+        for node in self.nodes:
+            chain: list[str] = []
+            seen = {node.name}
+            cur = node.pkname
+            while cur and cur not in seen:
+                chain.append(cur)
+                seen.add(cur)
+                parent = self.by_name.get(cur)
+                cur = parent.pkname if parent else ""
+            node.ancestors = tuple(chain)
+            if not node.children:
+                node.children = tuple(self.children_of.get(node.name, ()))
+
+        root = self.by_mountpoint.get("/")
+        self.root_disk: str | None = self.physical_disk(root.name) if root else None
+        # "/" está en un disco que no casa con ningún nodo: no sabemos cuál es el del sistema.
+        self.root_unresolved = self.root_disk is None and _mount_table.root_on_block_device()
+
+    def get(self, name: str) -> DeviceNode | None:
+        return self.by_name.get(name)
+
+    def physical_disk(self, name: str) -> str | None:
+        """Disco superior de la cadena (p.ej. ubuntu-lv -> sda3 -> sda)."""
+
+        node = self.by_name.get(name)
+        if node is None:
+            return None
+        return node.ancestors[-1] if node.ancestors else node.name
+
+    def on_root_disk(self, node: DeviceNode) -> bool:
+        """El propio disco del sistema o una de sus particiones directas.
+
+        Si "/" está sobre un dispositivo de bloque que no se pudo atar a ningún
+        nodo, no sabemos cuál es el disco del sistema: se trata cualquiera como si
+        lo fuera (nada es gestionable). Una raíz sin disco detrás (overlay, tmpfs,
+        NFS, contenedores) no ocupa ninguno: todos son gestionables.
+        """
+
+        if not self.root_disk:
+            return self.root_unresolved
+        return node.name == self.root_disk or node.pkname == self.root_disk
+
+    def partitions_of(self, disk_name: str) -> list[DeviceNode]:
+        out: list[DeviceNode] = []
+        for name in self.children_of.get(disk_name, ()):
+            n = self.by_name.get(name)
+            if n is not None and n.type == "part":
+                out.append(n)
+        return out
+
+
+# ---- Inventario de dispositivos (caché invalidada por uevents) ----
+
+# NETLINK_KOBJECT_UEVENT: el kernel (grupo 1) y udev (grupo 2) publican aquí los
+# eventos add/remove/change de dispositivos.
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUPS = 0x1 | 0x2
+
+# Red de seguridad: aunque no llegue ningún uevent, el inventario no se sirve
+# más viejo que esto (p.ej. montajes hechos a mano fuera de la app).
+INVENTORY_MAX_AGE_S = float(os.getenv("DISKMANAGER_INVENTORY_MAX_AGE_S", "30"))
+# Si no podemos escuchar uevents (sin netlink, contenedor...), caducamos mucho antes.
+INVENTORY_FALLBACK_MAX_AGE_S = 2.0
+
+
+class _InventoryCache:
+    """`DeviceGraph` de `probe_partitions()` cacheado en memoria.
+
+    Se construye una vez y solo se invalida cuando llega un uevent de tipo block
+    (o cuando la propia app monta/desmonta/formatea). Así, las lecturas del
+    dashboard y de /api/* no lanzan un proceso `lsblk` cada vez.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._graph: DeviceGraph | None = None
+        self._loaded_at = 0.0
+        self._listener_pid = 0
+        self._listener_ok = False
+        self.generation = 0
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._graph = None
+            self.generation += 1
+        _changes.notify("devices")
+
+    def graph(self) -> DeviceGraph:
+        """Devuelve el inventario actual. El grafo es compartido: no mutarlo."""
+
+        self._ensure_listener()
+        max_age = INVENTORY_MAX_AGE_S if self._listener_ok else INVENTORY_FALLBACK_MAX_AGE_S
+        with self._lock:
+            if self._graph is not None and (time.monotonic() - self._loaded_at) < max_age:
+                return self._graph
+            generation = self.generation
+
+        # Varios requests con la caché vacía comparten un único lsblk/sysfs.
+        graph = _singleflight.do(("inventory", generation), lambda: DeviceGraph(probe_partitions()))
+
+        with self._lock:
+            # Si durante el lsblk llegó un uevent, este resultado ya nace viejo:
+            # lo devolvemos pero no lo guardamos.
+            if generation == self.generation:
+                self._graph = graph
+                self._loaded_at = time.monotonic()
+        return graph
+
+    def _ensure_listener(self) -> None:
+        # gunicorn hace fork de los workers: el hilo se arranca en cada proceso.
+        pid = os.getpid()
+        if self._listener_pid == pid:
+            return
+        with self._lock:
+            if self._listener_pid == pid:
+                return
+            self._listener_pid = pid
+            self._graph = None
+            if not _backend.kernel:
+                # Un backend simulado avisa él mismo de sus "uevents" con invalidate().
+                self._listener_ok = True
+                return
+            sock = _open_uevent_socket()
+            self._listener_ok = sock is not None
+            if sock is not None:
+                t = threading.Thread(target=self._listen, args=(sock,), name="uevent-listener", daemon=True)
+                t.start()
+
+    def _listen(self, sock: socket.socket) -> None:
+        while True:
+            try:
+                data = sock.recv(64 * 1024)
+            except InterruptedError:
+                continue
+            except OSError:
+                # Socket roto: volvemos al modo TTL corto.
+                self._listener_ok = False
+                return
+            if _is_block_uevent(data):
+                self.invalidate()
+
+
+def _open_uevent_socket() -> socket.socket | None:
+    if not hasattr(socket, "AF_NETLINK"):
+        return None
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+    except OSError:
+        return None
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+    except OSError:
+        pass
+    try:
+        sock.bind((0, UEVENT_GROUPS))
+    except OSError:
+        # Sin permisos para el grupo de udev: al menos los eventos del kernel.
+        try:
+            sock.bind((0, 0x1))
+        except OSError:
+            sock.close()
+            return None
+    return sock
+
+
+def _is_block_uevent(data: bytes) -> bool:
+    # Mensaje del kernel: "add@/devices/...\0ACTION=add\0...SUBSYSTEM=block\0..."
+    # Mensaje de udev: cabecera binaria "libudev" + las mismas propiedades.
+    return b"SUBSYSTEM=block\0" in data
+
+
+_inventory = _InventoryCache()
+
+
+def inventory_graph() -> DeviceGraph:
+    return _inventory.graph()
+
+
+def _invalidate_inventory() -> None:
+    _inventory.invalidate()
+
+
+@traced("samba")
+def samba_shares() -> list[dict[str, Any]]:
+    conf = load_smb_conf()
+    return conf.shares() if conf else []
+
+
+def _human_size(size_bytes: int) -> str:
+    if size_bytes == 0:
+        return "0B"
+    size_name = ("B", "KB", "MB", "GB", "TB", "PB")
+    i = int(math.floor(math.log(size_bytes, 1024)))
     p = math.pow(1024, i)
     s = round(size_bytes / p, 2)
     return f"{s} {size_name[i]}"
@@ -962,7 +3148,7 @@ def _human_size(size_bytes: int) -> str:
 
 def _get_usage(path: str) -> dict[str, Any] | None:
     try:
-        total, used, free = shutil.disk_usage(path)
+        total, used, free = _backend.disk_usage(path)
         percent = (used / total) * 100 if total > 0 else 0
         return {
             "total_bytes": total,
@@ -977,116 +3163,292 @@ def _get_usage(path: str) -> dict[str, Any] | None:
         return None
 
 
-def disks_view() -> list[dict[str, Any]]:
-    entries = parse_fstab()
-    fstab_by_uuid: dict[str, FstabEntry] = {e.uuid: e for e in entries if e.uuid}
-    fstab_by_dev: dict[str, FstabEntry] = {e.spec: e for e in entries if e.spec.startswith("/dev/")}
-    shares = samba_shares()
-    share_paths = {_norm_path(s.get("path") or "") for s in shares if s.get("path") and s.get("enabled")}
+# ---- Uso de disco: sondeo paralelo con timeout ----
 
-    disks: list[dict[str, Any]] = []
-    seen_uuids: set[str] = set()
+USAGE_TIMEOUT_S = float(os.getenv("DISKMANAGER_USAGE_TIMEOUT_S", "1.5"))
+USAGE_TTL_S = float(os.getenv("DISKMANAGER_USAGE_TTL_S", "10"))
+USAGE_MAX_WORKERS = int(os.getenv("DISKMANAGER_USAGE_WORKERS", "8"))
 
-    parts = lsblk_partitions()
-    root_disk = _root_physical_disk(parts)
 
-    def is_external_disk(node: dict[str, Any]) -> bool:
-        # Solo mostramos discos "en crudo" si parecen externos/hotplug.
-        # (evita exponer discos internos sin particiones por accidente).
+class _UsageProber:
+    """`_get_usage()` en hilos, con plazo por montaje y caché TTL corta.
+
+    Un statvfs sobre un USB colgado o un FUSE (ntfs-3g) bloqueado puede no volver
+    nunca. Por eso cada sondeo va en su propio hilo daemon (uno como máximo por
+    mountpoint, aunque lo pidan varios requests) y el request solo espera hasta
+    el plazo: lo que no responde se devuelve como `stale`/`unresponsive`.
+
+    Las plazas (`max_workers`) limitan los statvfs simultáneos, pero un sondeo que
+    pasa el plazo devuelve la suya aunque siga colgado: si no, unos pocos montajes
+    muertos dejarían a todos los demás haciendo cola para siempre. Y si un sondeo
+    sigue en marcha tras un plazo entero, los lotes siguientes ya no lo esperan.
+    """
+
+    def __init__(self, max_workers: int) -> None:
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, max_workers))
+        self._cache: dict[str, tuple[float, dict[str, Any] | None]] = {}
+        # mountpoint -> (cuándo empezó el sondeo, evento de fin).
+        self._inflight: dict[str, tuple[float, threading.Event]] = {}
+        # Sondeos que ocupan plaza ahora mismo (los abandonados ya no cuentan).
+        self._holding: set[str] = set()
+
+    def _start(self, mountpoint: str) -> tuple[float, threading.Event]:
+        with self._lock:
+            inflight = self._inflight.get(mountpoint)
+            if inflight is not None:
+                return inflight
+            inflight = self._inflight[mountpoint] = (time.monotonic(), threading.Event())
+        t = threading.Thread(target=self._probe, args=(mountpoint, inflight[1]), name="usage-probe", daemon=True)
+        t.start()
+        return inflight
+
+    def _probe(self, mountpoint: str, ev: threading.Event) -> None:
+        self._slots.acquire()
+        with self._lock:
+            self._holding.add(mountpoint)
+        started = time.perf_counter()
         try:
-            if int(node.get("rm") or 0) == 1:
-                return True
-            if int(node.get("hotplug") or 0) == 1:
-                return True
-        except Exception:
-            pass
-        tran = (node.get("tran") or "").strip().lower()
-        return tran == "usb"
+            usage = _get_usage(mountpoint)
+        finally:
+            self._release(mountpoint)
+        _metrics.observe("hyperdrive_usage_probe_duration_seconds", {}, time.perf_counter() - started)
+        with self._lock:
+            self._cache[mountpoint] = (time.monotonic(), usage)
+            self._inflight.pop(mountpoint, None)
+        ev.set()
+
+    def _release(self, mountpoint: str) -> None:
+        """Devuelve la plaza del sondeo, una sola vez (al terminar o al pasar el plazo)."""
+
+        with self._lock:
+            if mountpoint not in self._holding:
+                return
+            self._holding.discard(mountpoint)
+        self._slots.release()
+
+    def _stale(self, mountpoint: str) -> dict[str, Any]:
+        with self._lock:
+            last = self._cache.get(mountpoint)
+        out: dict[str, Any] = dict(last[1]) if last and last[1] else {}
+        out.update({"stale": True, "unresponsive": True})
+        return out
+
+    def probe_many(self, mountpoints: list[str], *, timeout_s: float = USAGE_TIMEOUT_S) -> dict[str, dict[str, Any] | None]:
+        results: dict[str, dict[str, Any] | None] = {}
+        waiting: dict[str, threading.Event] = {}
+        now = time.monotonic()
+        for mp in dict.fromkeys(mountpoints):
+            with self._lock:
+                cached = self._cache.get(mp)
+            if cached is not None and (now - cached[0]) < USAGE_TTL_S:
+                results[mp] = cached[1]
+                continue
+            started, ev = self._start(mp)
+            if now - started >= timeout_s and not ev.is_set():
+                # Ya pasó un plazo entero sin volver: no hacemos esperar otra vez.
+                _metrics.inc("hyperdrive_usage_probe_timeouts_total", {})
+                results[mp] = self._stale(mp)
+                self._release(mp)
+                continue
+            waiting[mp] = ev
+
+        # Un único plazo para todo el lote: los sondeos corren en paralelo.
+        deadline = time.monotonic() + timeout_s
+        with span("usage"):
+            for mp, ev in waiting.items():
+                if ev.wait(max(0.0, deadline - time.monotonic())):
+                    with self._lock:
+                        results[mp] = self._cache.get(mp, (0.0, None))[1]
+                else:
+                    _metrics.inc("hyperdrive_usage_probe_timeouts_total", {})
+                    results[mp] = self._stale(mp)
+                    # Colgado (o en cola): si ocupa plaza, deja de contar para el límite.
+                    self._release(mp)
+        return results
 
-    def is_manageable_partition(p: dict[str, Any]) -> bool:
-        t = (p.get("type") or "").strip().lower()
+    def probe(self, mountpoint: str) -> dict[str, Any] | None:
+        return self.probe_many([mountpoint]).get(mountpoint)
 
-        # Permitir discos sin particiones (solo externos) para poder formatearlos.
-        if t == "disk":
-            # Nunca mostrar el disco del sistema.
-            if root_disk and (p.get("name") == root_disk):
-                return False
-            # Si tiene hijos/particiones, lo gestionamos a nivel de particiones, no a nivel de disco.
-            if p.get("children"):
-                return False
-            return is_external_disk(p)
 
-        if _is_noise_partition(p):
-            return False
+_usage_prober = _UsageProber(USAGE_MAX_WORKERS)
 
-        # Nunca mostrar ni gestionar particiones del disco del sistema (donde está /).
-        if root_disk and (p.get("pkname") == root_disk):
-            return False
 
-        mountpoint = p.get("mountpoint") or ""
-        mounted = bool(mountpoint)
-        fstype = (p.get("fstype") or "").lower()
-        if fstype == "swap":
-            return False
-        # No tocar montajes del sistema.
-        if mounted and _is_system_mountpoint(mountpoint):
-            return False
-        # Si está montado, solo consideramos “de usuario” lo montado bajo /mnt o /media.
-        if mounted and not _is_user_mountpoint(mountpoint):
-            return False
-        return True
+# ---- Snapshot del sistema por request ----
 
-    for p in parts:
-        name = p.get("name") or ""
-        uuid = p.get("uuid") or ""
-        fstype = p.get("fstype") or ""
-        label = p.get("label") or ""
-        size = p.get("size") or ""
-        mountpoint = p.get("mountpoint") or ""
-        mounted = bool(mountpoint)
-        dev_path = p.get("path") or f"/dev/{name}"
-        kind = (p.get("type") or "").strip().lower() or "part"
-
-        if not is_manageable_partition(p):
-            continue
 
-        persistent = False
-        if uuid and uuid in fstab_by_uuid:
-            persistent = True
-        elif dev_path in fstab_by_dev:
-            persistent = True
+def _list_by_uuid() -> set[str]:
+    try:
+        return set(_backend.listdir("/dev/disk/by-uuid"))
+    except Exception:
+        return set()
 
-        samba_enabled = bool(mountpoint and _norm_path(mountpoint) in share_paths)
 
-        usage = None
-        if mounted:
-            usage = _get_usage(mountpoint)
+class SystemSnapshot:
+    """Estado del sistema leído como mucho una vez por request.
 
-        disks.append(
-            {
-                "id": name,
-                "label": label or f"Disco {name}",
-                "size": size,
-                "fstype": fstype or "-",
-                "uuid": uuid or "-",
-                "mounted": mounted,
-                "mountpoint": mountpoint or "",
-                "persistent": persistent,
-                "samba": samba_enabled,
-                "kind": kind,
-                "usage": usage,
-            }
+    Cada parte (dispositivos, fstab, smb.conf, tabla de montajes, /dev/disk/by-uuid)
+    se carga de forma perezosa la primera vez que alguien la pide. Las mutaciones
+    invalidan solo lo que han tocado con `invalidate(...)`.
+    """
+
+    PARTS = ("devices", "fstab", "samba", "mounts", "by_uuid")
+
+    def __init__(self) -> None:
+        self._cache: dict[str, Any] = {}
+
+    def _get(self, key: str, loader: Any) -> Any:
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = loader()
+            return value
+
+    def invalidate(self, *parts: str) -> None:
+        for part in parts or self.PARTS:
+            # Claves derivadas ("fstab.by_uuid", "samba.paths"...) caen con su parte.
+            for key in [k for k in self._cache if k == part or k.startswith(part + ".")]:
+                del self._cache[key]
+            if part == "devices":
+                _invalidate_inventory()
+            elif part == "mounts":
+                _mount_table.refresh()
+            elif part in {"fstab", "samba"}:
+                _changes.notify(part)
+
+    @property
+    def graph(self) -> DeviceGraph:
+        return self._get("devices", inventory_graph)
+
+    @property
+    def fstab(self) -> list[FstabEntry]:
+        return self._get("fstab", parse_fstab)
+
+    @property
+    def fstab_by_uuid(self) -> dict[str, FstabEntry]:
+        return self._get("fstab.by_uuid", lambda: _fstab_indexes(self.fstab)[0])
+
+    @property
+    def fstab_by_dev(self) -> dict[str, FstabEntry]:
+        return self._get("fstab.by_dev", lambda: _fstab_indexes(self.fstab)[1])
+
+    @property
+    def shares(self) -> list[dict[str, Any]]:
+        return self._get("samba", samba_shares)
+
+    @property
+    def enabled_share_paths(self) -> set[str]:
+        return self._get("samba.enabled_paths", lambda: _enabled_share_paths(self.shares))
+
+    @property
+    def share_paths(self) -> set[str]:
+        return self._get(
+            "samba.paths", lambda: {_norm_path(s.get("path") or "") for s in self.shares if s.get("path")}
         )
-        if uuid:
-            seen_uuids.add(uuid)
+
+    @property
+    def mounts(self) -> dict[str, MountEntry]:
+        return self._get("mounts", _mount_table.by_mountpoint)
+
+    @property
+    def by_uuid(self) -> set[str]:
+        return self._get("by_uuid", _list_by_uuid)
+
+
+def system_snapshot() -> SystemSnapshot:
+    """Snapshot del request actual (fuera de un request, uno nuevo cada vez)."""
+
+    if not has_request_context():
+        return SystemSnapshot()
+    snap = g.get("system_snapshot")
+    if snap is None:
+        snap = g.system_snapshot = SystemSnapshot()
+    return snap
+
+
+def _is_manageable(node: DeviceNode, graph: DeviceGraph) -> bool:
+    # Nunca mostrar ni gestionar el disco del sistema (donde está /) ni sus particiones.
+    if graph.on_root_disk(node):
+        return False
+
+    # Permitir discos sin particiones (solo externos) para poder formatearlos.
+    if node.type == "disk":
+        # Si tiene hijos/particiones, lo gestionamos a nivel de particiones, no a nivel de disco.
+        if node.children:
+            return False
+        return node.is_external
+
+    if _is_noise_partition(node):
+        return False
+
+    mountpoint = node.mountpoint
+    if node.fstype.lower() == "swap":
+        return False
+    # No tocar montajes del sistema.
+    if mountpoint and _is_system_mountpoint(mountpoint):
+        return False
+    # Si está montado, solo consideramos “de usuario” lo montado bajo /mnt o /media.
+    if mountpoint and not _is_user_mountpoint(mountpoint):
+        return False
+    return True
+
+
+def _disk_record(
+    node: DeviceNode,
+    fstab_by_uuid: dict[str, FstabEntry],
+    fstab_by_dev: dict[str, FstabEntry],
+    share_paths: set[str],
+    usage: dict[str, Any] | None = None,
+) -> dict[str, Any]:
+    mountpoint = node.mountpoint
+    persistent = bool((node.uuid and node.uuid in fstab_by_uuid) or node.path in fstab_by_dev)
+    return {
+        "id": node.name,
+        "label": node.label or f"Disco {node.name}",
+        "size": node.size,
+        "fstype": node.fstype or "-",
+        "uuid": node.uuid or "-",
+        "mounted": node.mounted,
+        "mountpoint": mountpoint,
+        "persistent": persistent,
+        "samba": bool(mountpoint and _norm_path(mountpoint) in share_paths),
+        "kind": node.type or "part",
+        "usage": usage if mountpoint else None,
+    }
+
+
+def _fstab_indexes(entries: list[FstabEntry]) -> tuple[dict[str, FstabEntry], dict[str, FstabEntry]]:
+    by_uuid: dict[str, FstabEntry] = {e.uuid: e for e in entries if e.uuid}
+    by_dev: dict[str, FstabEntry] = {e.spec: e for e in entries if e.spec.startswith("/dev/")}
+    return by_uuid, by_dev
+
+
+def _enabled_share_paths(shares: list[dict[str, Any]]) -> set[str]:
+    return {_norm_path(s.get("path") or "") for s in shares if s.get("path") and s.get("enabled")}
+
+
+def disks_view(snap: SystemSnapshot | None = None) -> list[dict[str, Any]]:
+    snap = snap or system_snapshot()
+    graph = snap.graph
+    disks: list[dict[str, Any]] = [
+        _disk_record(node, snap.fstab_by_uuid, snap.fstab_by_dev, snap.enabled_share_paths)
+        for node in graph.nodes
+        if _is_manageable(node, graph)
+    ]
+
+    # Uso de disco en paralelo y con plazo: un montaje colgado no congela el dashboard.
+    usages = _usage_prober.probe_many([d["mountpoint"] for d in disks if d["mountpoint"]])
+    for d in disks:
+        if d["mountpoint"]:
+            d["usage"] = usages.get(d["mountpoint"])
 
     # Agregamos “discos faltantes” que están en fstab por UUID pero no existen ahora.
-    for e in entries:
+    for e in snap.fstab:
         if not e.uuid:
             continue
-        if e.uuid in seen_uuids:
+        if e.uuid in graph.by_uuid:
             continue
-        if os.path.exists(f"/dev/disk/by-uuid/{e.uuid}"):
+        if e.uuid in snap.by_uuid:
             continue
         # Solo mostrar como gestionable si su mountpoint es típico de usuario.
         if not _is_user_mountpoint(e.mountpoint):
@@ -1109,157 +3471,1215 @@ def disks_view() -> list[dict[str, Any]]:
     return disks
 
 
-def manageable_partition_by_name(dev_id: str) -> dict[str, Any] | None:
+def disk_by_id(dev_id: str, snap: SystemSnapshot | None = None) -> dict[str, Any] | None:
+    """Registro de `disks_view()` para un único disco, sin construir la lista entera."""
+
+    snap = snap or system_snapshot()
+    node = manageable_partition_by_name(dev_id, snap)
+    if node is None:
+        return None
+    usage = _usage_prober.probe(node.mountpoint) if node.mountpoint else None
+    return _disk_record(node, snap.fstab_by_uuid, snap.fstab_by_dev, snap.enabled_share_paths, usage)
+
+
+def manageable_partition_by_name(dev_id: str, snap: SystemSnapshot | None = None) -> DeviceNode | None:
     dev_id = (dev_id or "").strip()
     if not DEVICE_ID_RE.match(dev_id):
         return None
-    parts = lsblk_partitions()
-    root_disk = _root_physical_disk(parts)
+    graph = (snap or system_snapshot()).graph
+    node = graph.get(dev_id)
+    if node is None or not _is_manageable(node, graph):
+        return None
+    return node
+
+
+def _is_mountpoint_mounted(mountpoint: str, snap: SystemSnapshot | None = None) -> bool:
+    mp = (mountpoint or "").strip()
+    if not mp:
+        return False
+    return mp in (snap or system_snapshot()).mounts
+
+
+# ---- Reconexión de entradas persistentes ----
+
+# udev mantiene este fichero mientras tiene eventos pendientes de procesar.
+UDEV_QUEUE_PATH = "/run/udev/queue"
+RECONNECT_WAIT_S = float(os.getenv("DISKMANAGER_RECONNECT_WAIT_S", "10"))
+RECONNECT_WORKERS = int(os.getenv("DISKMANAGER_RECONNECT_WORKERS", "4"))
+RECONNECT_ATTEMPTS = 3
+
+_FSTAB_SPEC_LINKS = (
+    ("UUID=", "/dev/disk/by-uuid/"),
+    ("PARTUUID=", "/dev/disk/by-partuuid/"),
+    ("LABEL=", "/dev/disk/by-label/"),
+    ("PARTLABEL=", "/dev/disk/by-partlabel/"),
+)
+
+
+def _fstab_entry_device_path(e: "FstabEntry") -> str | None:
+    """Nodo que udev crea para la entrada (p.ej. /dev/disk/by-uuid/<uuid>)."""
+
+    for prefix, directory in _FSTAB_SPEC_LINKS:
+        if e.spec.startswith(prefix):
+            value = e.spec[len(prefix) :]
+            return directory + value if value and "/" not in value else None
+    if e.spec.startswith("/dev/"):
+        return e.spec
+    return None
+
+
+def _wait_for_device_node(path: str, timeout_s: float) -> bool:
+    """Espera a que exista `path` mientras udev siga procesando eventos.
+
+    Si la cola de udev está vacía y el nodo no existe, el disco no está
+    conectado: volvemos al momento en vez de agotar el plazo.
+    """
+
+    deadline = time.monotonic() + timeout_s
+    delay = 0.02
+    while True:
+        if _backend.exists(path):
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not _backend.exists(UDEV_QUEUE_PATH):
+            return _backend.exists(path)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.2)
+
+
+def _mount_fstab_entry(e: "FstabEntry") -> tuple[str, str]:
+    """Monta una entrada de fstab en cuanto su dispositivo está listo.
+
+    Returns: (estado, error) con estado en "mounted" | "absent" | "failed".
+    """
+
+    dev_path = _fstab_entry_device_path(e)
+    if not dev_path or not _wait_for_device_node(dev_path, RECONNECT_WAIT_S):
+        return ("absent", "")
+    try:
+        with state_lock(device_lock_name(os.path.basename(os.path.realpath(dev_path))), timeout_s=DEVICE_LOCK_TIMEOUT_S):
+            return _mount_fstab_entry_locked(e, dev_path)
+    except LockBusy:
+        return ("failed", "Disco ocupado por otra operación.")
+
+
+def _mount_fstab_entry_locked(e: "FstabEntry", dev_path: str) -> tuple[str, str]:
+    # Si el fstype es ntfs3, intentar cargar módulo (best-effort).
+    if (e.fstype or "").strip().lower() == "ntfs3":
+        _capabilities.ensure_filesystem("ntfs3")
+
+    _backend.makedirs(e.mountpoint)
+    last_err = ""
+    for attempt in range(RECONNECT_ATTEMPTS):
+        cp = _run(["mount", e.mountpoint], timeout_s=30)
+        if cp.returncode == 0:
+            return ("mounted", "")
+        last_err = _truncate((cp.stderr or cp.stdout or "").strip())
+        if attempt + 1 < RECONNECT_ATTEMPTS:
+            # Backoff propio de este disco: el resto sigue montándose en paralelo.
+            time.sleep(0.25 * (2**attempt))
+            _wait_for_device_node(dev_path, RECONNECT_WAIT_S)
+    return ("failed", last_err)
+
+
+def _mount_fstab_entries(entries: list["FstabEntry"]) -> dict[str, tuple[str, str]]:
+    """Monta varias entradas a la vez (pool acotado); resultado por mountpoint."""
+
+    if not entries:
+        return {}
+    workers = max(1, min(RECONNECT_WORKERS, len(entries)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reconnect") as pool:
+        futures = {e.mountpoint: pool.submit(_mount_fstab_entry, e) for e in entries}
+        return {mp: f.result() for mp, f in futures.items()}
+
+
+def _automount_persistent_user_mounts() -> tuple[list[str], list[dict[str, str]]]:
+    """Best-effort: monta entradas persistentes (fstab) bajo /mnt o /media si el disco está presente.
+
+    Esto resuelve el caso de hot-unplug/hot-plug: al reconectar, quedan como 'permanente'
+    pero no montadas hasta que alguien ejecute `mount <mountpoint>`.
+    """
+
+    if _backend.geteuid() != 0:
+        return ([], [])
 
-    for p in parts:
-        if (p.get("name") or "") != dev_id:
+    snap = system_snapshot()
+    entries = [e for e in snap.fstab if _is_user_mountpoint(e.mountpoint)]
+
+    mounted: list[str] = []
+    failed: list[dict[str, str]] = []
+
+    # Para reiniciar Samba una sola vez si hace falta.
+    share_paths = snap.enabled_share_paths
+    mounted_share_paths = False
+
+    pending: list[FstabEntry] = []
+    for e in entries:
+        mp = (e.mountpoint or "").strip()
+        if not mp:
+            continue
+        if not _looks_safe_mountpoint(mp):
             continue
+        if _is_mountpoint_mounted(mp, snap):
+            continue
+        pending.append(e)
+
+    results = _mount_fstab_entries(pending)
+    for e in pending:
+        state, err = results.get(e.mountpoint, ("absent", ""))
+        if state == "mounted":
+            mounted.append(e.mountpoint)
+            if _norm_path(e.mountpoint) in share_paths:
+                mounted_share_paths = True
+        elif state == "failed":
+            failed.append({"mountpoint": e.mountpoint, "error": err})
 
-        # Si es el disco del sistema, nunca permitir.
-        if root_disk and dev_id == root_disk:
-            return None
+    if mounted:
+        snap.invalidate("devices", "mounts")
+    if mounted_share_paths:
+        _apply_samba_config()
+
+    return (mounted, failed)
+
+
+# ---- Eventos de estado de discos ----
+
+SSE_HEARTBEAT_S = 15.0
+# Las conexiones SSE ocupan un hilo del worker: las cerramos periódicamente y
+# EventSource reconecta solo (así un cliente muerto no retiene el hilo para siempre).
+SSE_MAX_S = float(os.getenv("DISKMANAGER_SSE_MAX_S", "300"))
+# Ventana para agrupar ráfagas de uevents (p.ej. un disco con varias particiones).
+SSE_COALESCE_S = 0.25
+
+
+def _disk_key(d: dict[str, Any]) -> str:
+    if d.get("missing"):
+        return f"missing:{d.get('uuid') or ''}:{d.get('mountpoint') or ''}"
+    return str(d.get("id") or "")
+
+
+def _disk_state_signature(d: dict[str, Any]) -> tuple:
+    return tuple(d.get(k) for k in ("label", "size", "fstype", "uuid", "mounted", "mountpoint", "persistent", "samba", "kind", "missing"))
+
+
+def _disk_usage_signature(d: dict[str, Any]) -> tuple:
+    u = d.get("usage") or {}
+    return (u.get("percent"), bool(u.get("stale")))
+
+
+def _index_disks(disks: list[dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    return {_disk_key(d): d for d in disks}
 
-        t = (p.get("type") or "").strip().lower()
 
-        # Permitir "disk" sin particiones para formateo.
-        if t == "disk":
-            if p.get("children"):
+def diff_disks(old: dict[str, dict[str, Any]], new: dict[str, dict[str, Any]]) -> list[dict[str, Any]]:
+    """Deltas entre dos inventarios: added/removed/mounted/unmounted/changed/usage."""
+
+    events: list[dict[str, Any]] = []
+    for key, d in new.items():
+        prev = old.get(key)
+        if prev is None:
+            change = "added"
+        elif bool(prev.get("mounted")) != bool(d.get("mounted")):
+            change = "mounted" if d.get("mounted") else "unmounted"
+        elif _disk_state_signature(prev) != _disk_state_signature(d):
+            change = "changed"
+        elif _disk_usage_signature(prev) != _disk_usage_signature(d):
+            change = "usage"
+        else:
+            continue
+        events.append({"change": change, "key": key, "id": d.get("id"), "disk": d})
+    for key, d in old.items():
+        if key not in new:
+            events.append({"change": "removed", "key": key, "id": d.get("id"), "disk": None})
+    return events
+
+
+def _file_signature(path: str) -> tuple[int, int, int] | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class _DiskStateTracker:
+    """Inventario versionado: versión monótona + qué cambió en cada versión.
+
+    `current()` solo recalcula `disks_view()` cuando cambia algo de lo que depende
+    (uevents/mountinfo, fstab, smb.conf o el tramo TTL del uso de disco); si no,
+    devuelve lo último sin tocar el sistema. La versión solo sube si hubo deltas.
+    """
+
+    # Cuántas bajas recordamos para servir `since=`; más allá, respuesta completa.
+    REMOVED_HISTORY = 256
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # Identifica quién numera las versiones (este proceso o el líder del
+        # inventario compartido): versiones de distinto epoch no son comparables.
+        self.epoch = secrets.token_hex(4)
+        self.version = 0
+        self._key: tuple | None = None
+        self._disks: list[dict[str, Any]] = []
+        self._index: dict[str, dict[str, Any]] = {}
+        self._changed_at: dict[str, int] = {}
+        self._removed_at: dict[str, int] = {}
+        self._oldest_delta = 0
+        # Instantánea del líder que estamos sirviendo (ver _SharedInventory).
+        self._adopted: dict[str, Any] | None = None
+
+    def _source_key(self) -> tuple:
+        return (
+            _changes.generation,
+            _backend.signature(FSTAB_PATH),
+            _backend.signature(SMB_CONF_PATH),
+            int(time.monotonic() // max(USAGE_TTL_S, 1.0)),
+        )
+
+    def current(self) -> tuple[int, list[dict[str, Any]]]:
+        shared = _shared_inventory.snapshot()
+        if shared is not None:
+            return self._adopt(shared)
+        key = self._source_key()
+        with self._lock:
+            if key == self._key:
+                return self.version, self._disks
+        # Pollers simultáneos (varias pestañas) comparten un único recálculo.
+        disks = _singleflight.do(("disks_view", key), lambda: disks_view(SystemSnapshot()))
+        index = _index_disks(disks)
+        with self._lock:
+            if self._adopted is not None:
+                # Volvemos a calcular nosotros: las versiones siguientes ya no son
+                # las del líder, así que cambiamos de epoch (los clientes recargan).
+                self._adopted = None
+                self.epoch = secrets.token_hex(4)
+            events = diff_disks(self._index, index)
+            if events or self._key is None:
+                self.version += 1
+                for ev in events:
+                    if ev["change"] == "removed":
+                        self._removed_at[ev["key"]] = self.version
+                        self._changed_at.pop(ev["key"], None)
+                    else:
+                        self._changed_at[ev["key"]] = self.version
+                        self._removed_at.pop(ev["key"], None)
+                if len(self._removed_at) > self.REMOVED_HISTORY:
+                    for k, _v in sorted(self._removed_at.items(), key=lambda kv: kv[1])[: -self.REMOVED_HISTORY]:
+                        self._oldest_delta = max(self._oldest_delta, self._removed_at.pop(k))
+            changed = self._key is None or bool(events)
+            self._key = key
+            self._disks = disks
+            self._index = index
+            version = self.version
+        if changed:
+            _last_state.request_save()
+        return version, disks
+
+    def peek(self) -> list[dict[str, Any]]:
+        """Última vista conocida sin recalcular ni sondear nada."""
+
+        shared = _shared_inventory.snapshot()
+        if shared is not None:
+            return self._adopt(shared)[1]
+        with self._lock:
+            return self._disks
+
+    @property
+    def warm(self) -> bool:
+        """True si ya hay una vista calculada (o adoptada) en este proceso."""
+
+        return self._key is not None or self._adopted is not None
+
+    def _adopt(self, shared: dict[str, Any]) -> tuple[int, list[dict[str, Any]]]:
+        with self._lock:
+            if shared is not self._adopted:
+                self._adopted = shared
+                self.epoch = shared["epoch"]
+                self.version = shared["version"]
+                self._disks = shared["disks"]
+                self._index = _index_disks(self._disks)
+                self._changed_at = shared["changed_at"]
+                self._removed_at = shared["removed_at"]
+                self._oldest_delta = shared["oldest_delta"]
+                self._key = None
+            return self.version, self._disks
+
+    def export(self) -> dict[str, Any]:
+        """Estado completo (vista + historial de deltas) para publicarlo a otros workers."""
+
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "epoch": self.epoch,
+                "version": self.version,
+                "disks": self._disks,
+                "changed_at": dict(self._changed_at),
+                "removed_at": dict(self._removed_at),
+                "oldest_delta": self._oldest_delta,
+            }
+
+    def delta(self, since: int) -> tuple[int, list[dict[str, Any]], list[str]] | None:
+        """(versión, cambiados, claves borradas) desde `since`; None si no se puede servir."""
+
+        version, _disks = self.current()
+        with self._lock:
+            if since > version or since < self._oldest_delta:
                 return None
-            # Solo permitir discos externos/hotplug.
+            changed = [self._index[k] for k, v in self._changed_at.items() if v > since and k in self._index]
+            removed = [k for k, v in self._removed_at.items() if v > since]
+            return version, changed, removed
+
+    def etag(self, version: int) -> str:
+        return f"{self.epoch}-{version}"
+
+
+_disk_state = _DiskStateTracker()
+
+
+# ---- Inventario compartido entre workers ----
+
+# Con varios workers de gunicorn cada uno sondeaba el sistema por su cuenta y su
+# caché solo servía a su parte de las peticiones. Ahora un único proceso, el
+# líder (el primer worker que coge el flock, o el sidecar `python app.py
+# inventoryd`), es el que escucha uevents, vigila mountinfo y muestrea el uso;
+# publica su estado en SHARED_INVENTORY_PATH (JSON, rename atómico) y el resto
+# solo hace stat() y relee cuando cambia. Si el líder muere, el kernel suelta el
+# flock y otro worker toma el relevo.
+SHARED_INVENTORY = os.getenv("DISKMANAGER_SHARED_INVENTORY", "1") != "0"
+SHARED_INVENTORY_PATH = os.path.join(STATE_DIR, "inventory.json")
+LOCK_INVENTORY_LEADER = "inventory-leader"
+# Cada cuánto mira el líder si hay que recalcular (fstab/smb.conf, tramo de uso).
+SHARED_INVENTORY_POLL_S = 0.5
+# El líder reescribe la instantánea al menos así de seguido aunque no cambie nada.
+SHARED_INVENTORY_KEEPALIVE_S = 5.0
+# Una instantánea más vieja que esto es de un líder colgado: calculamos en local.
+SHARED_INVENTORY_MAX_AGE_S = 15.0
+
+
+class _SharedInventory:
+    """Elección de líder + publicación/lectura de la instantánea compartida."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pid: int | None = None
+        self._enabled = False
+        self.is_leader = False
+        self._sig: tuple[int, int, int] | None = None
+        self._snapshot: dict[str, Any] | None = None
+
+    def _ensure_started(self) -> bool:
+        """Arranca (una vez por proceso) los hilos de elección y seguimiento."""
+
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._enabled
+        with self._lock:
+            if self._pid == pid:
+                return self._enabled
+            self._pid = pid
+            fd = _lock_fd(LOCK_INVENTORY_LEADER)
+            # Sin STATE_DIR escribible cada proceso va por su cuenta.
+            self._enabled = fd is not None
+            if fd is None:
+                return False
+            self.is_leader = False
+            self._sig = None
+            self._snapshot = None
+            threading.Thread(target=self._elect, args=(fd,), name="inventory-elect", daemon=True).start()
+            threading.Thread(target=self._follow, name="inventory-follow", daemon=True).start()
+            return True
+
+    def _elect(self, fd: int) -> None:
+        # Bloquea hasta que no quede otro líder vivo.
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        self.is_leader = True
+        self._publish_loop()
+
+    def _follow(self) -> None:
+        """Despierta a los streams SSE de este worker cuando el líder publica."""
+
+        sig = _file_signature(SHARED_INVENTORY_PATH)
+        while not self.is_leader:
+            time.sleep(SHARED_INVENTORY_POLL_S)
+            cur = _file_signature(SHARED_INVENTORY_PATH)
+            if cur != sig:
+                sig = cur
+                _changes.notify("shared")
+
+    def _publish_loop(self) -> None:
+        published: tuple[str, int] | None = None
+        published_at = 0.0
+        gen = _changes.generation
+        while True:
             try:
-                if int(p.get("rm") or 0) == 0 and int(p.get("hotplug") or 0) == 0:
-                    tran = (p.get("tran") or "").strip().lower()
-                    if tran != "usb":
-                        return None
+                version, _disks = _disk_state.current()
+                now = time.monotonic()
+                if (_disk_state.epoch, version) != published or now - published_at >= SHARED_INVENTORY_KEEPALIVE_S:
+                    _write_json_atomic(SHARED_INVENTORY_PATH, _disk_state.export())
+                    published = (_disk_state.epoch, version)
+                    published_at = now
             except Exception:
-                tran = (p.get("tran") or "").strip().lower()
-                if tran != "usb":
-                    return None
-            return p
-
-        if _is_noise_partition(p):
+                # Un fallo puntual (disco que desaparece a mitad...) no tumba al líder.
+                pass
+            new_gen = _changes.wait(gen, SHARED_INVENTORY_POLL_S)
+            if new_gen != gen:
+                time.sleep(SSE_COALESCE_S)
+            gen = _changes.generation
+
+    def serve(self) -> int:
+        """Modo sidecar: hace de líder en primer plano hasta que lo maten."""
+
+        fd = _lock_fd(LOCK_INVENTORY_LEADER)
+        if fd is None:
+            print(f"No se puede crear {LOCKS_DIR}.")
+            return 1
+        self._pid = os.getpid()
+        self._enabled = True
+        self.is_leader = True
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        self._publish_loop()
+        return 0
+
+    def snapshot(self) -> dict[str, Any] | None:
+        """Última instantánea del líder, o None si este proceso debe calcular en local."""
+
+        # La instantánea compartida describe este host: con otro backend (fake, replay) se calcula en local.
+        if not SHARED_INVENTORY or not _backend.kernel or not self._ensure_started() or self.is_leader:
             return None
-
-        # Nunca permitir operaciones sobre particiones del disco del sistema.
-        if root_disk and (p.get("pkname") == root_disk):
+        try:
+            st = os.stat(SHARED_INVENTORY_PATH)
+        except OSError:
             return None
-
-        mountpoint = p.get("mountpoint") or ""
-        mounted = bool(mountpoint)
-        fstype = (p.get("fstype") or "").lower()
-        if fstype == "swap":
+        if time.time() - st.st_mtime > SHARED_INVENTORY_MAX_AGE_S:
+            return None
+        if _changes.changed_at >= st.st_mtime:
+            # Este worker acaba de cambiar algo (montar, editar fstab...) y el
+            # líder aún no lo ha publicado: mejor fresco que compartido.
             return None
-        if mounted and _is_system_mountpoint(mountpoint):
+        sig = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if sig == self._sig:
+                return self._snapshot
+        try:
+            with open(SHARED_INVENTORY_PATH, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
             return None
-        if mounted and not _is_user_mountpoint(mountpoint):
+        if not isinstance(data, dict) or not isinstance(data.get("disks"), list):
             return None
-        return p
-    return None
+        with self._lock:
+            self._sig = sig
+            self._snapshot = data
+        return data
+
+
+_shared_inventory = _SharedInventory()
+
+
+# ---- Último estado conocido (arranque en frío) ----
+
+# Tras `systemctl restart hyperdrive` la primera vista tendría que sondear todo
+# en frío. Guardamos en disco la última vista (discos con uso, shares y filas de
+# fstab) y, mientras el proceso no tiene una propia, la servimos marcada como
+# `stale` y refrescamos en segundo plano.
+LAST_STATE_PATH = os.path.join(DATA_DIR, "last_state.json")
+# Mínimo entre escrituras: el uso cambia a menudo y esto va a disco, no a tmpfs.
+LAST_STATE_SAVE_INTERVAL_S = 30.0
+# Un estado más viejo que esto ya no sirve ni como aproximación.
+LAST_STATE_MAX_AGE_S = float(os.getenv("DISKMANAGER_LAST_STATE_MAX_AGE_S", str(7 * 86400)))
+
+
+class _LastState:
+    """Persistencia diferida de la última vista + refresco en segundo plano."""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._dirty = False
+        self._saved_at = 0.0
+        self._thread: threading.Thread | None = None
+        self._loaded: dict[str, Any] | None = None
+        self._load_done = False
+        self._refreshing = False
+
+    def request_save(self) -> None:
+        # Igual que el inventario compartido: lo guardado es de este host, no de un fake o un replay.
+        if not _backend.kernel:
+            return
+        with self._cond:
+            self._dirty = True
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="last-state", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._dirty:
+                    self._cond.wait()
+                while (delay := self._saved_at + LAST_STATE_SAVE_INTERVAL_S - time.monotonic()) > 0:
+                    self._cond.wait(delay)
+                self._dirty = False
+                self._saved_at = time.monotonic()
+            try:
+                self.save()
+            except Exception:
+                # Sin DATA_DIR escribible no hay arranque rápido, pero nada más.
+                pass
 
+    def save(self) -> None:
+        _version, disks = _disk_state.current()
+        snap = SystemSnapshot()
+        entries = [e for e in snap.fstab if _is_user_mountpoint(e.mountpoint)]
+        data = {
+            "saved_at": time.time(),
+            "disks": disks,
+            "shares": snap.shares,
+            "fstab_rows": fstab_rows(entries, snap),
+        }
+        os.makedirs(DATA_DIR, mode=0o755, exist_ok=True)
+        _atomic_write_text(LAST_STATE_PATH, json.dumps(data, ensure_ascii=False, separators=(",", ":")))
 
-def _is_mountpoint_mounted(mountpoint: str) -> bool:
-    mp = (mountpoint or "").strip()
-    if not mp:
-        return False
+    def load(self) -> dict[str, Any] | None:
+        """El estado guardado (leído una vez por proceso), o None si no hay o es viejo."""
+
+        with self._cond:
+            if not self._load_done:
+                self._load_done = True
+                try:
+                    with open(LAST_STATE_PATH, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                    if isinstance(data, dict) and isinstance(data.get("disks"), list):
+                        self._loaded = data
+                except (OSError, ValueError):
+                    pass
+            data = self._loaded
+        if data is None or time.time() - float(data.get("saved_at") or 0) > LAST_STATE_MAX_AGE_S:
+            return None
+        return data
+
+    def refresh_in_background(self) -> None:
+        with self._cond:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, name="cold-refresh", daemon=True).start()
+
+    def _refresh(self) -> None:
+        try:
+            _disk_state.current()
+        except Exception:
+            pass
+        finally:
+            with self._cond:
+                self._refreshing = False
+
+
+_last_state = _LastState()
+
+
+def _cold_view() -> dict[str, Any] | None:
+    """Último estado guardado si este proceso aún no tiene vista propia; si no, None.
+
+    Si devuelve algo, deja lanzado el refresco para que la siguiente petición ya
+    vea datos frescos.
+    """
+
+    if _disk_state.warm or not _backend.kernel or _shared_inventory.snapshot() is not None:
+        return None
+    data = _last_state.load()
+    if data is None:
+        return None
+    _last_state.refresh_in_background()
+    return data
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def stats(disks: list[dict[str, Any]]) -> dict[str, int]:
+    detected = len(disks)
+    mounted = sum(1 for d in disks if d.get("mounted"))
+    missing = sum(1 for d in disks if d.get("missing"))
+    persistent = sum(1 for d in disks if d.get("persistent"))
+    samba = sum(1 for d in disks if d.get("samba"))
+    return dict(detected=detected, mounted=mounted, missing=missing, persistent=persistent, samba=samba)
+
+
+# ---- Instantáneas del host (captura y replay) ----
+
+SNAPSHOT_FORMAT = 1
+
+
+def _snapshot_sources() -> dict[str, str]:
+    """Ficheros del host que entran en la instantánea: nombre en el archivo -> ruta."""
+
+    return {
+        "fstab": FSTAB_PATH,
+        "smb.conf": SMB_CONF_PATH,
+        "mountinfo": MOUNTINFO_PATH,
+        "diskstats": "/proc/diskstats",
+        "filesystems": "/proc/filesystems",
+    }
+
+
+def _timed(probes: dict[str, dict[str, Any]], name: str, fn: Callable[[], Any]) -> Any:
+    """Ejecuta un sondeo apuntando su duración (y el error, si lo hay) en `probes`."""
+
+    t0 = time.perf_counter()
     try:
-        with open("/proc/mounts", "r", encoding="utf-8", errors="replace") as f:
-            for raw in f:
-                parts = raw.split()
-                if len(parts) >= 2 and parts[1] == mp:
-                    return True
-    except Exception:
-        return False
-    return False
+        return fn()
+    except Exception as e:
+        probes[name] = {"error": _truncate(str(e))}
+        return None
+    finally:
+        probes.setdefault(name, {})["ms"] = round((time.perf_counter() - t0) * 1000, 3)
+
+
+def _snapshot_usage(probes: dict[str, dict[str, Any]], mountpoints: list[str]) -> dict[str, Any]:
+    """statvfs de cada montaje, cada uno en su hilo con el plazo de USAGE_TIMEOUT_S."""
+
+    results: dict[str, Any] = {}
+    started: dict[str, tuple[threading.Thread, float]] = {}
+    for mp in mountpoints:
+        def probe(mp: str = mp) -> None:
+            results[mp] = list(_backend.disk_usage(mp))
+
+        t = threading.Thread(target=probe, name="snapshot-usage", daemon=True)
+        started[mp] = (t, time.perf_counter())
+        t.start()
+    deadline = time.monotonic() + USAGE_TIMEOUT_S
+    for mp, (t, t0) in started.items():
+        t.join(max(0.0, deadline - time.monotonic()))
+        probe_info: dict[str, Any] = {"ms": round((time.perf_counter() - t0) * 1000, 3)}
+        if t.is_alive():
+            probe_info["timeout"] = True
+        elif mp not in results:
+            probe_info["error"] = "statvfs falló"
+        probes[f"usage:{mp}"] = probe_info
+    return {mp: results.get(mp) for mp in mountpoints}
+
+
+def capture_snapshot() -> bytes:
+    """Todo lo que la app lee del host + lo que tardó cada lectura, en un .tar.gz.
+
+    Contiene `manifest.json` (tiempos, herramientas, /dev/disk/by-uuid, uso de
+    disco...), `lsblk.json` y `files/<nombre>` por cada fichero de
+    `_snapshot_sources()`. `SnapshotBackend` lo reproduce en otra máquina.
+    """
 
+    probes: dict[str, dict[str, Any]] = {}
+    lsblk_cp = _timed(probes, "lsblk", lambda: _backend.run(LSBLK_ARGS, timeout_s=10))
+    files: dict[str, str] = {}
+    for name, path in _snapshot_sources().items():
+        text = _timed(probes, name, lambda path=path: _backend.read_text(path))
+        if text is not None:
+            files[name] = text
+    by_uuid = _timed(probes, "by-uuid", lambda: sorted(_backend.listdir("/dev/disk/by-uuid")))
+    tools = _timed(probes, "tools", lambda: {t: _backend.which(t) for t in KNOWN_TOOLS})
+    mountpoints = sorted(
+        {e.mountpoint for e in _parse_mountinfo(files.get("mountinfo", "")) if e.source.startswith("/dev/")}
+    )
+
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "created_at": time.time(),
+        "hostname": socket.gethostname(),
+        "kernel": os.uname().release,
+        "euid": _backend.geteuid(),
+        "sources": _snapshot_sources(),
+        "lsblk": {
+            "args": LSBLK_ARGS,
+            "returncode": lsblk_cp.returncode if lsblk_cp else None,
+            "stderr": _truncate(lsblk_cp.stderr or "") if lsblk_cp else "",
+        },
+        "by_uuid": by_uuid,
+        "tools": tools or {},
+        "modules": _timed(probes, "modules", lambda: {m: _backend.kernel_module_available(m) for m in KNOWN_MODULES}) or {},
+        "usage": _snapshot_usage(probes, mountpoints),
+        "probes": probes,
+        "slow_requests": _slow_requests.merged()["slowest"],
+    }
 
-def _device_present_for_fstab_entry(e: "FstabEntry") -> bool:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+
+        def add(name: str, text: str) -> None:
+            data = text.encode("utf-8")
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(manifest["created_at"])
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+
+        add("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2, sort_keys=True))
+        if lsblk_cp is not None:
+            add("lsblk.json", lsblk_cp.stdout or "")
+        for name, text in files.items():
+            add(f"files/{name}", text)
+    return buf.getvalue()
+
+
+def snapshot_filename() -> str:
+    return f"hyperdrive-snapshot-{socket.gethostname()}-{time.strftime('%Y%m%d-%H%M%S')}.tar.gz"
+
+
+class SnapshotBackend(SystemBackend):
+    """Replay de solo lectura de una instantánea de `capture_snapshot()`.
+
+    Con `latency`, cada lectura tarda lo que tardó en el host original (y un
+    statvfs que se colgó vuelve a colgarse hasta su plazo), así que los problemas
+    de rendimiento se reproducen tal cual. Montar, escribir o ejecutar cualquier
+    otra cosa falla sin tocar la máquina local.
+    """
+
+    kernel = False
+
+    def __init__(self, path: str, *, latency: bool = True) -> None:
+        members: dict[str, str] = {}
+        with tarfile.open(path, "r:gz") as tar:
+            for m in tar.getmembers():
+                f = tar.extractfile(m) if m.isfile() else None
+                if f is not None:
+                    members[m.name] = f.read().decode("utf-8", errors="replace")
+        try:
+            manifest = json.loads(members.pop("manifest.json"))
+        except (KeyError, ValueError):
+            raise ValueError(f"{path} no es una instantánea de HyperDrive.") from None
+        if manifest.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"Formato de instantánea no soportado: {manifest.get('format')!r}.")
+
+        self.manifest: dict[str, Any] = manifest
+        self.latency = latency
+        self._lsblk = members.get("lsblk.json")
+        self._files = {k[len("files/"):]: v for k, v in members.items() if k.startswith("files/")}
+        self._usage: dict[str, list[int] | None] = manifest.get("usage") or {}
+        self._by_uuid = set(manifest.get("by_uuid") or [])
+        self._devices: set[str] = set()
+        try:
+            stack = list(json.loads(self._lsblk or "{}").get("blockdevices") or [])
+        except ValueError:
+            stack = []
+        while stack:
+            node = stack.pop()
+            self._devices.add(node.get("name") or "")
+            stack.extend(node.get("children") or [])
+
+    def _replay_latency(self, probe: str) -> None:
+        if self.latency:
+            ms = (self.manifest.get("probes", {}).get(probe) or {}).get("ms") or 0
+            if ms > 0:
+                time.sleep(ms / 1000)
+
+    def _file_name(self, path: str) -> str | None:
+        for name, src in _snapshot_sources().items():
+            if src == path and name in self._files:
+                return name
+        return None
+
+    def run(self, args: list[str], *, timeout_s: int = 10, input: str | None = None) -> subprocess.CompletedProcess:
+        if args[:1] == ["lsblk"] and self._lsblk is not None:
+            self._replay_latency("lsblk")
+            rc = self.manifest.get("lsblk", {}).get("returncode") or 0
+            stderr = self.manifest.get("lsblk", {}).get("stderr") or ""
+            return subprocess.CompletedProcess(args=args, returncode=rc, stdout=self._lsblk, stderr=stderr)
+        return subprocess.CompletedProcess(
+            args=args, returncode=1, stdout="", stderr=f"Instantánea de solo lectura: no se ejecuta {args[0] if args else ''}."
+        )
+
+    def run_streaming(
+        self,
+        args: list[str],
+        *,
+        timeout_s: int,
+        on_output: Callable[[str], None],
+        should_cancel: Callable[[], bool],
+    ) -> tuple[int, str]:
+        return 1, f"Instantánea de solo lectura: no se ejecuta {args[0] if args else ''}."
+
+    def which(self, tool: str) -> str | None:
+        return (self.manifest.get("tools") or {}).get(tool)
+
+    def read_text(self, path: str) -> str:
+        name = self._file_name(path)
+        if name is None:
+            raise FileNotFoundError(2, "No está en la instantánea", path)
+        self._replay_latency(name)
+        return self._files[name]
+
+    def write_text(self, path: str, text: str) -> None:
+        raise PermissionError(13, "Instantánea de solo lectura", path)
+
+    def write_temp(self, directory: str, prefix: str, text: str) -> str:
+        raise PermissionError(13, "Instantánea de solo lectura", directory)
+
+    def remove(self, path: str) -> None:
+        raise PermissionError(13, "Instantánea de solo lectura", path)
+
+    def signature(self, path: str) -> tuple[int, int, int] | None:
+        name = self._file_name(path)
+        if name is None:
+            return None
+        return (sorted(self._files).index(name) + 1, 0, len(self._files[name]))
+
+    def exists(self, path: str) -> bool:
+        if self._file_name(path) is not None:
+            return True
+        if path.startswith("/dev/disk/by-uuid/"):
+            return path.rsplit("/", 1)[1] in self._by_uuid
+        if path.startswith("/dev/"):
+            return path[len("/dev/"):] in self._devices
+        return path in self._usage
+
+    def is_block_device(self, path: str) -> bool:
+        # Solo lo pide el formateo: que se pare antes de lanzar wipefs/parted.
+        raise PermissionError(13, "Instantánea de solo lectura", path)
+
+    def isdir(self, path: str) -> bool:
+        return path == "/dev/disk/by-uuid" or path in self._usage
+
+    def listdir(self, path: str) -> list[str]:
+        if path == "/dev/disk/by-uuid":
+            self._replay_latency("by-uuid")
+            return sorted(self._by_uuid)
+        raise FileNotFoundError(2, "No está en la instantánea", path)
+
+    def makedirs(self, path: str) -> None:
+        # Sin efecto: el `mount` que viene detrás ya falla con un mensaje claro.
+        pass
+
+    def rmdir(self, path: str) -> None:
+        pass
+
+    def disk_usage(self, path: str) -> tuple[int, int, int]:
+        probe = f"usage:{path}"
+        self._replay_latency(probe)
+        if (self.manifest.get("probes", {}).get(probe) or {}).get("timeout"):
+            raise TimeoutError(f"statvfs de {path} no respondió en la captura")
+        usage = self._usage.get(path)
+        if not usage:
+            raise FileNotFoundError(2, "No está en la instantánea", path)
+        total, used, free = usage
+        return total, used, free
+
+    def geteuid(self) -> int:
+        return int(self.manifest.get("euid") or 0)
+
+    def kernel_module_available(self, module: str) -> bool | None:
+        return (self.manifest.get("modules") or {}).get(module)
+
+
+# ---- Trabajos en segundo plano (formateo) ----
+
+# Los trabajos viven en disco (tmpfs en /run) para que cualquier worker de
+# gunicorn pueda consultarlos o cancelarlos, no solo el que los lanzó.
+JOBS_DIR = os.path.join(STATE_DIR, "jobs")
+JOB_ID_RE = re.compile(r"^[a-f0-9]{16}$")
+JOB_ACTIVE = {"queued", "running"}
+# Trabajos terminados que se conservan para que la UI pueda leer el resultado.
+JOB_KEEP_S = 3600
+JOB_LOG_LINES = 200
+# La salida de mkfs puede ser muy verbosa: limitamos las escrituras del JSON.
+JOB_SAVE_INTERVAL_S = 0.5
+JOB_EVENTS_POLL_S = 0.5
+# Reparto de la barra de progreso: preparar el disco / mkfs.
+JOB_PREPARE_WEIGHT = 30
+
+_MKFS_FRACTION_RE = re.compile(r"(\d+)\s*/\s*(\d+)\s*$")
+_MKFS_PERCENT_RE = re.compile(r"(\d{1,3}(?:\.\d+)?)\s*(?:%|percent)", re.IGNORECASE)
+
+
+def _write_json_atomic(path: str, data: Any) -> None:
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
     try:
-        if e.uuid:
-            return os.path.exists(f"/dev/disk/by-uuid/{e.uuid}")
-        if e.spec.startswith("/dev/"):
-            return os.path.exists(e.spec)
-    except Exception:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
         return False
-    return False
+    except PermissionError:
+        return True
+    return True
+
 
+class Job:
+    """Trabajo persistido en JOBS_DIR/<id>.json.
+
+    Solo el proceso que lo ejecuta escribe el JSON; la cancelación se pide desde
+    cualquier worker creando el marcador <id>.cancel.
+    """
+
+    def __init__(self, data: dict[str, Any]) -> None:
+        self.data = data
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+
+    @property
+    def id(self) -> str:
+        return str(self.data["id"])
+
+    @property
+    def status(self) -> str:
+        return str(self.data.get("status") or "")
+
+    @property
+    def active(self) -> bool:
+        return self.status in JOB_ACTIVE
+
+    @staticmethod
+    def _path(job_id: str, suffix: str = ".json") -> str:
+        return os.path.join(JOBS_DIR, job_id + suffix)
+
+    @classmethod
+    def create(cls, kind: str, target: str, params: dict[str, Any]) -> "Job":
+        now = time.time()
+        job = cls(
+            {
+                "id": secrets.token_hex(8),
+                "kind": kind,
+                "target": target,
+                "params": params,
+                "status": "queued",
+                "progress": 0,
+                "step": "En cola",
+                "log": [],
+                "message": "",
+                "details": "",
+                "created": now,
+                "updated": now,
+                "finished": None,
+                "pid": os.getpid(),
+            }
+        )
+        job.save()
+        return job
+
+    @classmethod
+    def load(cls, job_id: str) -> "Job | None":
+        if not JOB_ID_RE.match(job_id or ""):
+            return None
+        try:
+            with open(cls._path(job_id), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        job = cls(data)
+        # Si el worker que lo ejecutaba murió (reinicio, OOM...), el trabajo no
+        # avanzará nunca: lo damos por fallido.
+        if job.active and not _pid_alive(int(data.get("pid") or 0)):
+            job.data.update(
+                status="failed",
+                message="El trabajo se interrumpió (el proceso que lo ejecutaba terminó).",
+                finished=data.get("updated"),
+            )
+        return job
+
+    @classmethod
+    def all(cls) -> list["Job"]:
+        try:
+            names = os.listdir(JOBS_DIR)
+        except OSError:
+            return []
+        jobs: list[Job] = []
+        now = time.time()
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            job = cls.load(name[:-5])
+            if not job:
+                continue
+            finished = job.data.get("finished")
+            if not job.active and finished and now - float(finished) > JOB_KEEP_S:
+                job._remove()
+                continue
+            jobs.append(job)
+        jobs.sort(key=lambda j: float(j.data.get("created") or 0), reverse=True)
+        return jobs
+
+    @classmethod
+    def active_for(cls, target: str) -> "Job | None":
+        return next((j for j in cls.all() if j.active and j.data.get("target") == target), None)
+
+    def save(self) -> None:
+        self._saved_at = time.monotonic()
+        _write_json_atomic(self._path(self.id), self.data)
+
+    def update(self, *, force: bool = False, **fields: Any) -> None:
+        with self._lock:
+            self.data.update(fields)
+            self.data["updated"] = time.time()
+            if force or time.monotonic() - self._saved_at >= JOB_SAVE_INTERVAL_S:
+                self.save()
+
+    def log(self, line: str) -> None:
+        with self._lock:
+            lines = self.data.setdefault("log", [])
+            lines.append(line)
+            del lines[:-JOB_LOG_LINES]
+        self.update()
+
+    def finish(self, status: str, message: str, details: str = "") -> None:
+        self.update(force=True, status=status, message=message, details=details, finished=time.time())
+        try:
+            os.unlink(self._path(self.id, ".cancel"))
+        except OSError:
+            pass
 
-def _automount_persistent_user_mounts() -> tuple[list[str], list[dict[str, str]]]:
-    """Best-effort: monta entradas persistentes (fstab) bajo /mnt o /media si el disco está presente.
+    def cancel_requested(self) -> bool:
+        return os.path.exists(self._path(self.id, ".cancel"))
 
-    Esto resuelve el caso de hot-unplug/hot-plug: al reconectar, quedan como 'permanente'
-    pero no montadas hasta que alguien ejecute `mount <mountpoint>`.
-    """
+    def request_cancel(self) -> None:
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        with open(self._path(self.id, ".cancel"), "w", encoding="utf-8"):
+            pass
 
-    if os.geteuid() != 0:
-        return ([], [])
+    def _remove(self) -> None:
+        for suffix in (".json", ".cancel"):
+            try:
+                os.unlink(self._path(self.id, suffix))
+            except OSError:
+                pass
 
-    # Evitar carreras al reconectar: esperar a udev.
-    if shutil.which("udevadm"):
-        _run(["udevadm", "settle"], timeout_s=20)
+    def public(self) -> dict[str, Any]:
+        data = {k: v for k, v in self.data.items() if k != "pid"}
+        data["active"] = self.active
+        return data
 
-    entries = [e for e in parse_fstab() if _is_user_mountpoint(e.mountpoint)]
 
-    mounted: list[str] = []
-    failed: list[dict[str, str]] = []
+def _job_mtime(job_id: str) -> float:
+    try:
+        return os.stat(Job._path(job_id)).st_mtime
+    except OSError:
+        return 0.0
 
-    # Para reiniciar Samba una sola vez si hace falta.
-    shares = samba_shares()
-    share_paths = {s.get("path") for s in shares if s.get("path") and s.get("enabled")}
-    mounted_share_paths = False
 
-    for e in entries:
-        mp = (e.mountpoint or "").strip()
-        if not mp:
-            continue
-        if not _looks_safe_mountpoint(mp):
-            continue
-        if _is_mountpoint_mounted(mp):
-            continue
-        if not _device_present_for_fstab_entry(e):
-            continue
+def _run_streaming(
+    args: list[str],
+    *,
+    timeout_s: int,
+    on_output: Callable[[str], None],
+    should_cancel: Callable[[], bool],
+) -> tuple[int, str]:
+    """Como `_run`, pero entrega la salida línea a línea y permite cancelar.
 
-        # Si el fstype es ntfs3, a veces conviene cargar el módulo antes.
-        if (e.fstype or "").strip().lower() == "ntfs3":
-            _try_modprobe("ntfs3")
+    Devuelve (returncode, últimas líneas); 124 = timeout, 130 = cancelado.
+    """
 
-        os.makedirs(mp, exist_ok=True)
+    started = time.perf_counter()
+    rc = 127
+    try:
+        with span(f"run.{_command_name(args)}"):
+            rc, tail = _backend.run_streaming(args, timeout_s=timeout_s, on_output=on_output, should_cancel=should_cancel)
+        return rc, tail
+    finally:
+        # Cancelar no es un fallo del comando.
+        _record_command(args, time.perf_counter() - started, 0 if rc == 130 else rc)
+
+
+def _mkfs_progress(line: str) -> float | None:
+    """Fracción 0..1 si la línea es un indicador de progreso de mkfs."""
+
+    m = _MKFS_FRACTION_RE.search(line)
+    if m and int(m.group(2)) > 0:
+        return min(1.0, int(m.group(1)) / int(m.group(2)))
+    m = _MKFS_PERCENT_RE.search(line)
+    if m:
+        return min(1.0, float(m.group(1)) / 100)
+    return None
 
-        # Reintentos cortos por si el dispositivo aún se está enumerando.
-        last_err = ""
-        for _ in range(3):
-            cp = _run(["mount", mp], timeout_s=30)
-            if cp.returncode == 0:
-                mounted.append(mp)
-                if mp in share_paths:
-                    mounted_share_paths = True
-                last_err = ""
-                break
-            last_err = _truncate((cp.stderr or cp.stdout or "").strip())
-            if shutil.which("udevadm"):
-                _run(["udevadm", "settle"], timeout_s=10)
-            time.sleep(1)
 
-        if last_err:
-            failed.append({"mountpoint": mp, "error": last_err})
+def _format_job(job: Job, disk_name: str, fstype: str, label: str) -> None:
+    # Lock del disco durante todo el trabajo: montar/desmontar ese disco desde
+    # otro worker devuelve 409 en vez de competir con wipefs/mkfs.
+    try:
+        with state_lock(device_lock_name(disk_name)):
+            _format_job_locked(job, disk_name, fstype, label)
+    except LockBusy:
+        job.finish("failed", "El disco está ocupado por otra operación; no se formateó.")
 
-    if mounted_share_paths:
-        _apply_samba_restart()
 
-    return (mounted, failed)
+def _format_job_locked(job: Job, disk_name: str, fstype: str, label: str) -> None:
+    job.update(force=True, status="running", step="Preparando disco", progress=1)
+    try:
+        prepared = [0]
+
+        def on_step(msg: str) -> None:
+            prepared[0] += 1
+            job.log(msg)
+            job.update(progress=min(JOB_PREPARE_WEIGHT - 1, 1 + prepared[0] * 5))
+
+        msftdata = fstype in {"ntfs", "exfat", "vfat", "fat32"}
+        ok, new_part_path, details = _wipe_and_single_partition(
+            disk_name,
+            msftdata=msftdata,
+            on_step=on_step,
+            should_cancel=job.cancel_requested,
+        )
+        if not ok:
+            if job.cancel_requested():
+                job.finish("cancelled", "Formateo cancelado.", _truncate(details))
+            else:
+                job.finish("failed", "No se pudo preparar el disco (borrar/particionar).", _truncate(details))
+            return
+
+        cmd = _format_commands(fstype, new_part_path, label)
+        if not cmd:
+            job.finish("failed", "Formato no soportado o herramienta no instalada.")
+            return
+
+        job.update(force=True, step=f"Formateando {new_part_path} como {fstype}", progress=JOB_PREPARE_WEIGHT)
+        job.log("$ " + " ".join(cmd))
+
+        def on_output(line: str) -> None:
+            frac = _mkfs_progress(line)
+            if frac is None:
+                job.log(line)
+                return
+            job.update(progress=JOB_PREPARE_WEIGHT + int(frac * (99 - JOB_PREPARE_WEIGHT)))
+
+        format_timeout_s = int(os.getenv("DISKMANAGER_FORMAT_TIMEOUT_S", "1800"))
+        rc, out = _run_streaming(cmd, timeout_s=format_timeout_s, on_output=on_output, should_cancel=job.cancel_requested)
+        if rc == 130:
+            job.finish(
+                "cancelled",
+                "Formateo cancelado.",
+                f"{new_part_path} queda con un sistema de archivos incompleto: vuelve a formatear antes de usarlo.",
+            )
+        elif rc == 124:
+            job.finish(
+                "failed",
+                "El formateo tardó demasiado y se canceló.",
+                f"Aumenta DISKMANAGER_FORMAT_TIMEOUT_S (actual: {format_timeout_s}s) o revisa el estado del disco.\n{_truncate(out)}",
+            )
+        elif rc != 0:
+            job.finish("failed", "Error formateando.", _truncate(out))
+        else:
+            job.update(progress=100, step="Completado")
+            job.finish("succeeded", f"Disco formateado como {fstype}.", _truncate(details))
+    except Exception as e:
+        job.finish("failed", "Error inesperado durante el formateo.", _truncate(str(e)))
+    finally:
+        _invalidate_inventory()
 
 
-def stats(disks: list[dict[str, Any]]) -> dict[str, int]:
-    detected = len(disks)
-    mounted = sum(1 for d in disks if d.get("mounted"))
-    missing = sum(1 for d in disks if d.get("missing"))
-    persistent = sum(1 for d in disks if d.get("persistent"))
-    samba = sum(1 for d in disks if d.get("samba"))
-    return dict(detected=detected, mounted=mounted, missing=missing, persistent=persistent, samba=samba)
+def start_format_job(disk_name: str, fstype: str, label: str) -> Job:
+    job = Job.create("format", disk_name, {"fstype": fstype, "label": label})
+    threading.Thread(target=_format_job, args=(job, disk_name, fstype, label), name=f"job-{job.id}", daemon=True).start()
+    return job
 
 
 # ---- Rutas UI ----
@@ -1269,25 +4689,37 @@ def home():
 
 @app.get("/dashboard")
 def dashboard():
-    disks = disks_view()
-    return render_template("dashboard.html", stats=stats(disks), disks=disks)
+    cold = _cold_view()
+    disks = cold["disks"] if cold else _disk_state.current()[1]
+    return render_page("dashboard.html", stats=stats(disks), disks=disks, stale=bool(cold))
 
 @app.get("/disks")
 def disks():
-    return render_template("disks.html", disks=disks_view())
+    cold = _cold_view()
+    disks = cold["disks"] if cold else _disk_state.current()[1]
+    return render_page("disks.html", disks=disks, stale=bool(cold))
 
 @app.get("/fstab")
 def fstab():
+    cold = _cold_view()
+    if cold and isinstance(cold.get("fstab_rows"), list):
+        return render_page("fstab.html", rows=cold["fstab_rows"], stale=True)
     # Vista amigable: solo mostramos entradas "de usuario" (p.ej. /mnt o /media).
-    entries = [e for e in parse_fstab() if _is_user_mountpoint(e.mountpoint)]
-    return render_template("fstab.html", rows=fstab_rows(entries))
+    snap = system_snapshot()
+    entries = [e for e in snap.fstab if _is_user_mountpoint(e.mountpoint)]
+    return render_page("fstab.html", rows=fstab_rows(entries, snap))
 
 @app.get("/samba")
 def samba():
-    return render_template("samba.html", shares=samba_shares(), disks=disks_view())
+    cold = _cold_view()
+    if cold and isinstance(cold.get("shares"), list):
+        return render_page("samba.html", shares=cold["shares"], disks=cold["disks"], stale=True)
+    return render_page("samba.html", shares=system_snapshot().shares, disks=_disk_state.current()[1])
 
 
 @app.post("/api/mount")
+@idempotent
+@device_locked
 def api_mount():
     ok, msg = _require_root()
     if not ok:
@@ -1299,10 +4731,11 @@ def api_mount():
         return jsonify({"ok": False, "message": "ID de dispositivo inválido."}), 400
 
     dev_path = f"/dev/{dev_id}"
-    if not os.path.exists(dev_path):
+    if not _backend.exists(dev_path):
         return jsonify({"ok": False, "message": f"No existe {dev_path}."}), 404
 
-    part = manageable_partition_by_name(dev_id)
+    snap = system_snapshot()
+    part = manageable_partition_by_name(dev_id, snap)
     if not part:
         return (
             jsonify(
@@ -1314,27 +4747,24 @@ def api_mount():
             400,
         )
 
-    disks = disks_view()
-    d = next((x for x in disks if x.get("id") == dev_id), None)
+    d = disk_by_id(dev_id, snap)
     if d and d.get("mounted"):
-        return jsonify({"ok": True, "message": "Ya estaba montado."})
+        return jsonify({"ok": True, "message": "Ya estaba montado.", "disk": d})
 
     # Si está en fstab, montamos por mountpoint (mount <dir>) para usar opciones.
-    entries = parse_fstab()
     target_mountpoint: str | None = None
     disk_uuid = d.get("uuid") if d else None
     if disk_uuid and disk_uuid != "-":
-        for e in entries:
-            if e.spec == f"UUID={disk_uuid}":
-                target_mountpoint = e.mountpoint
-                break
+        entry = snap.fstab_by_uuid.get(disk_uuid)
+        if entry is not None:
+            target_mountpoint = entry.mountpoint
 
     mounted_mp = ""
     if target_mountpoint:
         if not _looks_safe_mountpoint(target_mountpoint):
             return jsonify({"ok": False, "message": "Punto de montaje inseguro; solo /mnt o /media."}), 400
-        os.makedirs(target_mountpoint, exist_ok=True)
-        if shutil.which("udevadm"):
+        _backend.makedirs(target_mountpoint)
+        if _capabilities.has("udevadm"):
             _run(["udevadm", "settle"], timeout_s=15)
         cp = _run(["mount", target_mountpoint], timeout_s=45)
         mounted_mp = target_mountpoint
@@ -1344,21 +4774,15 @@ def api_mount():
         if requested:
             mp = f"/mnt/{_safe_mount_dir(requested)}"
         else:
-            label = (d.get("label") if d else "") or (part.get("label") or dev_id)
+            label = (d.get("label") if d else "") or (part.label or dev_id)
             mp = f"/mnt/{_safe_mount_dir(label)}"
         if not _looks_safe_mountpoint(mp):
             return jsonify({"ok": False, "message": "Punto de montaje inseguro."}), 400
-        os.makedirs(mp, exist_ok=True)
-
-        fs = (part.get("fstype") or "").strip().lower()
-        if fs in {"ntfs", "ntfs3"}:
-            cp = _mount_ntfs(dev_path, mp)
-        else:
-            if shutil.which("udevadm"):
-                _run(["udevadm", "settle"], timeout_s=10)
-            cp = _run(["mount", dev_path, mp], timeout_s=30)
+        cp = _mount_device_at(dev_path, part.fstype, mp)
         mounted_mp = mp
 
+    # Montar no genera uevent: invalidamos a mano (también si falló a medias).
+    snap.invalidate("devices", "mounts")
     if cp.returncode != 0:
         err = (cp.stderr or cp.stdout or "").strip()
         if "unknown filesystem type 'ntfs-3g'" in err.lower() or "unknown filesystem type \"ntfs-3g\"" in err.lower():
@@ -1368,23 +4792,115 @@ def api_mount():
     # Si ya existe un share habilitado apuntando a este mountpoint, refrescamos Samba
     # para evitar que el usuario tenga que reiniciar smbd manualmente.
     try:
-        if mounted_mp and os.path.exists("/etc/samba/smb.conf"):
+        if mounted_mp and _backend.exists(SMB_CONF_PATH):
             # Si el share existía y estaba deshabilitado (available=no), lo re-habilitamos.
             _set_share_available_by_path(mounted_mp, True, restart=False)
-            # Y en cualquier caso, si hay share habilitado para ese path, reiniciar hace que quede accesible.
-            if _samba_enabled_share_for_path(mounted_mp):
-                _apply_samba_restart()
+            # Y en cualquier caso, si hay share habilitado para ese path, recargar hace que quede accesible.
+            if _samba_enabled_share_for_path(mounted_mp, snap):
+                _apply_samba_config()
     except Exception:
         pass
-    return jsonify({"ok": True, "message": "Montado correctamente."})
+    return jsonify({"ok": True, "message": "Montado correctamente.", "disk": disk_by_id(dev_id, snap)})
 
 
 @app.get("/api/disks")
 def api_disks_view():
-    return jsonify({"ok": True, "disks": disks_view()})
+    """Inventario versionado.
+
+    - If-None-Match con el ETag actual -> 304 sin cuerpo.
+    - ?since=<version>[&epoch=<epoch>] -> solo las entradas cambiadas/borradas.
+      Si la versión no es de este worker o es demasiado vieja, lista completa.
+    - En frío (recién arrancado) -> último estado guardado con `stale: true`,
+      sin versión ni ETag; la vista real se calcula en segundo plano.
+    """
+
+    cold = _cold_view()
+    if cold:
+        resp = jsonify({"ok": True, "stale": True, "saved_at": cold.get("saved_at"), "disks": cold["disks"], "full": True})
+        resp.headers["Cache-Control"] = "no-store"
+        return resp
+
+    version, disks = _disk_state.current()
+    etag = _disk_state.etag(version)
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+
+    payload: dict[str, Any] = {"ok": True, "version": version, "epoch": _disk_state.epoch}
+    since_raw = (request.args.get("since") or "").strip()
+    epoch = (request.args.get("epoch") or "").strip()
+    delta = None
+    if since_raw.isdigit() and (not epoch or epoch == _disk_state.epoch):
+        delta = _disk_state.delta(int(since_raw))
+    if delta is not None:
+        payload["version"], payload["changed"], payload["removed"] = delta
+        payload["full"] = False
+    else:
+        payload["disks"] = disks
+        payload["full"] = True
+
+    resp = jsonify(payload)
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+@app.get("/api/disks/<dev_id>")
+def api_disk_detail(dev_id: str):
+    dev_id = (dev_id or "").strip()
+    if not DEVICE_ID_RE.match(dev_id):
+        return jsonify({"ok": False, "message": "ID de dispositivo inválido."}), 400
+    d = disk_by_id(dev_id, system_snapshot())
+    if not d:
+        return jsonify({"ok": False, "message": "Disco no encontrado."}), 404
+    return jsonify({"ok": True, "disk": d})
+
+
+@app.get("/api/events")
+def api_events():
+    """Stream SSE con los cambios de discos (alta/baja, montaje, estado, uso).
+
+    Se despierta con los uevents y con los cambios de mountinfo; si no pasa nada,
+    recalcula cada SSE_HEARTBEAT_S para detectar cambios de uso o ediciones
+    externas de fstab/smb.conf. También emite "samba" cuando se aplica un lote
+    de cambios de Samba (los handlers ya no esperan a que termine).
+    """
+
+    def stream():
+        yield "retry: 3000\n\n"
+        prev = _index_disks(_disk_state.current()[1])
+        samba_seen = _samba_applier.last()[0]
+        gen = _changes.generation
+        started = time.monotonic()
+        while time.monotonic() - started < SSE_MAX_S:
+            new_gen = _changes.wait(gen, SSE_HEARTBEAT_S)
+            if new_gen != gen:
+                time.sleep(SSE_COALESCE_S)
+                new_gen = _changes.generation
+            gen = new_gen
+            cur = _index_disks(_disk_state.current()[1])
+            events = diff_disks(prev, cur)
+            prev = cur
+            for ev in events:
+                yield _sse("disk", ev)
+            applied, result = _samba_applier.last()
+            if applied > samba_seen:
+                samba_seen = applied
+                yield _sse("samba", {"ok": bool(result.get("ok")), "message": _samba_apply_summary(result)})
+            elif not events:
+                # Heartbeat: detecta clientes desconectados y mantiene vivos los proxies.
+                yield ": ping\n\n"
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.post("/api/reconnect")
+@idempotent
 def api_reconnect():
     """Monta automáticamente discos persistentes que fueron desconectados y han vuelto.
 
@@ -1397,17 +4913,17 @@ def api_reconnect():
     if not ok:
         return jsonify({"ok": False, "message": msg}), 403
 
-    # Esperar a udev por si se acaba de reconectar en caliente.
-    if shutil.which("udevadm"):
-        _run(["udevadm", "settle"], timeout_s=25)
-
-    entries = [e for e in parse_fstab() if _is_user_mountpoint(e.mountpoint)]
-    needs_samba_restart = False
+    snap = system_snapshot()
+    entries = [e for e in snap.fstab if _is_user_mountpoint(e.mountpoint)]
+    needs_samba_apply = False
 
     mounted: list[str] = []
     skipped: list[str] = []
     failed: list[dict[str, str]] = []
 
+    # Sin `udevadm settle` global: cada entrada espera a su propio nodo
+    # /dev/disk/by-*/ y se monta en paralelo con el resto.
+    pending: list[FstabEntry] = []
     for e in entries:
         mp = e.mountpoint
         if not mp:
@@ -1415,43 +4931,32 @@ def api_reconnect():
         if not _looks_safe_mountpoint(mp):
             skipped.append(f"{mp} (inseguro)")
             continue
-
-        # Solo intentamos si el disco/uuid está presente.
-        if not _device_present_for_fstab_entry(e):
-            continue
-
-        if _is_mountpoint_mounted(mp):
+        if _is_mountpoint_mounted(mp, snap):
             skipped.append(f"{mp} (ya montado)")
             continue
+        pending.append(e)
 
-        # Si el fstype es ntfs3, intentar cargar módulo (best-effort).
-        if (e.fstype or "").strip().lower() == "ntfs3":
-            _try_modprobe("ntfs3")
-
-        os.makedirs(mp, exist_ok=True)
-        last_err = ""
-        for _ in range(3):
-            cp = _run(["mount", mp], timeout_s=30)
-            if cp.returncode == 0:
-                last_err = ""
-                break
-            last_err = _truncate((cp.stderr or cp.stdout or "").strip())
-            if shutil.which("udevadm"):
-                _run(["udevadm", "settle"], timeout_s=10)
-            time.sleep(1)
-        if last_err:
-            failed.append({"mountpoint": mp, "error": last_err})
+    results = _mount_fstab_entries(pending)
+    for e in pending:
+        mp = e.mountpoint
+        state, err = results.get(mp, ("absent", ""))
+        if state == "failed":
+            failed.append({"mountpoint": mp, "error": err})
+            continue
+        if state != "mounted":
             continue
 
         mounted.append(mp)
 
         # Si existe un share para este path y estaba deshabilitado, lo re-habilitamos.
-        if _samba_share_exists_for_path(mp) and not _samba_enabled_share_for_path(mp):
+        if _samba_share_exists_for_path(mp, snap) and not _samba_enabled_share_for_path(mp, snap):
             _set_share_available_by_path(mp, True, restart=False)
-            needs_samba_restart = True
+            needs_samba_apply = True
 
-    if needs_samba_restart:
-        _apply_samba_restart()
+    if mounted:
+        snap.invalidate("devices", "mounts")
+    if needs_samba_apply:
+        _apply_samba_config()
 
     details_lines: list[str] = []
     if mounted:
@@ -1470,6 +4975,8 @@ def api_reconnect():
     )
 
 @app.post("/api/unmount")
+@idempotent
+@device_locked
 def api_unmount():
     ok, msg = _require_root()
     if not ok:
@@ -1480,25 +4987,27 @@ def api_unmount():
     if not DEVICE_ID_RE.match(dev_id):
         return jsonify({"ok": False, "message": "ID de dispositivo inválido."}), 400
 
-    disks = disks_view()
-    d = next((x for x in disks if x.get("id") == dev_id), None)
+    snap = system_snapshot()
+    d = disk_by_id(dev_id, snap)
     mountpoint = (d or {}).get("mountpoint") or ""
     if not mountpoint:
-        return jsonify({"ok": True, "message": "Ya estaba desmontado."})
+        return jsonify({"ok": True, "message": "Ya estaba desmontado.", "disk": d})
     if not _looks_safe_mountpoint(mountpoint):
         return jsonify({"ok": False, "message": "Punto de montaje inseguro; solo /mnt o /media."}), 400
 
     cp = _run(["umount", mountpoint], timeout_s=20)
+    snap.invalidate("devices", "mounts")
     if cp.returncode != 0:
         err = (cp.stderr or cp.stdout or "").strip()
         return jsonify({"ok": False, "message": f"Error desmontando: {err}"}), 500
 
     # Limpieza: si el directorio quedó vacío, lo borramos para no dejar huérfanos.
     _cleanup_mount_dir(mountpoint)
-    return jsonify({"ok": True, "message": "Desmontado correctamente."})
+    return jsonify({"ok": True, "message": "Desmontado correctamente.", "disk": disk_by_id(dev_id, snap)})
 
 
 @app.post("/api/format")
+@idempotent
 def api_format():
     ok, msg = _require_root()
     if not ok:
@@ -1528,7 +5037,8 @@ def api_format():
         )
 
     # Reutilizamos las protecciones: no permitir sistema/noise/etc.
-    part = manageable_partition_by_name(dev_id)
+    snap = system_snapshot()
+    part = manageable_partition_by_name(dev_id, snap)
     if not part:
         return (
             jsonify(
@@ -1541,8 +5051,7 @@ def api_format():
         )
 
     # Seguridad extra: solo permitir formatear si NO está montado, no persistente, no compartido.
-    disks = disks_view()
-    d = next((x for x in disks if x.get("id") == dev_id), None)
+    d = disk_by_id(dev_id, snap)
     if d and d.get("mounted"):
         return jsonify({"ok": False, "message": "Desmonta el disco antes de formatear."}), 400
     if d and d.get("persistent"):
@@ -1553,8 +5062,7 @@ def api_format():
     # Importante: al formatear queremos limpiar el DISCO ENTERO, no solo la partición.
     # - Si el usuario seleccionó una partición (sde1), usamos su pkname (sde)
     # - Si seleccionó el disco en crudo (sde), usamos el propio nombre.
-    part_type = (part.get("type") or "").strip().lower()
-    disk_name = (part.get("name") or "").strip() if part_type == "disk" else (part.get("pkname") or "").strip()
+    disk_name = part.name if part.type == "disk" else part.pkname
     if not disk_name:
         return (
             jsonify(
@@ -1566,22 +5074,8 @@ def api_format():
             500,
         )
 
-    msftdata = fstype in {"ntfs", "exfat", "vfat", "fat32"}
-    ok2, new_part_path, details = _wipe_and_single_partition(disk_name, msftdata=msftdata)
-    if not ok2:
-        return (
-            jsonify(
-                {
-                    "ok": False,
-                    "message": "No se pudo preparar el disco (borrar/particionar).",
-                    "details": _truncate(details),
-                }
-            ),
-            500,
-        )
-
-    cmd = _format_commands(fstype, new_part_path, label)
-    if not cmd:
+    # Validamos la herramienta ANTES de borrar nada (el path real aún no existe).
+    if not _format_commands(fstype, "/dev/null", label):
         return (
             jsonify(
                 {
@@ -1593,31 +5087,97 @@ def api_format():
             400,
         )
 
-    # El formateo puede tardar bastante (especialmente NTFS). Hacemos el timeout
-    # configurable para evitar un 500 silencioso en el frontend.
-    format_timeout_s = int(os.getenv("DISKMANAGER_FORMAT_TIMEOUT_S", "1800"))
-    cp = _run(cmd, timeout_s=format_timeout_s)
-    if cp.returncode != 0:
-        err = _truncate((cp.stderr or cp.stdout or ""))
-        if cp.returncode == 124:
+    # Comprobar + crear bajo lock: dos workers no pueden lanzar dos formateos del mismo disco.
+    with state_lock(LOCK_JOBS):
+        running = Job.active_for(disk_name)
+        if running:
             return (
                 jsonify(
                     {
                         "ok": False,
-                        "message": "El formateo tardó demasiado y se canceló.",
-                        "details": f"Aumenta DISKMANAGER_FORMAT_TIMEOUT_S (actual: {format_timeout_s}s) o revisa el estado del disco.\n{err}",
+                        "message": f"Ya hay un formateo en curso para /dev/{disk_name}.",
+                        "job": running.public(),
                     }
                 ),
-                504,
+                409,
             )
-        return jsonify({"ok": False, "message": "Error formateando.", "details": err}), 500
 
-    return jsonify(
-        {
-            "ok": True,
-            "message": f"Disco formateado como {fstype}.",
-            "details": _truncate(details),
-        }
+        # El formateo puede tardar muchos minutos (NTFS, discos grandes): lo ejecuta
+        # un hilo en segundo plano y el cliente sigue el progreso en /api/jobs/<id>.
+        job = start_format_job(disk_name, fstype, label)
+    return (
+        jsonify(
+            {
+                "ok": True,
+                "message": f"Formateo de /dev/{disk_name} en curso.",
+                "job": job.public(),
+            }
+        ),
+        202,
+    )
+
+
+@app.get("/api/jobs")
+def api_jobs():
+    return jsonify({"ok": True, "jobs": [j.public() for j in Job.all()]})
+
+
+@app.get("/api/jobs/<job_id>")
+def api_job(job_id: str):
+    job = Job.load(job_id)
+    if not job:
+        return jsonify({"ok": False, "message": "Trabajo no encontrado."}), 404
+    return jsonify({"ok": True, "job": job.public()})
+
+
+@app.post("/api/jobs/<job_id>/cancel")
+@idempotent
+def api_job_cancel(job_id: str):
+    ok, msg = _require_root()
+    if not ok:
+        return jsonify({"ok": False, "message": msg}), 403
+
+    job = Job.load(job_id)
+    if not job:
+        return jsonify({"ok": False, "message": "Trabajo no encontrado."}), 404
+    if not job.active:
+        return jsonify({"ok": False, "message": "El trabajo ya terminó.", "job": job.public()}), 409
+    job.request_cancel()
+    return jsonify({"ok": True, "message": "Cancelación solicitada.", "job": job.public()}), 202
+
+
+@app.get("/api/jobs/<job_id>/events")
+def api_job_events(job_id: str):
+    """Stream SSE del progreso de un trabajo; se cierra al terminar."""
+
+    if not Job.load(job_id):
+        return jsonify({"ok": False, "message": "Trabajo no encontrado."}), 404
+
+    def stream():
+        yield "retry: 2000\n\n"
+        last_mtime = -1.0
+        last_sent = time.monotonic()
+        started = last_sent
+        while time.monotonic() - started < SSE_MAX_S:
+            mtime = _job_mtime(job_id)
+            if mtime != last_mtime:
+                last_mtime = mtime
+                job = Job.load(job_id)
+                if not job:
+                    return
+                yield _sse("job", job.public())
+                last_sent = time.monotonic()
+                if not job.active:
+                    return
+            elif time.monotonic() - last_sent >= SSE_HEARTBEAT_S:
+                yield ": ping\n\n"
+                last_sent = time.monotonic()
+            time.sleep(JOB_EVENTS_POLL_S)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
@@ -1625,7 +5185,115 @@ def api_format():
 def api_format_options():
     return jsonify({"ok": True, "options": _available_format_options()})
 
+def _disk_gauges(disks: list[dict[str, Any]]) -> list[str]:
+    """Gauges de inventario a partir de la vista cacheada (no sondea nada)."""
+
+    series: dict[str, list[str]] = {
+        "hyperdrive_disk_mounted": [],
+        "hyperdrive_disk_persistent": [],
+        "hyperdrive_disk_samba": [],
+        "hyperdrive_disk_size_bytes": [],
+        "hyperdrive_disk_used_bytes": [],
+        "hyperdrive_disk_free_bytes": [],
+        "hyperdrive_fstab_entry_missing": [],
+    }
+    help_text = {
+        "hyperdrive_disk_mounted": "1 si el disco está montado.",
+        "hyperdrive_disk_persistent": "1 si el disco tiene entrada en fstab.",
+        "hyperdrive_disk_samba": "1 si el montaje está compartido por Samba.",
+        "hyperdrive_disk_size_bytes": "Tamaño del sistema de ficheros montado.",
+        "hyperdrive_disk_used_bytes": "Bytes usados del sistema de ficheros montado.",
+        "hyperdrive_disk_free_bytes": "Bytes libres del sistema de ficheros montado.",
+        "hyperdrive_fstab_entry_missing": "Entrada de fstab cuyo disco no está conectado.",
+    }
+    missing = 0
+    for d in disks:
+        if d.get("missing"):
+            missing += 1
+            labels = _prom_labels([("uuid", d.get("uuid") or ""), ("mountpoint", d.get("mountpoint") or "")])
+            series["hyperdrive_fstab_entry_missing"].append(f"hyperdrive_fstab_entry_missing{labels} 1")
+            continue
+        labels = _prom_labels(
+            [("device", d.get("id") or ""), ("uuid", d.get("uuid") or ""), ("mountpoint", d.get("mountpoint") or "")]
+        )
+        for name, flag in (
+            ("hyperdrive_disk_mounted", "mounted"),
+            ("hyperdrive_disk_persistent", "persistent"),
+            ("hyperdrive_disk_samba", "samba"),
+        ):
+            series[name].append(f"{name}{labels} {1 if d.get(flag) else 0}")
+        usage = d.get("usage") or {}
+        for name, field in (
+            ("hyperdrive_disk_size_bytes", "total_bytes"),
+            ("hyperdrive_disk_used_bytes", "used_bytes"),
+            ("hyperdrive_disk_free_bytes", "free_bytes"),
+        ):
+            if isinstance(usage.get(field), (int, float)):
+                series[name].append(f"{name}{labels} {_prom_number(usage[field])}")
+
+    out: list[str] = []
+    for name, lines in series.items():
+        out += [f"# HELP {name} {help_text[name]}", f"# TYPE {name} gauge", *lines]
+    out += [
+        "# HELP hyperdrive_fstab_missing_entries Entradas de fstab con el disco desconectado.",
+        "# TYPE hyperdrive_fstab_missing_entries gauge",
+        f"hyperdrive_fstab_missing_entries {missing}",
+    ]
+    return out
+
+
+@app.get("/metrics")
+def metrics():
+    """Métricas en formato texto de Prometheus (todos los workers sumados)."""
+
+    merged = _metrics.merged()
+    out: list[str] = []
+    for name, (kind, help_line) in METRICS_HELP.items():
+        out += [f"# HELP {name} {help_line}", f"# TYPE {name} {kind}"]
+        if kind == "counter":
+            for key, v in sorted(merged["counters"].get(name, {}).items()):
+                out.append(f"{name}{_prom_labels(key)} {_prom_number(v)}")
+            continue
+        for key, h in sorted(merged["histograms"].get(name, {}).items()):
+            for bound, count in zip((*LATENCY_BUCKETS, math.inf), (*h[: len(LATENCY_BUCKETS)], h[-1])):
+                out.append(f"{name}_bucket{_prom_labels(key + (('le', _prom_number(bound)),))} {_prom_number(count)}")
+            out.append(f"{name}_sum{_prom_labels(key)} {_prom_number(h[-2])}")
+            out.append(f"{name}_count{_prom_labels(key)} {_prom_number(h[-1])}")
+    out += _disk_gauges(_disk_state.peek())
+    return Response("\n".join(out) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/debug/slow")
+def debug_slow():
+    """Requests más lentas (con su árbol de spans) y perfiles cProfile capturados."""
+
+    data = _slow_requests.merged()
+    return jsonify({"ok": True, "profile_enabled": PROFILE_ENABLED, **data})
+
+
+@app.get("/api/snapshot")
+def api_snapshot():
+    """Instantánea del host (.tar.gz) para reproducir un problema en otra máquina con `app.py replay`."""
+
+    resp = Response(capture_snapshot(), content_type="application/gzip")
+    resp.headers["Content-Disposition"] = f'attachment; filename="{snapshot_filename()}"'
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+@app.get("/api/capabilities")
+def api_capabilities():
+    """Herramientas, filesystems del kernel y módulos detectados (?refresh=1 para re-sondear)."""
+
+    if (request.args.get("refresh") or "").strip() in {"1", "true", "yes"}:
+        _capabilities.refresh()
+    return jsonify({"ok": True, "capabilities": _capabilities.public()})
+
+
 @app.post("/api/persist")
+@idempotent
+@device_locked
+@locked(LOCK_FSTAB)
 def api_persist():
     ok, msg = _require_root()
     if not ok:
@@ -1636,56 +5304,33 @@ def api_persist():
     if not DEVICE_ID_RE.match(dev_id):
         return jsonify({"ok": False, "message": "ID de dispositivo inválido."}), 400
 
-    disks = disks_view()
-    d = next((x for x in disks if x.get("id") == dev_id), None)
+    snap = system_snapshot()
+    d = disk_by_id(dev_id, snap)
     if not d:
         return jsonify({"ok": False, "message": "Disco no encontrado."}), 404
     uuid = d.get("uuid")
     if not uuid or uuid == "-":
         return jsonify({"ok": False, "message": "No se puede hacer persistente: UUID no disponible."}), 400
 
-    fstab_path = "/etc/fstab"
     try:
-        with open(fstab_path, "r", encoding="utf-8", errors="replace") as f:
-            lines = f.readlines()
+        store = FstabStore.load()
     except Exception as e:
         return jsonify({"ok": False, "message": f"No se pudo leer /etc/fstab: {e}"}), 500
-
-    uuid_spec = f"UUID={uuid}"
-    existing_idx = None
-    for i, line in enumerate(lines):
-        stripped = line.strip()
-        if not stripped or stripped.startswith("#"):
-            continue
-        if stripped.split()[0] == uuid_spec:
-            existing_idx = i
-            break
+    existing = store.by_uuid.get(uuid)
 
     enable = data.get("enable", None)
     if enable is not None and not isinstance(enable, bool):
         return jsonify({"ok": False, "message": "Campo 'enable' inválido (usa true/false)."}), 400
 
-    modified = False
+    if enable is True and existing is not None:
+        return jsonify({"ok": True, "message": "Entrada fstab ya existía.", "disk": d})
+    if enable is False and existing is None:
+        return jsonify({"ok": True, "message": "Entrada fstab ya estaba eliminada.", "disk": d})
 
-    if enable is True:
-        if existing_idx is not None:
-            return jsonify({"ok": True, "message": "Entrada fstab ya existía."})
-        # crear
-        existing_idx = None
-
-    if enable is False:
-        if existing_idx is None:
-            return jsonify({"ok": True, "message": "Entrada fstab ya estaba eliminada."})
-        _remove_diskmanager_fstab_block(lines, existing_idx)
-        action = "eliminada"
-        modified = True
-
-    elif existing_idx is not None:
-        # Modo legacy: toggle -> quitar entrada
-        _remove_diskmanager_fstab_block(lines, existing_idx)
+    if existing is not None:
+        # enable=False, o modo legacy (toggle) -> quitar entrada
+        store.remove([existing])
         action = "eliminada"
-        modified = True
-
     else:
         mountpoint = d.get("mountpoint") or ""
         if not mountpoint:
@@ -1696,32 +5341,20 @@ def api_persist():
                 mountpoint = f"/mnt/{_safe_mount_dir(d.get('label') or dev_id)}"
         if not _looks_safe_mountpoint(mountpoint):
             return jsonify({"ok": False, "message": "Punto de montaje inseguro; solo /mnt o /media."}), 400
-        os.makedirs(mountpoint, exist_ok=True)
-        fstype = d.get("fstype") or "auto"
-        fstype_out, options_out, dump_out, passno_out = _fstab_fields_for_fstype(fstype)
-        # Marcar la entrada como "gestionada" para permitir reconexión segura vía mount -a -O.
-        if options_out and "x-diskmanager" not in options_out.split(","):
-            options_out = options_out + ",x-diskmanager"
-        new_line = f"{uuid_spec}\t{mountpoint}\t{fstype_out}\t{options_out}\t{dump_out}\t{passno_out}\n"
-        lines.append("\n# diskmanager\n" + new_line)
+        _backend.makedirs(mountpoint)
+        store.add(uuid, mountpoint, d.get("fstype") or "auto")
         action = "añadida"
-        modified = True
 
-    if not modified:
-        return jsonify({"ok": True, "message": "Sin cambios en fstab."})
-
-    # Backup antes de escribir
-    backup = f"/etc/fstab.bak.diskmanager.{int(time.time())}"
-    try:
-        shutil.copy2(fstab_path, backup)
-        with open(fstab_path, "w", encoding="utf-8") as f:
-            f.writelines(lines)
-    except Exception as e:
-        return jsonify({"ok": False, "message": f"No se pudo escribir /etc/fstab: {e}"}), 500
+    ok, backup, err = store.commit()
+    if not ok:
+        return jsonify({"ok": False, "message": f"No se pudo escribir /etc/fstab: {err}"}), 500
 
-    return jsonify({"ok": True, "message": f"Entrada fstab {action}. (Backup: {backup})"})
+    return jsonify({"ok": True, "message": f"Entrada fstab {action}. (Backup: {backup})", "disk": disk_by_id(dev_id, snap)})
 
 @app.post("/api/samba")
+@idempotent
+@device_locked
+@locked(LOCK_SMB_CONF)
 def api_samba_toggle():
     ok, msg = _require_root()
     if not ok:
@@ -1739,8 +5372,8 @@ def api_samba_toggle():
     # Para borrar shares, permitimos indicar el path explícitamente aunque el disco no esté montado.
     mountpoint_override = (data.get("path") or "").strip()
 
-    disks = disks_view()
-    d = next((x for x in disks if x.get("id") == dev_id), None)
+    snap = system_snapshot()
+    d = disk_by_id(dev_id, snap)
 
     mountpoint = mountpoint_override
     if not mountpoint:
@@ -1750,163 +5383,261 @@ def api_samba_toggle():
     if not _looks_safe_mountpoint(mountpoint):
         return jsonify({"ok": False, "message": "Punto de montaje inseguro; solo /mnt o /media."}), 400
 
-    smb_conf = "/etc/samba/smb.conf"
-    if not os.path.exists(smb_conf):
+    if not _backend.exists(SMB_CONF_PATH):
         return jsonify({"ok": False, "message": "No existe /etc/samba/smb.conf (¿Samba instalado?)."}), 404
 
-    try:
-        with open(smb_conf, "r", encoding="utf-8", errors="replace") as f:
-            lines = f.readlines()
-    except Exception as e:
-        return jsonify({"ok": False, "message": f"No se pudo leer smb.conf: {e}"}), 500
+    conf = load_smb_conf(for_edit=True)
+    if conf is None:
+        return jsonify({"ok": False, "message": "No se pudo leer smb.conf."}), 500
 
     # Detectar si ya hay un share con ese path; si existe, lo quitamos.
-    def find_share_block_by_path(target_path: str) -> tuple[int, int] | None:
-        start = None
-        name = None
-        for i, raw in enumerate(lines):
-            line = raw.strip()
-            if line.startswith("[") and line.endswith("]"):
-                # cerrar anterior
-                if start is not None and name and name.lower() != "global":
-                    # buscar path dentro del bloque anterior
-                    block = "".join(lines[start:i]).lower()
-                    if f"path = {target_path}".lower() in block:
-                        return (start, i)
-                start = i
-                name = line[1:-1].strip()
-        # último bloque
-        if start is not None and name and name.lower() != "global":
-            block = "".join(lines[start:]).lower()
-            if f"path = {target_path}".lower() in block:
-                return (start, len(lines))
-        return None
-
-    block = find_share_block_by_path(mountpoint)
+    sec = conf.share_by_path(mountpoint)
     action = ""
 
     def create_share_block() -> str:
-        server_user = _default_server_user()
-        share_name = _safe_share_name(os.path.basename(mountpoint) or ((d or {}).get("label") or dev_id))
-        return (
-            "\n"
-            f"[{share_name}]\n"
-            f"   path = {mountpoint}\n"
-            "   browseable = yes\n"
-            "   read only = no\n"
-            "   guest ok = yes\n"
-            "   public = yes\n"
-            f"   force user = {server_user}\n"
-            "   create mask = 0775\n"
-            "   directory mask = 0775\n"
-            f"   dfree command = /bin/df -P {mountpoint}\n"
-        )
+        return _samba_share_block(mountpoint, (d or {}).get("label") or dev_id)
 
     if enable is True:
-        if block:
+        if sec is not None:
             action = "ya existía"
         else:
-            lines.append(create_share_block())
+            conf.append(create_share_block())
             action = "creado"
     elif enable is False:
-        if block:
-            a, b = block
-            del lines[a:b]
+        if sec is not None:
+            conf.remove(sec)
             action = "eliminado"
         else:
             action = "ya estaba eliminado"
     else:
         # Modo legacy: toggle
-        if block:
-            a, b = block
-            del lines[a:b]
+        if sec is not None:
+            conf.remove(sec)
             action = "eliminado"
         else:
-            lines.append(create_share_block())
+            conf.append(create_share_block())
             action = "creado"
+    lines = conf.lines
 
-    # Escribimos a un temporal, validamos con testparm, y solo entonces reemplazamos smb.conf.
-    backup = f"/etc/samba/smb.conf.bak.diskmanager.{int(time.time())}"
-    tmp_path = ""
-    try:
-        with tempfile.NamedTemporaryFile(
-            mode="w",
-            encoding="utf-8",
-            delete=False,
-            dir=os.path.dirname(smb_conf),
-            prefix=".smb.conf.diskmanager.",
-        ) as tf:
-            tf.writelines(lines)
-            tmp_path = tf.name
-
-        # Validar antes de aplicar cambios.
-        if shutil.which("testparm"):
-            cp = _run(["testparm", "-s", tmp_path], timeout_s=25)
-            if cp.returncode != 0:
-                err = _truncate((cp.stderr or cp.stdout or ""))
-                try:
-                    os.unlink(tmp_path)
-                except Exception:
-                    pass
-                return (
-                    jsonify(
-                        {
-                            "ok": False,
-                            "message": "Configuración Samba inválida (testparm). No se aplicaron cambios.",
-                            "details": err,
-                        }
-                    ),
-                    400,
-                )
-
-        # Backup y reemplazo atómico.
-        shutil.copy2(smb_conf, backup)
-        try:
-            st = os.stat(smb_conf)
-            os.chmod(tmp_path, st.st_mode)
-        except Exception:
-            pass
-        os.replace(tmp_path, smb_conf)
-        tmp_path = ""
-
-    except Exception as e:
-        if tmp_path:
-            try:
-                os.unlink(tmp_path)
-            except Exception:
-                pass
-        # Si ya hicimos backup pero falló después, intentamos rollback.
-        if os.path.exists(backup):
-            try:
-                shutil.copy2(backup, smb_conf)
-            except Exception:
-                pass
+    # Validamos con testparm antes de reemplazar smb.conf.
+    status, backup, err = _replace_samba_conf_locked(lines)
+    if status == "invalid":
         return (
             jsonify(
                 {
                     "ok": False,
-                    "message": "No se aplicaron cambios en Samba.",
-                    "details": _truncate(str(e)),
+                    "message": "Configuración Samba inválida (testparm). No se aplicaron cambios.",
+                    "details": err,
                 }
             ),
-            500,
+            400,
         )
+    if status != "ok":
+        return jsonify({"ok": False, "message": "No se aplicaron cambios en Samba.", "details": err}), 500
+
+    # `smbcontrol all reload-config` publica shares nuevos sin cortar sesiones;
+    # si no está disponible se cae a reload/restart del servicio.
+    applied = _apply_samba_config()
+    return jsonify(
+        {
+            "ok": True,
+            "message": f"Share Samba {action}. (Backup: {backup})",
+            "details": _samba_apply_summary(applied),
+            "samba_apply": applied,
+            "disk": disk_by_id(dev_id, snap),
+        }
+    )
+
+
+PROVISION_MAX_DISKS = 64
+
+
+@app.post("/api/provision")
+@idempotent
+def api_provision():
+    """Pone en marcha varios discos en un solo request: montar, persistir y compartir.
+
+    Body: {"disks": [{"id": "sdb1", "mount_dir": "datos", "persist": true, "share": true}, ...]}
+
+    Primero se planifica y valida todo; después los montajes van en paralelo y
+    fstab y smb.conf se escriben una sola vez cada uno (una transacción por
+    fichero). Samba se recarga como mucho una vez.
+    """
+
+    ok, msg = _require_root()
+    if not ok:
+        return jsonify({"ok": False, "message": msg}), 403
+
+    data = request.json or {}
+    items = data.get("disks")
+    if not isinstance(items, list) or not items or not all(isinstance(x, dict) for x in items):
+        return jsonify({"ok": False, "message": "Campo 'disks' inválido (lista de objetos con 'id')."}), 400
+    if len(items) > PROVISION_MAX_DISKS:
+        return jsonify({"ok": False, "message": f"Máximo {PROVISION_MAX_DISKS} discos por petición."}), 400
+
+    snap = system_snapshot()
+    results: list[dict[str, Any]] = []
+    # (resultado, partición, mountpoint, montar_por_fstab, persistir, compartir)
+    plan: list[tuple[dict[str, Any], DeviceNode, str, bool, bool, bool]] = []
+    used_mountpoints: set[str] = set()
+
+    # 1) Plan + validación: no se toca nada hasta aquí.
+    for item in items:
+        dev_id = str(item.get("id") or "").strip()
+        res: dict[str, Any] = {"id": dev_id, "ok": False, "mountpoint": "", "actions": [], "error": ""}
+        results.append(res)
+
+        persist = item.get("persist", False)
+        share = item.get("share", False)
+        if not DEVICE_ID_RE.match(dev_id):
+            res["error"] = "ID de dispositivo inválido."
+            continue
+        if not isinstance(persist, bool) or not isinstance(share, bool):
+            res["error"] = "Campos 'persist'/'share' inválidos (usa true/false)."
+            continue
+        part = manageable_partition_by_name(dev_id, snap)
+        d = disk_by_id(dev_id, snap)
+        if not part or not d:
+            res["error"] = "Este dispositivo parece ser del sistema o no es gestionable desde esta UI."
+            continue
+
+        uuid = d.get("uuid") if d.get("uuid") != "-" else None
+        entry = snap.fstab_by_uuid.get(uuid) if uuid else None
+        via_fstab = False
+        if d.get("mounted"):
+            mountpoint = d.get("mountpoint") or ""
+        elif entry is not None:
+            mountpoint = entry.mountpoint
+            via_fstab = True
+        else:
+            requested = str(item.get("mount_dir") or "").strip()
+            mountpoint = f"/mnt/{_safe_mount_dir(requested or d.get('label') or dev_id)}"
+        mountpoint = _norm_path(mountpoint)
+
+        if not _looks_safe_mountpoint(mountpoint):
+            res["error"] = "Punto de montaje inseguro; solo /mnt o /media."
+            continue
+        if mountpoint in used_mountpoints:
+            res["error"] = f"Punto de montaje duplicado en la petición: {mountpoint}"
+            continue
+        if persist and not uuid:
+            res["error"] = "No se puede hacer persistente: UUID no disponible."
+            continue
+        if share and not _backend.exists(SMB_CONF_PATH):
+            res["error"] = "No existe /etc/samba/smb.conf (¿Samba instalado?)."
+            continue
+
+        used_mountpoints.add(mountpoint)
+        res["mountpoint"] = mountpoint
+        plan.append((res, part, mountpoint, via_fstab, persist, share))
+
+    # 2) Montajes en paralelo (solo los que no estaban montados).
+    def mount_one(part: DeviceNode, mountpoint: str, via_fstab: bool) -> subprocess.CompletedProcess:
+        try:
+            with state_lock(device_lock_name(part.name), timeout_s=DEVICE_LOCK_TIMEOUT_S):
+                if via_fstab:
+                    _backend.makedirs(mountpoint)
+                    return _run(["mount", mountpoint], timeout_s=45)
+                return _mount_device_at(part.path, part.fstype, mountpoint)
+        except LockBusy:
+            return subprocess.CompletedProcess(args=[], returncode=1, stdout="", stderr="Disco ocupado por otra operación.")
+
+    to_mount = [p for p in plan if not _is_mountpoint_mounted(p[2], snap)]
+    if to_mount:
+        workers = max(1, min(RECONNECT_WORKERS, len(to_mount)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="provision") as pool:
+            futures = [(p, pool.submit(mount_one, p[1], p[2], p[3])) for p in to_mount]
+            for (res, *_rest), fut in futures:
+                cp = fut.result()
+                if cp.returncode == 0:
+                    res["actions"].append("montado")
+                else:
+                    res["error"] = "Error montando: " + _truncate((cp.stderr or cp.stdout or "").strip(), limit=400)
+        snap.invalidate("devices", "mounts")
+    plan = [p for p in plan if not p[0]["error"]]
 
-    # En algunos hosts `reload` devuelve OK pero el share nuevo no queda accesible.
-    # Usamos restart para aplicar cambios de forma fiable.
-    _apply_samba_restart()
-    return jsonify({"ok": True, "message": f"Share Samba {action}. (Backup: {backup})"})
+    # 3) fstab: una única escritura con todas las entradas nuevas.
+    fstab_targets = [p for p in plan if p[4] and p[1].uuid and p[1].uuid not in snap.fstab_by_uuid]
+    if fstab_targets:
+        try:
+            with state_lock(LOCK_FSTAB):
+                store = FstabStore.load()
+                for res, part, mountpoint, *_rest in fstab_targets:
+                    if part.uuid not in store.by_uuid:
+                        store.add(part.uuid, mountpoint, part.fstype or "auto")
+                ok_w, _backup, err = store.commit()
+        except Exception as e:
+            ok_w, err = False, str(e)
+        for res, *_rest in fstab_targets:
+            if ok_w:
+                res["actions"].append("fstab")
+            else:
+                res["error"] = f"No se pudo escribir /etc/fstab: {err}"
+
+    # 4) smb.conf: crear shares pedidos y re-habilitar los que estaban en 'available = no'.
+    apply_samba = False
+    if _backend.exists(SMB_CONF_PATH) and plan:
+        with state_lock(LOCK_SMB_CONF):
+            conf = load_smb_conf(for_edit=True)
+            if conf is None:
+                for res, _part, _mp, _via, _persist, share in plan:
+                    if share:
+                        res["error"] = "No se pudo leer smb.conf."
+            touched: list[dict[str, Any]] = []
+            for res, part, mountpoint, _via, _persist, share in plan:
+                if conf is None or res["error"]:
+                    continue
+                sec = conf.share_by_path(mountpoint)
+                if sec is not None:
+                    if conf.set_available(sec, True):
+                        touched.append(res)
+                    elif share or "montado" in res["actions"]:
+                        # Share ya activo: basta con recargar para que sirva el disco recién montado.
+                        apply_samba = True
+                elif share:
+                    conf.append(_samba_share_block(mountpoint, part.label or part.name))
+                    touched.append(res)
+            if touched and conf is not None:
+                ok_w, _backup, err = _write_samba_conf_lines(conf.lines)
+                for res in touched:
+                    if ok_w:
+                        res["actions"].append("samba")
+                    else:
+                        res["error"] = f"No se aplicaron cambios en Samba. {err}"
+                apply_samba = apply_samba or ok_w
+    applied = _apply_samba_config() if apply_samba else None
+
+    for res in results:
+        res["ok"] = not res["error"]
+        res["disk"] = disk_by_id(res["id"], snap) if DEVICE_ID_RE.match(res["id"]) else None
+
+    done = sum(1 for r in results if r["ok"])
+    details = [f"{r['id'] or '?'}: {r['error']}" for r in results if r["error"]]
+    if applied:
+        details.append(_samba_apply_summary(applied))
+    return jsonify(
+        {
+            "ok": done == len(results),
+            "message": f"Provisionados {done} de {len(results)} disco(s).",
+            "details": "\n".join(details),
+            "results": results,
+            "samba_apply": applied,
+        }
+    )
 
 
 @app.post("/api/samba/restart")
+@idempotent
 def api_samba_restart():
     ok, msg = _require_root()
     if not ok:
         return jsonify({"ok": False, "message": msg}), 403
 
-    if not shutil.which("systemctl"):
+    if not _capabilities.has("systemctl"):
         return jsonify({"ok": False, "message": "systemctl no disponible en este sistema."}), 500
 
+    # Reinicio explícito pedido por el usuario: corta todas las sesiones.
+    sessions = _samba_session_count()
     cp = _run(["systemctl", "restart", "smbd"], timeout_s=25)
     if cp.returncode != 0:
         err = _truncate((cp.stderr or cp.stdout or ""))
@@ -1915,10 +5646,12 @@ def api_samba_restart():
             500,
         )
 
-    return jsonify({"ok": True, "message": "smbd reiniciado."})
+    details = f"{sessions} sesión(es) cortada(s)." if sessions else ""
+    return jsonify({"ok": True, "message": "smbd reiniciado.", "details": details})
 
 
 @app.post("/api/samba/path")
+@idempotent
 def api_samba_path_toggle():
     ok, msg = _require_root()
     if not ok:
@@ -1944,6 +5677,8 @@ def api_samba_path_toggle():
 
 
 @app.post("/api/missing/remove")
+@idempotent
+@locked(LOCK_FSTAB)
 def api_missing_remove():
     """Elimina configuración de un disco "no disponible": fstab + share Samba (si existe).
 
@@ -1964,50 +5699,29 @@ def api_missing_remove():
     if mountpoint and not _looks_safe_mountpoint(mountpoint):
         return jsonify({"ok": False, "message": "Punto de montaje inseguro; solo /mnt o /media."}), 400
 
-    fstab_path = "/etc/fstab"
     try:
-        with open(fstab_path, "r", encoding="utf-8", errors="replace") as f:
-            lines = f.readlines()
+        store = FstabStore.load()
     except Exception as e:
         return jsonify({"ok": False, "message": f"No se pudo leer /etc/fstab: {e}"}), 500
 
     uuid_spec = f"UUID={uuid}"
-    to_remove: list[int] = []
-    for i, raw in enumerate(lines):
-        stripped = raw.strip()
-        if not stripped or stripped.startswith("#"):
-            continue
-        parts = stripped.split()
-        if len(parts) < 2:
-            continue
-        if parts[0] != uuid_spec:
-            continue
-        if mountpoint and parts[1] != mountpoint:
-            continue
-        to_remove.append(i)
+    to_remove = [
+        e for e in store.entries if e.spec == uuid_spec and (not mountpoint or e.mountpoint == mountpoint)
+    ]
 
     if not to_remove and mountpoint:
         # Si el usuario no pasó UUID bien, pero sí mountpoint, no hacemos nada.
         return jsonify({"ok": True, "message": "No se encontró entrada en fstab para eliminar."})
 
-    changed_fstab = False
-    # Borrar de atrás hacia delante para no desplazar índices.
-    for idx in sorted(to_remove, reverse=True):
-        _remove_diskmanager_fstab_block(lines, idx)
-        changed_fstab = True
-
+    changed_fstab = store.remove(to_remove) > 0
     backup_fstab = ""
     if changed_fstab:
-        backup_fstab = f"/etc/fstab.bak.diskmanager.{int(time.time())}"
-        try:
-            shutil.copy2(fstab_path, backup_fstab)
-            with open(fstab_path, "w", encoding="utf-8") as f:
-                f.writelines(lines)
-        except Exception as e:
-            return jsonify({"ok": False, "message": f"No se pudo escribir /etc/fstab: {e}"}), 500
+        ok_w, backup_fstab, err = store.commit()
+        if not ok_w:
+            return jsonify({"ok": False, "message": f"No se pudo escribir /etc/fstab: {err}"}), 500
 
     samba_details = ""
-    if mountpoint and os.path.exists("/etc/samba/smb.conf"):
+    if mountpoint and _backend.exists(SMB_CONF_PATH):
         _changed, samba_details = _remove_share_block_by_path(mountpoint)
 
     details_parts: list[str] = []
@@ -2022,6 +5736,8 @@ def api_missing_remove():
 
 
 @app.post("/api/samba/share")
+@idempotent
+@locked(LOCK_SMB_CONF)
 def api_samba_share_toggle():
     ok, msg = _require_root()
     if not ok:
@@ -2035,130 +5751,89 @@ def api_samba_share_toggle():
     if enable is None or not isinstance(enable, bool):
         return jsonify({"ok": False, "message": "Campo 'enable' inválido (usa true/false)."}), 400
 
-    smb_conf = "/etc/samba/smb.conf"
-    if not os.path.exists(smb_conf):
+    if not _backend.exists(SMB_CONF_PATH):
         return jsonify({"ok": False, "message": "No existe /etc/samba/smb.conf (¿Samba instalado?)."}), 404
 
-    try:
-        with open(smb_conf, "r", encoding="utf-8", errors="replace") as f:
-            lines = f.readlines()
-    except Exception as e:
-        return jsonify({"ok": False, "message": f"No se pudo leer smb.conf: {e}"}), 500
-
-    # Encontrar el bloque por nombre (case-insensitive), ignorando [global].
-    def find_share_block_by_name(target_name: str) -> tuple[int, int] | None:
-        start = None
-        sec_name = None
-        for i, raw in enumerate(lines):
-            line = raw.strip()
-            if line.startswith("[") and line.endswith("]"):
-                # cerrar sección anterior
-                if start is not None and sec_name and sec_name.lower() != "global":
-                    if sec_name.lower() == target_name.lower():
-                        return (start, i)
-                start = i
-                sec_name = line[1:-1].strip()
-        if start is not None and sec_name and sec_name.lower() != "global":
-            if sec_name.lower() == target_name.lower():
-                return (start, len(lines))
-        return None
+    conf = load_smb_conf(for_edit=True)
+    if conf is None:
+        return jsonify({"ok": False, "message": "No se pudo leer smb.conf."}), 500
 
-    block = find_share_block_by_name(name)
-    if not block:
+    # Búsqueda por nombre (case-insensitive), ignorando [global].
+    sec = conf.share_by_name(name)
+    if sec is None:
         return jsonify({"ok": False, "message": "Share no encontrado en smb.conf."}), 404
 
-    a, b = block
-    desired = "yes" if enable else "no"
-
-    # Buscar y actualizar (o insertar) la línea 'available'.
-    changed = False
-    inserted = False
-    for i in range(a + 1, b):
-        raw = lines[i]
-        stripped = raw.strip()
-        if not stripped or stripped.startswith("#") or stripped.startswith(";"):
-            continue
-        if "=" not in stripped:
-            continue
-        k, _v = [p.strip() for p in stripped.split("=", 1)]
-        if k.lower() == "available":
-            indent = re.match(r"^\s*", raw).group(0)
-            lines[i] = f"{indent}available = {desired}\n"
-            changed = True
-            break
-
-    if not changed:
-        # Insertar justo después del header del share para mantenerlo simple.
-        lines.insert(a + 1, f"   available = {desired}\n")
-        inserted = True
-        changed = True
-
-    if not changed:
+    if not conf.set_available(sec, enable):
         return jsonify({"ok": True, "message": "Sin cambios."})
+    lines = conf.lines
 
-    # Escribimos a un temporal, validamos con testparm, y solo entonces reemplazamos smb.conf.
-    backup = f"/etc/samba/smb.conf.bak.diskmanager.{int(time.time())}"
-    tmp_path = ""
-    try:
-        with tempfile.NamedTemporaryFile(
-            mode="w",
-            encoding="utf-8",
-            delete=False,
-            dir=os.path.dirname(smb_conf),
-            prefix=".smb.conf.diskmanager.",
-        ) as tf:
-            tf.writelines(lines)
-            tmp_path = tf.name
-
-        if shutil.which("testparm"):
-            cp = _run(["testparm", "-s", tmp_path], timeout_s=25)
-            if cp.returncode != 0:
-                err = _truncate((cp.stderr or cp.stdout or ""))
-                try:
-                    os.unlink(tmp_path)
-                except Exception:
-                    pass
-                return (
-                    jsonify(
-                        {
-                            "ok": False,
-                            "message": "Configuración Samba inválida (testparm). No se aplicaron cambios.",
-                            "details": err,
-                        }
-                    ),
-                    400,
-                )
-
-        shutil.copy2(smb_conf, backup)
-        try:
-            st = os.stat(smb_conf)
-            os.chmod(tmp_path, st.st_mode)
-        except Exception:
-            pass
-        os.replace(tmp_path, smb_conf)
-        tmp_path = ""
-
-    except Exception as e:
-        if tmp_path:
-            try:
-                os.unlink(tmp_path)
-            except Exception:
-                pass
-        if os.path.exists(backup):
-            try:
-                shutil.copy2(backup, smb_conf)
-            except Exception:
-                pass
+    # Validamos con testparm antes de reemplazar smb.conf.
+    status, backup, err = _replace_samba_conf_locked(lines)
+    if status == "invalid":
         return (
-            jsonify({"ok": False, "message": "No se aplicaron cambios en Samba.", "details": _truncate(str(e))}),
-            500,
+            jsonify(
+                {
+                    "ok": False,
+                    "message": "Configuración Samba inválida (testparm). No se aplicaron cambios.",
+                    "details": err,
+                }
+            ),
+            400,
         )
+    if status != "ok":
+        return jsonify({"ok": False, "message": "No se aplicaron cambios en Samba.", "details": err}), 500
 
-    # Aplicar cambios: para que se refleje siempre, preferimos restart.
-    _apply_samba_restart()
+    applied = _apply_samba_config()
     action = "habilitado" if enable else "deshabilitado"
-    return jsonify({"ok": True, "message": f"Share {name} {action}. (Backup: {backup})"})
+    return jsonify(
+        {
+            "ok": True,
+            "message": f"Share {name} {action}. (Backup: {backup})",
+            "details": _samba_apply_summary(applied),
+            "samba_apply": applied,
+        }
+    )
 
 
-if __name__ == "__main__":
+def _cli(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(prog="app.py", description="HyperDrive (sin subcomando: servidor de desarrollo).")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("inventoryd", help="líder del inventario compartido en primer plano (sidecar)")
+    p = sub.add_parser("snapshot", help="captura el estado del host en un .tar.gz")
+    p.add_argument("-o", "--output", help="fichero de salida ('-' = stdout); por defecto hyperdrive-snapshot-<host>-<fecha>.tar.gz")
+    p = sub.add_parser("replay", help="sirve la UI (solo lectura) desde una instantánea")
+    p.add_argument("archive")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8090)
+    p.add_argument("--no-latency", action="store_true", help="no reproducir los tiempos capturados")
+    args = parser.parse_args(argv)
+
+    if args.command == "inventoryd":
+        return _shared_inventory.serve()
+    if args.command == "snapshot":
+        data = capture_snapshot()
+        if args.output == "-":
+            sys.stdout.buffer.write(data)
+            return 0
+        out = args.output or snapshot_filename()
+        with open(out, "wb") as f:
+            f.write(data)
+        print(out)
+        return 0
+    if args.command == "replay":
+        try:
+            backend = SnapshotBackend(args.archive, latency=not args.no_latency)
+        except (OSError, ValueError, tarfile.TarError) as e:
+            print(f"No se puede abrir la instantánea: {e}", file=sys.stderr)
+            return 1
+        set_backend(backend)
+        m = backend.manifest
+        print(f"Replay de {m.get('hostname')} ({time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(m.get('created_at') or 0))})")
+        app.run(host=args.host, port=args.port, threaded=True)
+        return 0
     app.run(host="0.0.0.0", port=8090, debug=True)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(_cli(sys.argv[1:]))
@@ -0,0 +1,54 @@
+"""Coste por llamada: `lsblk_partitions()` (subproceso) vs `sysfs_partitions()` (nativo).
+
+Uso (desde la raíz del repo):
+
+    python bench/bench_enumerator.py [-n 200]
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def _measure(fn, n: int) -> dict[str, float]:
+    samples: list[float] = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {
+        "mean_ms": statistics.fmean(samples),
+        "p50_ms": samples[len(samples) // 2],
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+    }
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("-n", type=int, default=200, help="iteraciones por enumerador")
+    args = ap.parse_args()
+
+    devices = len(app.sysfs_partitions())
+    print(f"Dispositivos (disk/part/crypt/lvm): {devices}")
+    results = {
+        "lsblk": _measure(app.lsblk_partitions, args.n),
+        "sysfs": _measure(app.sysfs_partitions, args.n),
+    }
+    for name, r in results.items():
+        print(f"{name:6s} mean={r['mean_ms']:8.3f} ms  p50={r['p50_ms']:8.3f} ms  p95={r['p95_ms']:8.3f} ms")
+    if results["sysfs"]["mean_ms"] > 0:
+        print(f"Mejora: x{results['lsblk']['mean_ms'] / results['sysfs']['mean_ms']:.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
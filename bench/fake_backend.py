@@ -0,0 +1,369 @@
+"""Backend simulado: la capa web de HyperDrive sin root, sin discos y sin Samba.
+
+Simula los discos (lo que devolvería `lsblk -J`), los montajes (mountinfo y
+`mount`/`umount`), /etc/fstab y smb.conf en memoria, latencias configurables por
+operación y uevents de hotplug. Es determinista: misma semilla, misma secuencia.
+
+Uso:
+
+    import app
+    from fake_backend import FakeBackend
+
+    fake = FakeBackend(devices=100, latency={"lsblk": 0.05, "disk_usage": 0.002})
+    app.set_backend(fake)
+"""
+
+from __future__ import annotations
+
+import collections
+import copy
+import itertools
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import zlib
+from typing import Any, Callable, Iterable, Iterator
+
+import app
+import fixtures
+
+# Tamaño de cada disco simulado (coincide con el "4T" de fixtures.lsblk_json).
+DISK_BYTES = 4 * 1024**4
+
+
+class FakeBackend(app.SystemBackend):
+    """`SystemBackend` en memoria.
+
+    `latency` asigna segundos de espera por operación: el nombre del comando
+    (`lsblk`, `mount`, `testparm`...) o `read`, `write`, `disk_usage`; la clave
+    `run` es el valor por defecto para comandos no listados.
+    """
+
+    # Sin kernel detrás: nada de netlink ni poll de mountinfo; los "uevents" los
+    # genera el propio backend (plug/unplug) llamando a app._inventory.invalidate().
+    kernel = False
+
+    def __init__(
+        self,
+        devices: int = 20,
+        *,
+        fstab_entries: int | None = None,
+        shares: int | None = None,
+        latency: dict[str, float] | None = None,
+        seed: int = 0,
+    ) -> None:
+        self._lock = threading.RLock()
+        self.latency = dict(latency or {})
+        self._rng = random.Random(seed)
+        self.calls: collections.Counter[str] = collections.Counter()
+
+        tree = json.loads(fixtures.lsblk_json(devices))["blockdevices"]
+        self._disks: dict[str, dict[str, Any]] = {d["name"]: d for d in tree}
+        self._unplugged: set[str] = set()
+        self._devno = {name: f"8:{i}" for i, name in enumerate(self._iter_names(tree))}
+        self._parent = {p["name"]: p["pkname"] for p in self._iter_parts(tree)}
+        # mountpoint -> nombre de la partición
+        self._mounts: dict[str, str] = {}
+        for part in self._iter_parts(tree):
+            if part.get("mountpoint"):
+                self._mounts[part["mountpoint"]] = part["name"]
+            part["mountpoint"] = None
+
+        self._files: dict[str, str] = {
+            app.FSTAB_PATH: fixtures.fstab_text(devices if fstab_entries is None else fstab_entries, devices),
+            app.SMB_CONF_PATH: fixtures.smb_conf_text(devices // 2 if shares is None else shares),
+            "/proc/filesystems": "nodev\tsysfs\nnodev\tproc\n\text4\n\txfs\n\tvfat\n\texfat\n\tntfs3\n",
+        }
+        self._inodes: dict[str, int] = {}
+        self._versions: dict[str, int] = {}
+        self._next_ino = itertools.count(1000)
+        self._dirs: set[str] = set(self._mounts)
+
+    # -- Modelo --
+
+    @staticmethod
+    def _iter_names(tree: Iterable[dict[str, Any]]) -> Iterator[str]:
+        for d in tree:
+            yield d["name"]
+            for ch in d.get("children") or []:
+                yield ch["name"]
+
+    @staticmethod
+    def _iter_parts(tree: Iterable[dict[str, Any]]) -> Iterator[dict[str, Any]]:
+        for d in tree:
+            yield from d.get("children") or []
+
+    def _present_parts(self) -> dict[str, dict[str, Any]]:
+        return {
+            p["name"]: p
+            for name, d in self._disks.items()
+            if name not in self._unplugged
+            for p in d.get("children") or []
+        }
+
+    def _sleep(self, op: str, default: str | None = None) -> None:
+        self.calls[op] += 1
+        delay = self.latency.get(op, self.latency.get(default, 0.0) if default else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _lsblk(self) -> str:
+        with self._lock:
+            by_part = {v: k for k, v in self._mounts.items()}
+            out = []
+            for name, d in self._disks.items():
+                if name in self._unplugged:
+                    continue
+                disk = copy.deepcopy(d)
+                for ch in disk.get("children") or []:
+                    ch["mountpoint"] = by_part.get(ch["name"])
+                out.append(disk)
+        return json.dumps({"blockdevices": out})
+
+    def _fstab_device(self, mountpoint: str) -> str | None:
+        store = app.FstabStore(self._files.get(app.FSTAB_PATH, "").splitlines(keepends=True))
+        entry = store.by_mountpoint.get(app._norm_path(mountpoint))
+        if entry is None:
+            return None
+        for name, p in self._present_parts().items():
+            if entry.uuid and p.get("uuid") == entry.uuid:
+                return name
+            if entry.spec == f"/dev/{name}":
+                return name
+        return None
+
+    def _mount(self, args: list[str]) -> subprocess.CompletedProcess:
+        positional: list[str] = []
+        it = iter(args[1:])
+        for a in it:
+            if a in {"-t", "-o", "-O"}:
+                next(it, None)
+            elif not a.startswith("-"):
+                positional.append(a)
+        with self._lock:
+            if len(positional) == 1:
+                mp = positional[0]
+                name = self._fstab_device(mp)
+                if name is None:
+                    return _cp(args, 32, f"mount: {mp}: can't find in /etc/fstab or device missing.")
+            elif len(positional) == 2:
+                name = os.path.basename(positional[0])
+                mp = positional[1]
+                if name not in self._present_parts():
+                    return _cp(args, 32, f"mount: {mp}: special device {positional[0]} does not exist.")
+            else:
+                return _cp(args, 1, "mount: argumentos no soportados por el backend simulado.")
+            if mp in self._mounts:
+                return _cp(args, 32, f"mount: {mp}: already mounted.")
+            self._mounts[mp] = name
+            self._dirs.add(mp)
+        return _cp(args, 0)
+
+    def _umount(self, args: list[str]) -> subprocess.CompletedProcess:
+        targets = [a for a in args[1:] if not a.startswith("-")]
+        with self._lock:
+            for t in targets:
+                if t.startswith("/dev/"):
+                    name = os.path.basename(t)
+                    gone = [mp for mp, n in self._mounts.items() if name in (n, self._parent.get(n))]
+                    if not gone and "-A" not in args:
+                        return _cp(args, 32, f"umount: {t}: not mounted.")
+                    for mp in gone:
+                        del self._mounts[mp]
+                elif t in self._mounts:
+                    del self._mounts[t]
+                else:
+                    return _cp(args, 32, f"umount: {t}: not mounted.")
+        return _cp(args, 0)
+
+    def _mkfs(self, fstype: str, args: list[str]) -> subprocess.CompletedProcess:
+        name = os.path.basename(args[-1])
+        with self._lock:
+            part = self._present_parts().get(name)
+            if part is None:
+                return _cp(args, 1, f"mkfs.{fstype}: {args[-1]}: No such file or directory")
+            if name in self._mounts.values():
+                return _cp(args, 1, f"mkfs.{fstype}: {args[-1]} is mounted; will not make a filesystem here!")
+            part["fstype"] = fstype
+            part["uuid"] = f"{self._rng.getrandbits(32):08x}-0000-4000-8000-{self._rng.getrandbits(48):012x}"
+        return _cp(args, 0)
+
+    # -- Hotplug --
+
+    def unplug(self, disk: str) -> None:
+        """Desconecta un disco (sus montajes desaparecen) y emite el "uevent"."""
+
+        with self._lock:
+            self._unplugged.add(disk)
+            for mp in [mp for mp, n in self._mounts.items() if self._parent.get(n) == disk]:
+                del self._mounts[mp]
+        app._inventory.invalidate()
+
+    def plug(self, disk: str) -> None:
+        with self._lock:
+            self._unplugged.discard(disk)
+        app._inventory.invalidate()
+
+    def start_hotplug(self, interval_s: float) -> threading.Event:
+        """Cada `interval_s` conecta o desconecta un disco de datos al azar. Devuelve el Event para pararlo."""
+
+        stop = threading.Event()
+        candidates = [name for name in self._disks if name != "sda"]
+
+        def loop() -> None:
+            while candidates and not stop.wait(interval_s):
+                with self._lock:
+                    name = self._rng.choice(candidates)
+                    present = name not in self._unplugged
+                if present:
+                    self.unplug(name)
+                else:
+                    self.plug(name)
+
+        threading.Thread(target=loop, name="fake-hotplug", daemon=True).start()
+        return stop
+
+    # -- SystemBackend --
+
+    def run(self, args: list[str], *, timeout_s: int = 10, input: str | None = None) -> subprocess.CompletedProcess:
+        cmd = os.path.basename(args[0]) if args else ""
+        self._sleep(cmd, "run")
+        if cmd == "lsblk":
+            return _cp(args, 0, stdout=self._lsblk())
+        if cmd == "mount":
+            return self._mount(args)
+        if cmd == "umount":
+            return self._umount(args)
+        if cmd.startswith("mkfs."):
+            return self._mkfs(cmd[len("mkfs."):], args)
+        # udevadm, partprobe, sfdisk, smbcontrol, systemctl, testparm...: todo bien.
+        return _cp(args, 0)
+
+    def run_streaming(
+        self,
+        args: list[str],
+        *,
+        timeout_s: int,
+        on_output: Callable[[str], None],
+        should_cancel: Callable[[], bool],
+    ) -> tuple[int, str]:
+        if should_cancel():
+            return 130, ""
+        cp = self.run(args, timeout_s=timeout_s)
+        tail = [ln for ln in (cp.stdout + cp.stderr).splitlines() if ln.strip()]
+        for line in tail:
+            on_output(line)
+        return cp.returncode, "\n".join(tail[-40:])
+
+    def which(self, tool: str) -> str | None:
+        return f"/usr/sbin/{tool}" if tool in app.KNOWN_TOOLS or tool == "lsblk" else None
+
+    def read_text(self, path: str) -> str:
+        self._sleep("read")
+        with self._lock:
+            if path == app.MOUNTINFO_PATH:
+                return self._mountinfo()
+            try:
+                return self._files[path]
+            except KeyError:
+                raise FileNotFoundError(2, "No such file or directory", path) from None
+
+    def _mountinfo(self) -> str:
+        parts = {p["name"]: p for p in self._iter_parts(self._disks.values())}
+        lines = []
+        for i, (mp, name) in enumerate(sorted(self._mounts.items())):
+            parent = 1 if mp == "/" else 22
+            fstype = (parts.get(name) or {}).get("fstype") or "ext4"
+            lines.append(
+                f"{22 + i} {parent} {self._devno.get(name, '0:0')} / {mp} rw,relatime shared:{1 + i} - {fstype} /dev/{name} rw"
+            )
+        return "\n".join(lines) + "\n"
+
+    def write_text(self, path: str, text: str) -> None:
+        self._sleep("write")
+        with self._lock:
+            self._files[path] = text
+            self._versions[path] = self._versions.get(path, 0) + 1
+
+    def write_temp(self, directory: str, prefix: str, text: str) -> str:
+        path = os.path.join(directory, f"{prefix}{next(self._next_ino)}")
+        self.write_text(path, text)
+        return path
+
+    def remove(self, path: str) -> None:
+        with self._lock:
+            if self._files.pop(path, None) is None:
+                raise FileNotFoundError(2, "No such file or directory", path)
+            self._versions.pop(path, None)
+            self._inodes.pop(path, None)
+
+    def signature(self, path: str) -> tuple[int, int, int] | None:
+        with self._lock:
+            text = self._files.get(path)
+            if text is None:
+                return None
+            ino = self._inodes.get(path)
+            if ino is None:
+                ino = self._inodes[path] = next(self._next_ino)
+            return (ino, self._versions.get(path, 0), len(text))
+
+    def exists(self, path: str) -> bool:
+        with self._lock:
+            if path in self._files or path in self._dirs:
+                return True
+            if path.startswith("/dev/disk/by-uuid/"):
+                uuid = path.rsplit("/", 1)[1]
+                return any(p.get("uuid") == uuid for p in self._present_parts().values())
+            if path.startswith("/dev/"):
+                name = path[len("/dev/"):]
+                return name in self._present_parts() or (name in self._disks and name not in self._unplugged)
+        return False
+
+    def is_block_device(self, path: str) -> bool:
+        if not path.startswith("/dev/") or not self.exists(path):
+            raise FileNotFoundError(2, "No such file or directory", path)
+        return True
+
+    def isdir(self, path: str) -> bool:
+        with self._lock:
+            return path in self._dirs
+
+    def listdir(self, path: str) -> list[str]:
+        with self._lock:
+            if path == "/dev/disk/by-uuid":
+                return [p["uuid"] for p in self._present_parts().values() if p.get("uuid")]
+            if path in self._mounts:
+                return ["lost+found"]
+            if path in self._dirs:
+                return []
+        raise FileNotFoundError(2, "No such file or directory", path)
+
+    def makedirs(self, path: str) -> None:
+        with self._lock:
+            self._dirs.add(path)
+
+    def rmdir(self, path: str) -> None:
+        with self._lock:
+            self._dirs.discard(path)
+
+    def disk_usage(self, path: str) -> tuple[int, int, int]:
+        self._sleep("disk_usage")
+        with self._lock:
+            name = self._mounts.get(path)
+        if name is None:
+            raise FileNotFoundError(2, "No such file or directory", path)
+        used = DISK_BYTES * (5 + zlib.crc32(name.encode()) % 90) // 100
+        return DISK_BYTES, used, DISK_BYTES - used
+
+    def geteuid(self) -> int:
+        return 0
+
+    def kernel_module_available(self, module: str) -> bool | None:
+        return True
+
+
+def _cp(args: list[str], rc: int, stderr: str = "", *, stdout: str = "") -> subprocess.CompletedProcess:
+    return subprocess.CompletedProcess(args=args, returncode=rc, stdout=stdout, stderr=stderr)
@@ -0,0 +1,159 @@
+"""Datos sintéticos para los benchmarks: salida de `lsblk -J`, fstab y smb.conf.
+
+Todo es determinista (mismo tamaño -> mismo contenido) para que los resultados
+sean comparables entre versiones.
+"""
+
+from __future__ import annotations
+
+import json
+
+
+def device_uuid(i: int) -> str:
+    return f"{i:08x}-0000-4000-8000-{i:012x}"
+
+
+def disk_name(i: int) -> str:
+    return f"vd{i}"
+
+
+def lsblk_json(devices: int) -> str:
+    """Disco del sistema (sda, con '/') + `devices` discos de datos con una partición.
+
+    Las particiones pares están montadas en /mnt/diskN.
+    """
+
+    blockdevices = [
+        {
+            "name": "sda",
+            "path": "/dev/sda",
+            "pkname": None,
+            "size": "240G",
+            "fstype": None,
+            "label": None,
+            "uuid": None,
+            "mountpoint": None,
+            "type": "disk",
+            "rm": False,
+            "hotplug": False,
+            "tran": "sata",
+            "children": [
+                {
+                    "name": "sda1",
+                    "path": "/dev/sda1",
+                    "pkname": "sda",
+                    "size": "512M",
+                    "fstype": "vfat",
+                    "label": None,
+                    "uuid": "ABCD-0001",
+                    "mountpoint": "/boot/efi",
+                    "type": "part",
+                    "rm": False,
+                    "hotplug": False,
+                    "tran": None,
+                },
+                {
+                    "name": "sda2",
+                    "path": "/dev/sda2",
+                    "pkname": "sda",
+                    "size": "239.5G",
+                    "fstype": "ext4",
+                    "label": None,
+                    "uuid": "root-0000-0000",
+                    "mountpoint": "/",
+                    "type": "part",
+                    "rm": False,
+                    "hotplug": False,
+                    "tran": None,
+                },
+            ],
+        }
+    ]
+    for i in range(devices):
+        name = disk_name(i)
+        blockdevices.append(
+            {
+                "name": name,
+                "path": f"/dev/{name}",
+                "pkname": None,
+                "size": "4T",
+                "fstype": None,
+                "label": None,
+                "uuid": None,
+                "mountpoint": None,
+                "type": "disk",
+                "rm": False,
+                "hotplug": True,
+                "tran": "usb",
+                "children": [
+                    {
+                        "name": f"{name}p1",
+                        "path": f"/dev/{name}p1",
+                        "pkname": name,
+                        "size": "4T",
+                        "fstype": "ext4",
+                        "label": f"datos{i}",
+                        "uuid": device_uuid(i),
+                        "mountpoint": f"/mnt/disk{i}" if i % 2 == 0 else None,
+                        "type": "part",
+                        "rm": False,
+                        "hotplug": True,
+                        "tran": None,
+                    }
+                ],
+            }
+        )
+    return json.dumps({"blockdevices": blockdevices})
+
+
+def fstab_text(entries: int, devices: int) -> str:
+    """fstab con las líneas del sistema + `entries` entradas gestionadas.
+
+    Las primeras `devices` apuntan a discos presentes; el resto, a discos que no
+    están conectados (aparecen como “Disco no disponible”).
+    """
+
+    lines = [
+        "# /etc/fstab: static file system information.",
+        "UUID=root-0000-0000\t/\text4\terrors=remount-ro\t0\t1",
+        "UUID=ABCD-0001\t/boot/efi\tvfat\tumask=0077\t0\t1",
+        "/swapfile\tnone\tswap\tsw\t0\t0",
+    ]
+    for i in range(entries):
+        lines += [
+            "",
+            "# diskmanager",
+            f"UUID={device_uuid(i)}\t/mnt/disk{i}\text4\tdefaults,nofail,x-diskmanager\t0\t2",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def smb_conf_text(shares: int) -> str:
+    """smb.conf con [global], los shares de sistema y `shares` shares de discos."""
+
+    lines = [
+        "[global]",
+        "   workgroup = WORKGROUP",
+        "   server string = %h server (Samba)",
+        "   map to guest = bad user",
+        "",
+        "[printers]",
+        "   comment = All Printers",
+        "   path = /var/spool/samba",
+        "   printable = yes",
+        "",
+        "[print$]",
+        "   path = /var/lib/samba/printers",
+        "   read only = yes",
+    ]
+    for i in range(shares):
+        lines += [
+            "",
+            f"[disk{i}]",
+            f"   path = /mnt/disk{i}",
+            "   browseable = yes",
+            "   read only = no",
+            "   guest ok = no",
+            f"   available = {'yes' if i % 3 else 'no'}",
+        ]
+    return "\n".join(lines) + "\n"
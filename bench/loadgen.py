@@ -0,0 +1,281 @@
+"""Generador de carga contra la app Flask con el backend simulado (o contra --url).
+
+Lanza peticiones a ritmo fijo (bucle abierto: la latencia se mide desde el
+instante programado, así que las colas cuentan) con una mezcla de rutas
+parecida a la de la UI: polling de /api/disks con ETag, detalle de disco,
+páginas, /metrics y algún mount/unmount con Idempotency-Key.
+
+Uso (desde la raíz del repo):
+
+    python bench/loadgen.py [--rate 300] [--duration 30] [--concurrency 32]
+                            [--devices 200] [--hotplug 2] [--latency lsblk=0.05,disk_usage=0.002]
+                            [--snapshot hyperdrive-snapshot-host-fecha.tar.gz [--no-latency]]
+                            [--seed 0] [--url http://host:8080] [--out bench/results/carga.json]
+"""
+
+from __future__ import annotations
+
+import argparse
+import collections
+import http.client
+import json
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+from typing import Any
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Igual que bench/run.py: estado temporal y un único proceso sin líder compartido.
+_TMP = tempfile.mkdtemp(prefix="hyperdrive-load-")
+os.environ.setdefault("DISKMANAGER_STATE_DIR", os.path.join(_TMP, "run"))
+os.environ.setdefault("DISKMANAGER_DATA_DIR", os.path.join(_TMP, "lib"))
+os.environ.setdefault("DISKMANAGER_SHARED_INVENTORY", "0")
+os.environ.setdefault("DISKMANAGER_ENUMERATOR", "lsblk")
+
+# (peso, nombre) de cada tipo de petición.
+ROUTE_MIX = [
+    (60, "GET /api/disks"),
+    (12, "GET /api/disks/<id>"),
+    (6, "GET /dashboard"),
+    (6, "GET /disks"),
+    (4, "GET /fstab"),
+    (4, "GET /samba"),
+    (4, "GET /metrics"),
+    (2, "POST /api/mount"),
+    (2, "POST /api/unmount"),
+]
+
+
+def _parse_latency(raw: str) -> dict[str, float]:
+    out: dict[str, float] = {}
+    for item in (raw or "").split(","):
+        if not item.strip():
+            continue
+        key, _, value = item.partition("=")
+        out[key.strip()] = float(value)
+    return out
+
+
+def _start_local_server(args: argparse.Namespace) -> tuple[str, Any, list[str]]:
+    """Arranca la app en un hilo con el backend pedido. Devuelve URL, servidor e IDs de partición."""
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    import app
+    from fake_backend import FakeBackend
+
+    if args.snapshot:
+        app.set_backend(app.SnapshotBackend(args.snapshot, latency=not args.no_latency))
+    else:
+        fake = FakeBackend(args.devices, latency=_parse_latency(args.latency), seed=args.seed)
+        app.set_backend(fake)
+        if args.hotplug > 0:
+            fake.start_hotplug(args.hotplug)
+    dev_ids = [p["name"] for p in app.lsblk_partitions() if p.get("type") == "part"]
+
+    class _Handler(WSGIRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_request(self, *a: Any, **kw: Any) -> None:
+            pass
+
+    server = make_server("127.0.0.1", 0, app.app, threaded=True, request_handler=_Handler)
+    threading.Thread(target=server.serve_forever, name="loadgen-server", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server, dev_ids
+
+
+class _Client:
+    """Una conexión keep-alive por hilo; el ETag de /api/disks se comparte (como varias pestañas)."""
+
+    def __init__(self, base_url: str, dev_ids: list[str], rng: random.Random) -> None:
+        u = urllib.parse.urlsplit(base_url)
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or 80
+        self.dev_ids = dev_ids or ["sda1"]
+        self.rng = rng
+        self.etag: str | None = None
+        self._local = threading.local()
+
+    def _conn(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        return conn
+
+    def build(self, kind: str) -> tuple[str, str, dict[str, str], bytes | None]:
+        method, path = kind.split(" ", 1)
+        headers: dict[str, str] = {}
+        body = None
+        dev = self.rng.choice(self.dev_ids)
+        if path == "/api/disks/<id>":
+            path = f"/api/disks/{dev}"
+        if method == "POST":
+            headers["Content-Type"] = "application/json"
+            headers["Idempotency-Key"] = str(uuid.UUID(int=self.rng.getrandbits(128)))
+            body = json.dumps({"id": dev}).encode()
+        return method, path, headers, body
+
+    def request(self, method: str, path: str, headers: dict[str, str], body: bytes | None) -> int:
+        if path == "/api/disks" and self.etag:
+            headers = {**headers, "If-None-Match": self.etag}
+        for attempt in (0, 1):
+            conn = self._conn()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+                continue
+            if path == "/api/disks" and resp.status in (200, 304):
+                self.etag = resp.getheader("ETag") or self.etag
+            return resp.status
+        return 0
+
+
+def _percentile(sorted_ms: list[float], q: float) -> float:
+    if not sorted_ms:
+        return 0.0
+    return sorted_ms[min(len(sorted_ms) - 1, int(len(sorted_ms) * q))]
+
+
+def run_load(base_url: str, dev_ids: list[str], args: argparse.Namespace) -> dict[str, Any]:
+    rng = random.Random(args.seed)
+    # Una instantánea es de solo lectura: sus mount/unmount siempre darían 500.
+    mix = [(w, k) for w, k in ROUTE_MIX if not (args.snapshot and k.startswith("POST "))]
+    kinds = [k for _, k in mix]
+    weights = [w for w, _ in mix]
+    client = _Client(base_url, dev_ids, random.Random(args.seed + 1))
+
+    total = int(args.rate * args.duration)
+    # Plan completo de antemano (determinista con la semilla): (instante, petición).
+    plan = [(i / args.rate, k, client.build(k)) for i, k in enumerate(rng.choices(kinds, weights, k=total))]
+
+    work: queue.Queue[Any] = queue.Queue()
+    lock = threading.Lock()
+    latencies: dict[str, list[float]] = collections.defaultdict(list)
+    statuses: dict[str, collections.Counter[int]] = collections.defaultdict(collections.Counter)
+    errors: collections.Counter[str] = collections.Counter()
+
+    def worker() -> None:
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            due, name, (method, path, headers, body) = item
+            try:
+                status = client.request(method, path, headers, body)
+            except Exception:
+                status = 0
+            elapsed = (time.perf_counter() - due) * 1000
+            with lock:
+                latencies[name].append(elapsed)
+                statuses[name][status] += 1
+                if status == 0 or status >= 500:
+                    errors[name] += 1
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+
+    start = time.perf_counter()
+    for offset, name, req in plan:
+        due = start + offset
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        work.put((due, name, req))
+    for _ in threads:
+        work.put(None)
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    routes: dict[str, dict[str, Any]] = {}
+    all_ms: list[float] = []
+    for name, samples in sorted(latencies.items()):
+        samples.sort()
+        all_ms.extend(samples)
+        routes[name] = {
+            "count": len(samples),
+            "errors": errors[name],
+            "status": {str(k): v for k, v in sorted(statuses[name].items())},
+            "p50_ms": _percentile(samples, 0.50),
+            "p95_ms": _percentile(samples, 0.95),
+            "p99_ms": _percentile(samples, 0.99),
+            "max_ms": samples[-1],
+        }
+    all_ms.sort()
+    return {
+        "target_rate": args.rate,
+        "achieved_rate": len(all_ms) / wall if wall else 0.0,
+        "duration_s": wall,
+        "requests": len(all_ms),
+        "errors": sum(errors.values()),
+        "p50_ms": _percentile(all_ms, 0.50),
+        "p95_ms": _percentile(all_ms, 0.95),
+        "p99_ms": _percentile(all_ms, 0.99),
+        "max_ms": all_ms[-1] if all_ms else 0.0,
+        "routes": routes,
+    }
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--rate", type=float, default=300, help="peticiones por segundo")
+    ap.add_argument("--duration", type=float, default=30, help="segundos de carga")
+    ap.add_argument("--concurrency", type=int, default=32, help="hilos cliente")
+    ap.add_argument("--devices", type=int, default=200, help="discos simulados")
+    ap.add_argument("--hotplug", type=float, default=0, help="segundos entre conexiones/desconexiones simuladas (0 = nunca)")
+    ap.add_argument("--latency", default="", help="latencias del backend simulado, p. ej. lsblk=0.05,disk_usage=0.002")
+    ap.add_argument("--snapshot", help="servir una instantánea (`app.py snapshot`) en vez del backend simulado")
+    ap.add_argument("--no-latency", action="store_true", help="no reproducir los tiempos de la instantánea")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--url", help="atacar un servidor ya arrancado en vez del simulado en proceso")
+    ap.add_argument("--out", help="guardar el resultado en este JSON")
+    args = ap.parse_args()
+
+    if args.url:
+        # Contra un servidor externo, IDs del escenario sintético por defecto.
+        base_url, server = args.url.rstrip("/"), None
+        dev_ids = [f"vd{i}p1" for i in range(args.devices)]
+    else:
+        base_url, server, dev_ids = _start_local_server(args)
+
+    result = run_load(base_url, dev_ids, args)
+    if server is not None:
+        server.shutdown()
+
+    print(
+        f"{result['requests']} peticiones en {result['duration_s']:.1f} s "
+        f"({result['achieved_rate']:.0f}/s de {args.rate:.0f}/s), {result['errors']} errores"
+    )
+    print(f"{'total':24s} p50={result['p50_ms']:7.1f} ms  p95={result['p95_ms']:7.1f} ms  p99={result['p99_ms']:7.1f} ms")
+    for name, r in result["routes"].items():
+        print(
+            f"{name:24s} n={r['count']:<6d} err={r['errors']:<4d} "
+            f"p50={r['p50_ms']:7.1f} ms  p95={r['p95_ms']:7.1f} ms  p99={r['p99_ms']:7.1f} ms  max={r['max_ms']:7.1f} ms"
+        )
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "result": result}, f, indent=2, sort_keys=True)
+        print(f"\nResultados: {args.out}")
+    return 1 if result["errors"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
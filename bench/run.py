@@ -0,0 +1,213 @@
+"""Benchmarks de los caminos calientes con un sistema sintético (sin tocar el host).
+
+Alimenta `disks_view`, `parse_fstab`, `samba_shares`, la búsqueda de shares por
+path, `_root_physical_disk` y las rutas Flask con el backend simulado de
+bench/fake_backend.py (lsblk, fstab y smb.conf de bench/fixtures.py), o con
+instantáneas de hosts reales (`app.py snapshot`), y guarda los resultados en JSON.
+
+Uso (desde la raíz del repo):
+
+    python bench/run.py [--sizes 10,100,500] [--fstab 2000] [--shares 300] [-n 30]
+                        [--snapshot hyperdrive-snapshot-host-fecha.tar.gz [--no-latency]]
+                        [--out bench/results/x.json] [--compare bench/results/anterior.json]
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Callable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Antes de importar app: estado en un directorio temporal y todo en local
+# (sin líder compartido ni lectura de /sys), para medir siempre lo mismo.
+_TMP = tempfile.mkdtemp(prefix="hyperdrive-bench-")
+os.environ["DISKMANAGER_STATE_DIR"] = os.path.join(_TMP, "run")
+os.environ["DISKMANAGER_DATA_DIR"] = os.path.join(_TMP, "lib")
+os.environ["DISKMANAGER_SHARED_INVENTORY"] = "0"
+os.environ["DISKMANAGER_ENUMERATOR"] = "lsblk"
+
+import app  # noqa: E402
+from fake_backend import FakeBackend  # noqa: E402
+
+# Un resultado es regresión si su media empeora más que esto respecto a --compare.
+REGRESSION_RATIO = 1.2
+
+
+def _measure(fn: Callable[[], Any], n: int, *, setup: Callable[[], None] | None = None) -> dict[str, float]:
+    samples: list[float] = []
+    for _ in range(n):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {
+        "mean_ms": statistics.fmean(samples),
+        "p50_ms": samples[len(samples) // 2],
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "n": n,
+    }
+
+
+@contextmanager
+def installed(backend: app.SystemBackend):
+    """Instala `backend` mientras dura el bloque."""
+
+    previous = app.set_backend(backend)
+    try:
+        yield
+    finally:
+        app.set_backend(previous)
+
+
+def reset_caches() -> None:
+    """Vuelve a frío: inventario, smb.conf parseado y vista versionada."""
+
+    app._inventory.invalidate()
+    app._smb_conf_cache = None
+    app._disk_state = app._DiskStateTracker()
+
+
+def bench_backend(label: str, backend: app.SystemBackend, share_paths: list[str], n: int) -> dict[str, dict[str, float]]:
+    results: dict[str, dict[str, float]] = {}
+
+    def add(name: str, r: dict[str, float]) -> None:
+        results[f"{name}[{label}]"] = r
+
+    with installed(backend):
+        parts = app.lsblk_partitions()
+        add("lsblk_partitions", _measure(app.lsblk_partitions, n))
+        add("_root_physical_disk", _measure(lambda: app._root_physical_disk(parts), n))
+        add("parse_fstab", _measure(app.parse_fstab, n))
+        add("samba_shares.cold", _measure(app.samba_shares, n, setup=reset_caches))
+        add("samba_shares.warm", _measure(app.samba_shares, n))
+
+        # Antes `_find_share_block_by_path` recorría el fichero; ahora es el índice de SmbConf.
+        conf = app.load_smb_conf()
+        add("smb_share_by_path", _measure(lambda: [conf.share_by_path(p) for p in share_paths], n))
+
+        add("disks_view.cold", _measure(lambda: app.disks_view(app.SystemSnapshot()), n, setup=reset_caches))
+        add("disks_view.warm", _measure(lambda: app.disks_view(app.SystemSnapshot()), n))
+
+        client = app.app.test_client()
+        for route in ("/dashboard", "/disks", "/fstab", "/samba", "/api/disks"):
+            add(f"GET {route}", _measure(lambda: client.get(route), n))
+    return results
+
+
+def bench_size(devices: int, fstab_entries: int, shares: int, n: int) -> dict[str, dict[str, float]]:
+    """Escenario sintético de `devices` discos (FakeBackend)."""
+
+    paths = [f"/mnt/disk{i}" for i in range(0, max(shares, 1), max(1, shares // 50))]
+    backend = FakeBackend(devices, fstab_entries=fstab_entries, shares=shares)
+    return bench_backend(str(devices), backend, paths, n)
+
+
+def bench_snapshot(path: str, n: int, *, latency: bool) -> dict[str, dict[str, float]]:
+    """Escenario real reproducido desde una instantánea (`app.py snapshot`)."""
+
+    backend = app.SnapshotBackend(path, latency=latency)
+    label = os.path.basename(path).removesuffix(".tar.gz")
+    paths = sorted(backend.manifest.get("usage") or {})
+    return bench_backend(label, backend, paths, n)
+
+
+def _git_revision() -> str:
+    try:
+        cp = subprocess.run(
+            ["git", "describe", "--always", "--dirty", "--tags"],
+            cwd=ROOT,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            check=False,
+        )
+        return cp.stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def _compare(results: dict[str, dict[str, float]], old_path: str) -> int:
+    with open(old_path, "r", encoding="utf-8") as f:
+        old = json.load(f).get("results") or {}
+    regressions = 0
+    print(f"\nComparación con {old_path}:")
+    for name, r in results.items():
+        prev = old.get(name)
+        if not prev or not prev.get("mean_ms"):
+            continue
+        ratio = r["mean_ms"] / prev["mean_ms"]
+        flag = ""
+        if ratio > REGRESSION_RATIO:
+            flag = "  <-- REGRESIÓN"
+            regressions += 1
+        print(f"{name:32s} x{ratio:5.2f}{flag}")
+    return regressions
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--sizes", default="10,100,500", help="nº de dispositivos de cada escenario")
+    ap.add_argument("--fstab", type=int, default=2000, help="entradas gestionadas en fstab")
+    ap.add_argument("--shares", type=int, default=300, help="shares en smb.conf")
+    ap.add_argument("-n", type=int, default=30, help="iteraciones por medida")
+    ap.add_argument("--snapshot", action="append", default=[], help="medir también sobre esta instantánea (repetible)")
+    ap.add_argument("--no-latency", action="store_true", help="no reproducir los tiempos de la instantánea")
+    ap.add_argument("--out", help="fichero JSON de resultados (por defecto bench/results/<revisión>.json)")
+    ap.add_argument("--compare", help="resultados anteriores con los que comparar")
+    args = ap.parse_args()
+
+    revision = _git_revision()
+    results: dict[str, dict[str, float]] = {}
+    for size in [int(x) for x in args.sizes.split(",") if x.strip()]:
+        results.update(bench_size(size, max(args.fstab, size), args.shares, args.n))
+    for path in args.snapshot:
+        results.update(bench_snapshot(path, args.n, latency=not args.no_latency))
+
+    for name, r in results.items():
+        print(f"{name:32s} mean={r['mean_ms']:8.3f} ms  p50={r['p50_ms']:8.3f} ms  p95={r['p95_ms']:8.3f} ms")
+
+    out = args.out or os.path.join(ROOT, "bench", "results", f"{revision}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "meta": {
+                    "revision": revision,
+                    "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "fstab_entries": args.fstab,
+                    "shares": args.shares,
+                    "iterations": args.n,
+                    "snapshots": args.snapshot,
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+            sort_keys=True,
+        )
+    print(f"\nResultados: {out}")
+
+    if args.compare:
+        return 1 if _compare(results, args.compare) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -52,44 +52,84 @@ function ensureMountDir(id){
   return v;
 }
 
-async function postJSON(url, data){
-  try {
-    const r = await fetch(url, {
+function newIdempotencyKey(){
+  if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+// Peticiones idénticas en vuelo (doble clic, dos listeners...) comparten una
+// sola llamada; además cada POST lleva Idempotency-Key, así que el servidor
+// tampoco repite `mount`/`parted` si el duplicado llega por otra vía.
+const _inflightRequests = new Map();
+
+function _singleFlight(key, fn){
+  const existing = _inflightRequests.get(key);
+  if (existing) return existing;
+  const p = fn().finally(() => _inflightRequests.delete(key));
+  _inflightRequests.set(key, p);
+  return p;
+}
+
+async function _readJSONResponse(r){
+  const ct = (r.headers.get("content-type") || "").toLowerCase();
+  if (ct.includes("application/json")) {
+    const j = await r.json();
+    if (!r.ok && j && typeof j.ok === "undefined") {
+      j.ok = false;
+    }
+    return j;
+  }
+
+  const text = await r.text();
+  return {
+    ok: false,
+    message: `HTTP ${r.status}`,
+    details: (text || "").slice(0, 1200)
+  };
+}
+
+// Último POST de esta pestaña (para los avisos de Samba que llegan por SSE).
+let lastPostAt = 0;
+
+function postJSON(url, data){
+  const body = JSON.stringify(data);
+  lastPostAt = Date.now();
+  return _singleFlight(`POST ${url} ${body}`, async () => {
+    const key = newIdempotencyKey();
+    const send = () => fetch(url, {
       method: "POST",
-      headers: {"Content-Type":"application/json"},
-      body: JSON.stringify(data)
+      headers: {"Content-Type":"application/json", "Idempotency-Key": key},
+      body
     });
-
-    const ct = (r.headers.get("content-type") || "").toLowerCase();
-    if (ct.includes("application/json")) {
-      const j = await r.json();
-      if (!r.ok && j && typeof j.ok === "undefined") {
-        j.ok = false;
+    try {
+      let r;
+      try {
+        r = await send();
+      } catch (e) {
+        // Un reintento con la misma clave es seguro: si la primera llegó, el
+        // servidor devuelve su resultado en vez de repetir la operación.
+        await new Promise((resolve) => setTimeout(resolve, 500));
+        r = await send();
       }
-      return j;
+      return await _readJSONResponse(r);
+    } catch (e) {
+      return { ok: false, message: "Error de red", details: String(e || "") };
     }
-
-    const text = await r.text();
-    return {
-      ok: false,
-      message: `HTTP ${r.status}`,
-      details: (text || "").slice(0, 1200)
-    };
-  } catch (e) {
-    return { ok: false, message: "Error de red", details: String(e || "") };
-  }
+  });
 }
 
-async function getJSON(url){
-  try {
-    const r = await fetch(url, { method: "GET" });
-    const ct = (r.headers.get("content-type") || "").toLowerCase();
-    if (ct.includes("application/json")) return await r.json();
-    const text = await r.text();
-    return { ok: false, message: `HTTP ${r.status}`, details: (text || "").slice(0, 1200) };
-  } catch (e) {
-    return { ok: false, message: "Error de red", details: String(e || "") };
-  }
+function getJSON(url){
+  return _singleFlight(`GET ${url}`, async () => {
+    try {
+      const r = await fetch(url, { method: "GET" });
+      const ct = (r.headers.get("content-type") || "").toLowerCase();
+      if (ct.includes("application/json")) return await r.json();
+      const text = await r.text();
+      return { ok: false, message: `HTTP ${r.status}`, details: (text || "").slice(0, 1200) };
+    } catch (e) {
+      return { ok: false, message: "Error de red", details: String(e || "") };
+    }
+  });
 }
 
 function findDiskRow(id){
@@ -246,13 +286,20 @@ function updateDiskCard(d){
 }
 
 async function refreshDiskRow(id){
-  const res = await getJSON("/api/disks");
-  if (!res || !res.ok) return;
-  const d = (res.disks || []).find(x => String(x.id) === String(id));
-  if (d) {
-    updateDiskRow(d);
-    updateDiskCard(d);
+  const res = await getJSON(`/api/disks/${encodeURIComponent(String(id))}`);
+  if (!res || !res.ok || !res.disk) return;
+  updateDiskRow(res.disk);
+  updateDiskCard(res.disk);
+}
+
+// Las acciones devuelven el registro fresco del disco: lo pintamos sin otra petición.
+function applyDiskFromResponse(res, id){
+  if (res && res.disk) {
+    updateDiskRow(res.disk);
+    updateDiskCard(res.disk);
+    return;
   }
+  refreshDiskRow(id);
 }
 
 let _formatOptionsCache = null;
@@ -293,6 +340,8 @@ async function openFormatModal(id){
     submitBtn.disabled = false;
     submitBtn.textContent = "Formatear";
   }
+  const progressEl = document.getElementById("formatProgress");
+  if (progressEl) progressEl.classList.add("d-none");
 
   fstypeEl.innerHTML = `<option value="">Cargando…</option>`;
   const opts = await _loadFormatOptions();
@@ -337,19 +386,32 @@ async function submitFormatModal(){
     submitBtn.disabled = true;
     submitBtn.textContent = "Formateando…";
   }
-  toast("Formateando… esto puede tardar varios minutos.");
 
   try {
     const res = await postJSON("/api/format", { id, fstype, label, confirm_text: expected });
-    toast(msgFromResponse(res));
+    // 409 con job: ya había un formateo de este disco en curso; lo seguimos.
+    const job = res && res.job;
+    if (!job) {
+      toast(msgFromResponse(res));
+      return;
+    }
+    if (!res.ok) toast(msgFromResponse(res));
 
-    if (res && res.ok && modalEl) {
+    _formatJobId = job.id;
+    renderFormatJob(job);
+    const final = await followJob(job.id, renderFormatJob);
+    _formatJobId = null;
+    toast(msgFromResponse(final));
+
+    if (final && final.status === "succeeded" && modalEl) {
       const modal = bootstrap.Modal.getOrCreateInstance(modalEl);
       modal.hide();
       // Después de formatear cambian fstype/uuid/label: recargamos la página.
       setTimeout(() => window.location.reload(), 700);
     }
   } finally {
+    const cancelBtn = document.getElementById("formatCancelBtn");
+    if (cancelBtn) cancelBtn.classList.add("d-none");
     if (submitBtn) {
       submitBtn.disabled = false;
       submitBtn.textContent = prevText || "Formatear";
@@ -357,6 +419,87 @@ async function submitFormatModal(){
   }
 }
 
+let _formatJobId = null;
+
+function renderFormatJob(job){
+  const box = document.getElementById("formatProgress");
+  const bar = document.getElementById("formatProgressBar");
+  const stepEl = document.getElementById("formatProgressStep");
+  const pctEl = document.getElementById("formatProgressPct");
+  const cancelBtn = document.getElementById("formatCancelBtn");
+  if (!box || !bar) return;
+
+  const pct = Math.max(0, Math.min(100, Number(job.progress) || 0));
+  box.classList.remove("d-none");
+  bar.style.width = `${pct}%`;
+  bar.classList.toggle("progress-bar-animated", !!job.active);
+  bar.classList.toggle("bg-success", job.status === "succeeded");
+  bar.classList.toggle("bg-danger", job.status !== "succeeded");
+  if (stepEl) stepEl.textContent = job.active ? (job.step || "") : (job.message || job.status || "");
+  if (pctEl) pctEl.textContent = `${pct}%`;
+  if (cancelBtn) cancelBtn.classList.toggle("d-none", !job.active);
+}
+
+// Sigue un trabajo hasta que termina (SSE, o sondeo si no hay EventSource).
+// Resuelve con el estado final del trabajo.
+function followJob(jobId, onUpdate){
+  const id = encodeURIComponent(String(jobId));
+  return new Promise((resolve) => {
+    const done = (job) => {
+      if (onUpdate) onUpdate(job);
+      if (!job.active) {
+        resolve(job);
+        return true;
+      }
+      return false;
+    };
+
+    const poll = async () => {
+      const res = await getJSON(`/api/jobs/${id}`);
+      if (res && res.job) {
+        if (done(res.job)) return;
+      } else if (res && res.ok === false && !res.job) {
+        resolve(res);
+        return;
+      }
+      setTimeout(poll, 1000);
+    };
+
+    if (!window.EventSource) {
+      poll();
+      return;
+    }
+    const es = new EventSource(`/api/jobs/${id}/events`);
+    let finished = false;
+    es.addEventListener("job", (msg) => {
+      try {
+        if (done(JSON.parse(msg.data))) {
+          finished = true;
+          es.close();
+        }
+      } catch (e) {
+        console.error("SSE parse error", e);
+      }
+    });
+    es.addEventListener("error", () => {
+      if (finished) return;
+      // Sin stream (proxy, worker reiniciado...): seguimos por sondeo.
+      es.close();
+      finished = true;
+      poll();
+    });
+  });
+}
+
+async function cancelFormatJob(){
+  if (!_formatJobId) return;
+  if (!confirm("¿Detener el formateo? El disco puede quedar sin tabla de particiones o con un sistema de archivos incompleto.")) {
+    return;
+  }
+  const res = await postJSON(`/api/jobs/${encodeURIComponent(_formatJobId)}/cancel`, {});
+  toast(msgFromResponse(res));
+}
+
 async function enableSamba(id){
   return await postJSON("/api/samba", {id, enable: true});
 }
@@ -391,18 +534,19 @@ function forgetMountDir(id){
 async function mountDisk(id){
   const mount_dir = ensureMountDir(id);
   if (mount_dir === null) return;
-  const res = await postJSON("/api/mount", {id, mount_dir});
-  toast(msgFromResponse(res));
-
-  if (res.ok) {
-    const per = await postJSON("/api/persist", {id, mount_dir, enable: true});
-    toast(msgFromResponse(per));
-
-    const smb = await enableSamba(id);
-    toast(msgFromResponse(smb));
+  // Montar + fstab + Samba en un único request (un solo reinicio de Samba).
+  const res = await postJSON("/api/provision", {disks: [{id, mount_dir, persist: true, share: true}]});
+  const r = (res && Array.isArray(res.results)) ? res.results[0] : null;
+  if (r) {
+    const actions = (r.actions || []).join(", ");
+    toast(r.ok ? `Disco listo en ${r.mountpoint}${actions ? ` (${actions})` : ""}.` : r.error);
+  } else {
+    toast(msgFromResponse(res));
+  }
 
-    // Actualizar solo la fila (sin recargar la página).
-    setTimeout(() => refreshDiskRow(id), 250);
+  // Actualizar solo la fila (sin recargar la página).
+  if (r && (r.ok || (r.actions || []).length)) {
+    applyDiskFromResponse(r, id);
   }
 }
 
@@ -411,7 +555,7 @@ async function reconnectDisk(id){
   const res = await postJSON("/api/mount", { id });
   toast(msgFromResponse(res));
   if (res && res.ok) {
-    setTimeout(() => refreshDiskRow(id), 250);
+    applyDiskFromResponse(res, id);
   }
 }
 async function unmountDisk(id, mountpoint){
@@ -428,7 +572,7 @@ async function unmountDisk(id, mountpoint){
     forgetMountDir(id);
 
     // Actualizar solo la fila (sin recargar la página).
-    setTimeout(() => refreshDiskRow(id), 250);
+    applyDiskFromResponse(per, id);
   }
 }
 
@@ -444,73 +588,179 @@ async function disconnectDisk(id, mountpoint){
   const res = await postJSON("/api/unmount", { id });
   toast(msgFromResponse(res));
   if (res && res.ok) {
-    setTimeout(() => refreshDiskRow(id), 250);
+    applyDiskFromResponse(res, id);
   }
 }
 
-let lastDisksState = null;
+let pollInterval = null;
+let refreshPromptShown = false;
 
-async function pollDisksState() {
-  const path = window.location.pathname;
-  // Check if we are on dashboard or disks page.
-  // Dashboard is usually "/" or "/dashboard" (if configured).
-  // Disks is "/disks".
-  // We can also check for existence of specific DOM elements.
-  const isDashboard = !!document.querySelector(".card-soft"); // Dashboard has cards
-  const isDisksPage = !!document.querySelector("table"); // Disks page has table
+function isDiskStatePage(){
+  // Dashboard tiene tarjetas (.card-soft); la página de discos, tabla.
+  const isDashboard = !!document.querySelector(".card-soft");
+  const isDisksPage = !!document.querySelector("table");
+  return isDashboard || isDisksPage;
+}
 
-  if (!isDashboard && !isDisksPage) return;
+function showRefreshPrompt(){
+  if (refreshPromptShown) return;
+  refreshPromptShown = true;
+
+  const statusEl = document.getElementById("monitorStatus");
+  const btn = document.getElementById("refreshBtn");
+
+  if (statusEl) statusEl.classList.add("d-none");
+  if (btn) {
+    btn.classList.remove("d-none");
+    btn.classList.add("animate__animated", "animate__pulse");
+  } else {
+    // Fallback si no hay botón (p.ej. dashboard)
+    toast("Cambios detectados en los discos. Recarga la página.");
+  }
+}
+
+// Aplica un delta del stream /api/events sin recargar la página.
+function applyDiskEvent(ev){
+  if (!ev || !ev.change) return;
+  if (ev.change === "usage") return; // La tabla no muestra uso; el dashboard lo refresca al recargar.
+
+  const d = ev.disk;
+  const canPatch = d && !d.missing && d.id && (findDiskRow(d.id) || findDiskCard(d.id));
+  if (ev.change === "added" || ev.change === "removed" || !canPatch) {
+    showRefreshPrompt();
+    return;
+  }
+  updateDiskRow(d);
+  updateDiskCard(d);
+}
+
+// Último estado conocido por clave (igual que _disk_key en el servidor).
+const disksByKey = new Map();
+let disksVersion = null;
+let disksEpoch = "";
+let disksEtag = "";
+
+function diskKey(d){
+  if (d && d.missing) return `missing:${d.uuid || ""}:${d.mountpoint || ""}`;
+  return String((d && d.id) || "");
+}
+
+function diskSignature(d){
+  return JSON.stringify([d.label, d.size, d.fstype, d.uuid, d.mounted, d.mountpoint, d.persistent, d.samba]);
+}
+
+function applyPolledDisk(d){
+  const key = diskKey(d);
+  const prev = disksByKey.get(key);
+  disksByKey.set(key, d);
+  if (!prev) {
+    showRefreshPrompt();
+  } else if (diskSignature(prev) !== diskSignature(d)) {
+    applyDiskEvent({ change: "changed", key, id: d.id, disk: d });
+  }
+}
+
+// Sondeo de respaldo: pide solo los cambios desde la última versión (?since=)
+// y deja que el servidor responda 304 si nada cambió.
+async function pollDisksState() {
+  if (!isDiskStatePage()) return;
 
   try {
-    const res = await getJSON("/api/disks");
-    if (res && res.ok && res.disks) {
-      // Sort to ensure stable signature
-      const sorted = res.disks.sort((a, b) => (a.id || "").localeCompare(b.id || ""));
-      // Create signature based on relevant fields
-      const currentSignature = JSON.stringify(sorted.map(d => ({
-        id: d.id,
-        label: d.label,
-        size: d.size,
-        fstype: d.fstype,
-        uuid: d.uuid,
-        mounted: d.mounted,
-        mountpoint: d.mountpoint,
-        persistent: d.persistent,
-        samba: d.samba
-      })));
-
-      if (lastDisksState === null) {
-        lastDisksState = currentSignature;
-      } else if (lastDisksState !== currentSignature) {
-        console.log("Disk state changed.");
-        
-        // Stop polling to avoid loops
-        if (pollInterval) clearInterval(pollInterval);
-        
-        // Update UI to ask for refresh
-        const statusEl = document.getElementById("monitorStatus");
-        const btn = document.getElementById("refreshBtn");
-        
-        if (statusEl) statusEl.classList.add("d-none");
-        if (btn) {
-          btn.classList.remove("d-none");
-          // Optional: Animate or highlight
-          btn.classList.add("animate__animated", "animate__pulse");
-        } else {
-          // Fallback if elements not found (e.g. dashboard)
-          toast("Cambios detectados en los discos. Recarga la página.");
+    const qs = (disksVersion !== null)
+      ? `?since=${encodeURIComponent(disksVersion)}&epoch=${encodeURIComponent(disksEpoch)}`
+      : "";
+    const headers = disksEtag ? { "If-None-Match": disksEtag } : {};
+    const r = await fetch(`/api/disks${qs}`, { method: "GET", headers, cache: "no-store" });
+    if (r.status === 304) return;
+    const res = await r.json();
+    if (!r.ok || !res || !res.ok || res.stale) return;
+
+    const first = disksVersion === null;
+    disksEtag = r.headers.get("ETag") || "";
+    disksVersion = res.version;
+    disksEpoch = res.epoch || "";
+
+    if (res.full) {
+      const seen = new Set();
+      for (const d of (res.disks || [])) {
+        seen.add(diskKey(d));
+        if (first) disksByKey.set(diskKey(d), d);
+        else applyPolledDisk(d);
+      }
+      if (!first) {
+        for (const key of disksByKey.keys()) {
+          if (!seen.has(key)) showRefreshPrompt();
         }
       }
+      return;
     }
+
+    for (const d of (res.changed || [])) applyPolledDisk(d);
+    if ((res.removed || []).length) showRefreshPrompt();
   } catch (e) {
     console.error("Polling error", e);
   }
 }
 
-// Start polling
-let pollInterval = setInterval(pollDisksState, 10000);
-// Initial check
-pollDisksState();
+function startPolling(){
+  if (pollInterval) return;
+  pollInterval = setInterval(pollDisksState, 10000);
+  pollDisksState();
+}
+
+// Preferimos el stream SSE; si el navegador no lo soporta o el stream no llega
+// a abrirse nunca, volvemos al sondeo cada 10 s.
+function startDiskEvents(){
+  if (!isDiskStatePage()) return;
+  if (!window.EventSource) {
+    startPolling();
+    return;
+  }
+
+  let opened = false;
+  const es = new EventSource("/api/events");
+  es.addEventListener("open", () => { opened = true; });
+  es.addEventListener("disk", (msg) => {
+    try {
+      applyDiskEvent(JSON.parse(msg.data));
+    } catch (e) {
+      console.error("SSE parse error", e);
+    }
+  });
+  // Los cambios de Samba se aplican en segundo plano: avisamos cuando terminan,
+  // solo si esta pestaña hizo algo hace poco.
+  es.addEventListener("samba", (msg) => {
+    if (Date.now() - lastPostAt > 60000) return;
+    try {
+      toast(JSON.parse(msg.data).message);
+    } catch (e) {
+      console.error("SSE parse error", e);
+    }
+  });
+  es.addEventListener("error", () => {
+    if (!opened && es.readyState === EventSource.CLOSED) {
+      startPolling();
+    }
+  });
+}
+
+startDiskEvents();
+
+// Página servida con el último estado guardado (servidor recién arrancado):
+// recargamos en cuanto el servidor tenga la vista real.
+async function reloadWhenFresh(){
+  if (!document.getElementById("staleNotice")) return;
+  for (let i = 0; i < 60; i++) {
+    await new Promise((resolve) => setTimeout(resolve, 1000));
+    const res = await getJSON("/api/disks");
+    if (res && res.ok && !res.stale) {
+      window.location.reload();
+      return;
+    }
+  }
+}
+
+reloadWhenFresh();
 
 async function removeMissingDisk(uuid, mountpoint){
   const u = String(uuid || "").trim();
@@ -0,0 +1,58 @@
+"""Entorno de los tests: estado en un directorio temporal y nada compartido con otros procesos."""
+
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+# Antes de importar app (lee estas variables al importarse).
+_TMP = tempfile.mkdtemp(prefix="hyperdrive-tests-")
+os.environ["DISKMANAGER_STATE_DIR"] = os.path.join(_TMP, "run")
+os.environ["DISKMANAGER_DATA_DIR"] = os.path.join(_TMP, "lib")
+os.environ["DISKMANAGER_SHARED_INVENTORY"] = "0"
+
+import app  # noqa: E402
+
+
+class TextBackend(app.SystemBackend):
+    """Backend sin kernel que sirve ficheros de un dict (mountinfo, fstab, smb.conf...)."""
+
+    kernel = False
+
+    def __init__(self, files: dict[str, str] | None = None) -> None:
+        self.files = dict(files or {})
+
+    def read_text(self, path: str) -> str:
+        try:
+            return self.files[path]
+        except KeyError:
+            raise FileNotFoundError(2, "No such file or directory", path) from None
+
+    def write_text(self, path: str, text: str) -> None:
+        self.files[path] = text
+
+    def signature(self, path: str) -> tuple[int, int, int] | None:
+        text = self.files.get(path)
+        return None if text is None else (1, hash(text), len(text))
+
+    def exists(self, path: str) -> bool:
+        return path in self.files
+
+
+@pytest.fixture
+def backend():
+    """Instala un `TextBackend` vacío y restaura el anterior al acabar."""
+
+    fake = TextBackend()
+    previous = app.set_backend(fake)
+    try:
+        yield fake
+    finally:
+        app.set_backend(previous)
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import app
+
+
+def _disk(id_: str, **kw):
+    d = {"id": id_, "label": id_, "size": "10G", "fstype": "ext4", "uuid": f"u-{id_}", "mounted": False, "mountpoint": None}
+    d.update(kw)
+    return d
+
+
+def _changes(events):
+    return {ev["key"]: ev["change"] for ev in events}
+
+
+def test_diff_disks_reports_every_kind_of_change():
+    old = app._index_disks([
+        _disk("sdb1"),
+        _disk("sdc1", mounted=True, mountpoint="/mnt/c"),
+        _disk("sdd1"),
+        _disk("sde1", usage={"percent": 10}),
+        _disk("sdf1"),
+        _disk("sdg1"),
+    ])
+    new = app._index_disks([
+        _disk("sdb1", mounted=True, mountpoint="/mnt/b"),
+        _disk("sdc1"),
+        _disk("sdd1", label="datos"),
+        _disk("sde1", usage={"percent": 55}),
+        _disk("sdf1"),
+        _disk("sdh1"),
+    ])
+    assert _changes(app.diff_disks(old, new)) == {
+        "sdb1": "mounted",
+        "sdc1": "unmounted",
+        "sdd1": "changed",
+        "sde1": "usage",
+        "sdh1": "added",
+        "sdg1": "removed",
+    }
+    assert app.diff_disks(new, new) == []
+
+
+def test_missing_entries_are_keyed_by_uuid_and_mountpoint():
+    missing = {"missing": True, "uuid": "abcd", "mountpoint": "/mnt/x", "id": None}
+    assert app._disk_key(missing) == "missing:abcd:/mnt/x"
+    events = app.diff_disks({}, app._index_disks([missing]))
+    assert events[0]["key"] == "missing:abcd:/mnt/x" and events[0]["change"] == "added"
+
+
+class _Views:
+    """Sustituto de `disks_view`: devuelve la lista fijada y cuenta los recálculos."""
+
+    def __init__(self, disks):
+        self.disks = disks
+        self.calls = 0
+
+    def __call__(self, _snapshot):
+        self.calls += 1
+        return [dict(d) for d in self.disks]
+
+
+def test_tracker_version_bumps_only_on_changes(backend, monkeypatch):
+    views = _Views([_disk("sdb1"), _disk("sdc1")])
+    monkeypatch.setattr(app, "disks_view", views)
+    tracker = app._DiskStateTracker()
+
+    v1, disks = tracker.current()
+    assert v1 == 1 and [d["id"] for d in disks] == ["sdb1", "sdc1"]
+    # Sin cambios en las fuentes ni siquiera se recalcula.
+    assert tracker.current()[0] == v1 and views.calls == 1
+
+    # Una notificación sin deltas recalcula pero no cambia de versión.
+    app._changes.notify("devices")
+    assert tracker.current()[0] == v1 and views.calls == 2
+
+    views.disks = [_disk("sdb1", mounted=True, mountpoint="/mnt/b"), _disk("sdd1")]
+    app._changes.notify("devices")
+    v2, _ = tracker.current()
+    assert v2 == v1 + 1
+
+    version, changed, removed = tracker.delta(v1)
+    assert version == v2
+    assert sorted(d["id"] for d in changed) == ["sdb1", "sdd1"]
+    assert removed == ["sdc1"]
+    assert tracker.delta(v2) == (v2, [], [])
+    # Versiones del futuro (otro epoch o proceso reiniciado): respuesta completa.
+    assert tracker.delta(v2 + 1) is None
+    assert tracker.etag(v2) == f"{tracker.epoch}-{v2}"
+
+
+def test_tracker_forgets_old_removals(backend, monkeypatch):
+    views = _Views([_disk(f"sd{c}1") for c in "bcde"])
+    monkeypatch.setattr(app, "disks_view", views)
+    tracker = app._DiskStateTracker()
+    tracker.REMOVED_HISTORY = 2
+
+    v1, _ = tracker.current()
+    for remaining in ("cde", "de", "e"):
+        views.disks = [_disk(f"sd{c}1") for c in remaining]
+        app._changes.notify("devices")
+        tracker.current()
+
+    # La baja de sdb1 (v2) ya no se recuerda: desde v1 no se puede servir delta.
+    assert tracker.delta(v1) is None
+    version, _changed, removed = tracker.delta(v1 + 1)
+    assert sorted(removed) == ["sdc1", "sdd1"] and version == v1 + 3
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import pytest
+from fake_backend import FakeBackend
+
+import app
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    def no_real_processes(*a, **kw):
+        raise AssertionError("el formateo no debe lanzar procesos reales con un backend simulado")
+
+    monkeypatch.setattr(app.subprocess, "Popen", no_real_processes)
+    monkeypatch.setattr(app.subprocess, "run", no_real_processes)
+    fake = FakeBackend(4)
+    previous = app.set_backend(fake)
+    try:
+        yield fake
+    finally:
+        app.set_backend(previous)
+
+
+def _format(disk: str) -> app.Job:
+    job = app.Job.create("format", disk, {"fstype": "ext4", "label": ""})
+    app._format_job(job, disk, "ext4", "")
+    return job
+
+
+def test_format_job_runs_entirely_through_the_backend(fake):
+    before = {p["name"]: p.get("uuid") for p in app.lsblk_partitions() if p.get("pkname") == "vd1"}
+
+    job = _format("vd1")
+
+    assert job.data["status"] == "succeeded", job.data
+    assert fake.calls["mkfs.ext4"] == 1
+    after = {p["name"]: p.get("uuid") for p in app.lsblk_partitions() if p.get("pkname") == "vd1"}
+    assert after.keys() == before.keys() and after != before
+
+
+def test_format_job_refuses_unknown_devices(fake):
+    job = _format("vd99")
+    assert job.data["status"] == "failed"
+    assert "No se pudo validar /dev/vd99" in job.data.get("details", "")
+    assert fake.calls["mkfs.ext4"] == 0 and fake.calls["wipefs"] == 0
+
+
+def test_real_backend_streams_progress_lines():
+    lines: list[str] = []
+    rc, tail = app.SystemBackend().run_streaming(
+        ["sh", "-c", "printf '1/4\\r2/4\\bhecho\\n'; exit 3"],
+        timeout_s=10,
+        on_output=lines.append,
+        should_cancel=lambda: False,
+    )
+    assert rc == 3 and lines == ["1/4", "2/4", "hecho"] and tail.endswith("hecho")
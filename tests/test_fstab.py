@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import os
+import stat
+
+import fixtures
+import pytest
+
+import app
+
+
+def _store(text: str) -> app.FstabStore:
+    return app.FstabStore(text.splitlines(keepends=True))
+
+
+def test_fixture_round_trip_and_indexes():
+    text = fixtures.fstab_text(5, 3)
+    store = _store(text)
+
+    assert "".join(store.lines) == text
+    assert [e.mountpoint for e in store.entries] == ["/", "/boot/efi", "none"] + [f"/mnt/disk{i}" for i in range(5)]
+    e = store.by_mountpoint["/mnt/disk2"]
+    assert e.uuid == fixtures.device_uuid(2) and store.by_uuid[e.uuid] is e
+    assert store.lines[e.line].rstrip("\n") == e.raw
+    assert (e.fstype, e.options, e.dump, e.passno) == ("ext4", "defaults,nofail,x-diskmanager", "0", "2")
+    # Sin UUID= (swapfile) no entra en by_uuid.
+    assert store.by_mountpoint["none"].uuid is None
+    assert len(store.by_uuid) == 7
+
+
+def test_optional_columns_and_junk_lines():
+    store = _store("  # comentario\n\n/dev/sdb1 /mnt/b ext4 defaults\nbasura sin columnas\n/dev/sdc1 /mnt/c/ xfs ro 0 0 extra\n")
+    b, c = store.entries
+    assert (b.dump, b.passno) == ("0", "0")
+    assert store.by_mountpoint["/mnt/c"] is c and c.options == "ro"
+
+
+def test_add_and_remove_keep_the_rest_untouched():
+    text = fixtures.fstab_text(3, 3)
+    store = _store(text)
+
+    store.add("nuevo-uuid", "/mnt/nuevo", "ext4")
+    assert store.dirty
+    e = store.by_uuid["nuevo-uuid"]
+    assert "x-diskmanager" in e.options.split(",") and e.mountpoint == "/mnt/nuevo"
+    assert store.lines[e.line - 1] == "# diskmanager\n"
+    assert "".join(store.lines).startswith(text)
+
+    # Quitar la entrada se lleva también su cabecera y la línea en blanco previa.
+    assert store.remove([store.by_mountpoint["/mnt/nuevo"]]) == 1
+    assert "".join(store.lines) == text
+
+    assert store.remove([store.by_mountpoint["/mnt/disk1"]]) == 1
+    assert "".join(store.lines) == text.replace(f"\n# diskmanager\nUUID={fixtures.device_uuid(1)}\t/mnt/disk1\text4\tdefaults,nofail,x-diskmanager\t0\t2\n", "")
+    assert "/mnt/disk1" not in store.by_mountpoint and store.by_mountpoint["/mnt/disk2"].line == len(store.lines) - 1
+
+
+def test_add_after_unterminated_last_line():
+    store = _store("UUID=a\t/\text4\tdefaults\t0\t1")
+    store.add("b", "/mnt/b", "ext4")
+    assert [e.mountpoint for e in store.entries] == ["/", "/mnt/b"]
+
+
+def test_commit_writes_backup_and_new_text(backend):
+    text = fixtures.fstab_text(2, 2)
+    backend.files[app.FSTAB_PATH] = text
+    store = app.FstabStore.load()
+
+    # Sin cambios no se escribe nada.
+    assert store.commit() == (True, "", "")
+    assert list(backend.files) == [app.FSTAB_PATH]
+
+    store.add("nuevo-uuid", "/mnt/nuevo", "ext4")
+    ok, backup, err = store.commit()
+    assert ok and not err and not store.dirty
+    assert backup.startswith(f"{app.FSTAB_PATH}.bak.diskmanager.")
+    assert backend.files[backup] == text
+    assert backend.files[app.FSTAB_PATH] == "".join(store.lines)
+    assert app.FstabStore.load().by_uuid["nuevo-uuid"].mountpoint == "/mnt/nuevo"
+
+
+def test_atomic_write_keeps_mode_and_leaves_no_temp_files(tmp_path):
+    path = tmp_path / "fstab"
+    path.write_text("viejo\n")
+    os.chmod(path, 0o640)
+
+    app._atomic_write_text(str(path), "nuevo\n")
+    assert path.read_text() == "nuevo\n"
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+    assert os.listdir(tmp_path) == ["fstab"]
+
+
+def test_atomic_write_failure_keeps_original(tmp_path, monkeypatch):
+    path = tmp_path / "fstab"
+    path.write_text("viejo\n")
+
+    def broken_replace(src, dst):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(app.os, "replace", broken_replace)
+    with pytest.raises(OSError):
+        app._atomic_write_text(str(path), "nuevo\n")
+    assert path.read_text() == "viejo\n"
+    assert os.listdir(tmp_path) == ["fstab"]
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import hashlib
+import itertools
+import threading
+import time
+
+import flask
+
+import app
+
+
+def _make_app(handler):
+    web = flask.Flask("idempotency-test")
+
+    @web.post("/op")
+    @app.idempotent
+    def op():
+        return handler()
+
+    return web
+
+
+def _same_stripe_keys() -> tuple[str, str]:
+    """Dos claves distintas que caen en el mismo lock `idem-XX`."""
+
+    seen: dict[str, str] = {}
+    for i in itertools.count():
+        key = f"k{i}-{time.time_ns()}"
+        stripe = hashlib.sha256(f"POST /op {key}".encode()).hexdigest()[:2]
+        if stripe in seen:
+            return seen[stripe], key
+        seen[stripe] = key
+    raise AssertionError("inalcanzable")
+
+
+def test_duplicate_waits_and_gets_stored_response():
+    calls = []
+
+    def handler():
+        calls.append(1)
+        time.sleep(0.3)
+        return flask.jsonify({"ok": True, "n": len(calls)})
+
+    web = _make_app(handler)
+    key = f"dup-{time.time_ns()}"
+    results = []
+
+    def post():
+        with web.test_client() as c:
+            results.append(c.post("/op", json={"id": "sdb1"}, headers={"Idempotency-Key": key}))
+
+    threads = [threading.Thread(target=post) for _ in range(2)]
+    for t in threads:
+        t.start()
+        time.sleep(0.05)
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert [r.get_json()["n"] for r in results] == [1, 1]
+    assert sorted(r.headers.get("Idempotent-Replayed") or "" for r in results) == ["", "true"]
+
+
+def test_keys_sharing_a_stripe_do_not_serialize():
+    release = threading.Event()
+
+    def handler():
+        if flask.request.json.get("slow"):
+            release.wait(5)
+        return flask.jsonify({"ok": True})
+
+    web = _make_app(handler)
+    slow_key, fast_key = _same_stripe_keys()
+    slow = threading.Thread(
+        target=lambda: web.test_client().post("/op", json={"slow": True}, headers={"Idempotency-Key": slow_key})
+    )
+    slow.start()
+    time.sleep(0.1)
+    try:
+        started = time.monotonic()
+        resp = web.test_client().post("/op", json={"slow": False}, headers={"Idempotency-Key": fast_key})
+        assert resp.status_code == 200
+        assert time.monotonic() - started < 1.0
+    finally:
+        release.set()
+        slow.join()
+
+
+def test_errors_are_not_stored_and_reused_key_with_other_body_is_rejected():
+    statuses = iter([500, 200])
+
+    def handler():
+        return flask.jsonify({"ok": True}), next(statuses)
+
+    web = _make_app(handler)
+    c = web.test_client()
+    key = f"retry-{time.time_ns()}"
+    assert c.post("/op", json={"id": "a"}, headers={"Idempotency-Key": key}).status_code == 500
+    assert c.post("/op", json={"id": "a"}, headers={"Idempotency-Key": key}).status_code == 200
+    assert c.post("/op", json={"id": "b"}, headers={"Idempotency-Key": key}).status_code == 422
+
+
+def test_pruning_is_rate_limited_and_off_the_request_path(monkeypatch):
+    pruned = []
+    done = threading.Event()
+
+    def fake_prune(now):
+        pruned.append((now, threading.current_thread().name))
+        done.set()
+
+    monkeypatch.setattr(app, "_prune_idempotency", fake_prune)
+    monkeypatch.setattr(app, "_idempotency_pruned_at", 0.0)
+    now = time.time()
+
+    app._maybe_prune_idempotency(now)
+    assert done.wait(2)
+    # Dentro del intervalo, los siguientes POST no vuelven a recorrer el directorio.
+    app._maybe_prune_idempotency(now + 1)
+    app._maybe_prune_idempotency(now + app.IDEMPOTENCY_PRUNE_INTERVAL_S - 1)
+    done.clear()
+    app._maybe_prune_idempotency(now + app.IDEMPOTENCY_PRUNE_INTERVAL_S)
+    assert done.wait(2)
+    assert [t for t, _name in pruned] == [now, now + app.IDEMPOTENCY_PRUNE_INTERVAL_S]
+    assert all(name == "idempotency-prune" for _t, name in pruned)
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import os
+
+import app
+
+
+MOUNTINFO = (
+    "22 1 0:31 /root / rw,relatime shared:1 - btrfs /dev/sda3 rw,subvol=/root\n"
+    "23 22 0:31 /home /home rw,relatime shared:2 - btrfs /dev/sda3 rw,subvol=/home\n"
+    "24 22 8:1 / /boot/efi rw,relatime shared:3 - vfat /dev/sda1 rw\n"
+    "25 22 8:17 / /mnt/mis\\040datos rw,relatime shared:4 - ext4 /dev/sdb1 rw\n"
+    "26 22 0:5 / /dev rw,nosuid shared:5 - devtmpfs devtmpfs rw\n"
+    "27 22 253:0 / /mnt/cifrado rw,relatime shared:6 - ext4 /dev/mapper/datos rw\n"
+)
+
+
+def test_parse_mountinfo_unescapes_fields():
+    entries = app._parse_mountinfo(MOUNTINFO + "línea rota sin separador\n")
+
+    assert len(entries) == 6
+    data = entries[3]
+    assert data.mountpoint == "/mnt/mis datos"
+    assert data.devno == "8:17"
+    assert data.fstype == "ext4"
+    assert data.source == "/dev/sdb1"
+    assert entries[0].root == "/root"
+
+
+def test_first_by_devno_and_source(backend):
+    backend.files[app.MOUNTINFO_PATH] = MOUNTINFO
+    app._mount_table.refresh()
+
+    by_devno = app._mount_table.first_by_devno()
+    assert by_devno["8:17"] == "/mnt/mis datos"
+    # btrfs: número anónimo, nunca es el de un dispositivo de bloques.
+    assert "8:3" not in by_devno
+
+    by_source = app._mount_table.first_by_source()
+    # Dos subvolúmenes del mismo origen: gana "/".
+    assert by_source["/dev/sda3"] == "/"
+    assert by_source["/dev/mapper/datos"] == "/mnt/cifrado"
+    assert "devtmpfs" not in by_source
+
+
+def _write(path: str, text: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text + "\n")
+
+
+def _fake_sysfs(tmp_path, monkeypatch):
+    """sda (sistema, btrfs en sda3) + sdb con sdb1 + dm-0 sobre sdb2."""
+
+    devices = tmp_path / "devices"
+    block = tmp_path / "class" / "block"
+    udev = tmp_path / "udev"
+    block.mkdir(parents=True)
+    udev.mkdir()
+
+    def disk(name: str, devno: str) -> str:
+        d = devices / "pci0000:00" / "block" / name
+        _write(str(d / "dev"), devno)
+        _write(str(d / "size"), "1000000")
+        _write(str(d / "removable"), "0")
+        os.symlink(d, block / name)
+        return str(d)
+
+    def part(disk_dir: str, name: str, devno: str, fstype: str) -> str:
+        d = os.path.join(disk_dir, name)
+        _write(os.path.join(d, "dev"), devno)
+        _write(os.path.join(d, "size"), "1000")
+        _write(os.path.join(d, "partition"), name[-1])
+        os.symlink(d, block / name)
+        _write(str(udev / f"b{devno}"), f"E:ID_FS_TYPE={fstype}\nE:ID_FS_UUID=uuid-{name}")
+        return d
+
+    sda = disk("sda", "8:0")
+    part(sda, "sda1", "8:1", "vfat")
+    part(sda, "sda3", "8:3", "btrfs")
+    sdb = disk("sdb", "8:16")
+    part(sdb, "sdb1", "8:17", "ext4")
+    part(sdb, "sdb2", "8:18", "crypto_LUKS")
+    dm = devices / "virtual" / "block" / "dm-0"
+    _write(str(dm / "dev"), "253:0")
+    _write(str(dm / "size"), "900")
+    _write(str(dm / "dm" / "name"), "datos")
+    _write(str(dm / "dm" / "uuid"), "CRYPT-LUKS2-abc-datos")
+    (dm / "slaves").mkdir()
+    os.symlink(os.path.join(sdb, "sdb2"), dm / "slaves" / "sdb2")
+    os.symlink(dm, block / "dm-0")
+    _write(str(udev / "b253:0"), "E:ID_FS_TYPE=ext4")
+
+    monkeypatch.setattr(app, "SYS_CLASS_BLOCK", str(block))
+    monkeypatch.setattr(app, "UDEV_DATA_DIR", str(udev))
+
+
+def test_sysfs_links_btrfs_root_by_source(tmp_path, monkeypatch, backend):
+    _fake_sysfs(tmp_path, monkeypatch)
+    backend.files[app.MOUNTINFO_PATH] = MOUNTINFO
+    app._mount_table.refresh()
+
+    parts = {p["name"]: p for p in app.sysfs_partitions()}
+    assert parts["sda3"]["mountpoint"] == "/"
+    assert parts["sda1"]["mountpoint"] == "/boot/efi"
+    assert parts["sdb1"]["mountpoint"] == "/mnt/mis datos"
+    assert parts["datos"]["mountpoint"] == "/mnt/cifrado"
+    assert parts["datos"]["pkname"] == "sdb2"
+
+    graph = app.DeviceGraph(list(parts.values()))
+    assert graph.root_disk == "sda"
+    assert graph.on_root_disk(graph.get("sda3"))
+    assert not graph.on_root_disk(graph.get("sdb1"))
+
+
+def test_unknown_root_fails_closed(tmp_path, monkeypatch, backend):
+    _fake_sysfs(tmp_path, monkeypatch)
+    # "/" en un origen que no es ningún nodo conocido.
+    backend.files[app.MOUNTINFO_PATH] = "22 1 0:31 / / rw - btrfs /dev/nvme9n1p9 rw\n"
+    app._mount_table.refresh()
+
+    graph = app.DeviceGraph(app.sysfs_partitions())
+    assert graph.root_disk is None
+    assert all(not app._is_manageable(n, graph) for n in graph.nodes)
+
+
+def test_root_without_block_device_keeps_disks_manageable(tmp_path, monkeypatch, backend):
+    _fake_sysfs(tmp_path, monkeypatch)
+    # Contenedor o netboot: "/" es un overlay, ningún disco es el del sistema.
+    backend.files[app.MOUNTINFO_PATH] = (
+        "600 500 0:52 / / rw,relatime - overlay overlay rw,lowerdir=/l,upperdir=/u,workdir=/w\n"
+        "601 600 8:17 / /mnt/mis\\040datos rw,relatime - ext4 /dev/sdb1 rw\n"
+    )
+    app._mount_table.refresh()
+
+    graph = app.DeviceGraph(app.sysfs_partitions())
+    assert graph.root_disk is None and not graph.root_unresolved
+    assert not graph.on_root_disk(graph.get("sda3"))
+    assert graph.get("sdb1").mountpoint == "/mnt/mis datos"
@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def applies(monkeypatch):
+    """Sustituye el apply real; devuelve la lista de `restart` de cada ejecución."""
+
+    calls: list[bool] = []
+    lock = threading.Lock()
+
+    def fake_apply(restart: bool):
+        with lock:
+            calls.append(restart)
+        return {"ok": True, "mode": "restart" if restart else "reload", "sessions": 0, "dropped": 0}
+
+    monkeypatch.setattr(app, "_apply_samba_now", fake_apply)
+    return calls
+
+
+def _wait_applied(applier: app._SambaApplier, ticket: int) -> None:
+    deadline = time.monotonic() + 5
+    while applier.last()[0] < ticket and time.monotonic() < deadline:
+        time.sleep(0.02)
+
+
+def test_burst_across_workers_is_applied_once(tmp_path, applies):
+    path = str(tmp_path / "samba-apply.json")
+    # Dos workers: cada uno con su applier, mismo fichero de estado.
+    a = app._SambaApplier(0.2, path)
+    b = app._SambaApplier(0.2, path)
+
+    started = time.monotonic()
+    assert a.request() == {"ok": True, "mode": "pending"}
+    assert b.request() == {"ok": True, "mode": "pending"}
+    assert a.request() == {"ok": True, "mode": "pending"}
+    # El request no espera al debounce ni al apply.
+    assert time.monotonic() - started < 0.15
+
+    _wait_applied(a, 3)
+    assert applies == [False]
+    assert a.last() == b.last() == (3, {"ok": True, "mode": "reload", "sessions": 0, "dropped": 0})
+
+
+def test_wait_returns_the_result_and_restart_is_shared(tmp_path, applies):
+    path = str(tmp_path / "samba-apply.json")
+    a = app._SambaApplier(0.05, path)
+    b = app._SambaApplier(0.05, path)
+
+    # Otro worker cambió [global]: el siguiente lote, sea de quien sea, es un restart.
+    b.mark_restart()
+    assert a.request(wait=True, timeout_s=5)["mode"] == "restart"
+    assert a.request(wait=True, timeout_s=5)["mode"] == "reload"
+    assert applies == [True, False]
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import fixtures
+
+import app
+
+
+def _conf(text: str) -> app.SmbConf:
+    return app.SmbConf(text.splitlines(keepends=True))
+
+
+def test_fixture_shares_and_indexes():
+    text = fixtures.smb_conf_text(6)
+    conf = _conf(text)
+
+    assert "".join(conf.lines) == text
+    shares = conf.shares()
+    # [global], [printers] y [print$] no son shares de usuario.
+    assert [s["name"] for s in shares] == [f"disk{i}" for i in range(6)]
+    assert [s["enabled"] for s in shares] == [bool(i % 3) for i in range(6)]
+    assert all(not s["read_only"] and not s["public"] for s in shares)
+
+    assert "global" not in conf.by_name
+    assert conf.share_by_name(" DISK4 ") is conf.by_name["disk4"]
+    assert conf.share_by_path("/mnt/disk4/") is conf.by_name["disk4"]
+    sec = conf.by_name["disk4"]
+    assert conf.lines[sec.start].strip() == "[disk4]"
+    assert sec.get("path") == "/mnt/disk4" and sec.flag("browseable") is True
+
+
+def test_set_available_replaces_existing_line_keeping_indent():
+    conf = _conf(fixtures.smb_conf_text(3))
+    sec = conf.by_name["disk0"]
+    before = list(conf.lines)
+    line_no = sec.params["available"][0]
+
+    assert conf.set_available(sec, True) is True
+    assert conf.lines[line_no] == "   available = yes\n"
+    assert [ln for i, ln in enumerate(conf.lines) if i != line_no] == [ln for i, ln in enumerate(before) if i != line_no]
+    assert conf.by_name["disk0"].flag("available") is True
+    # Ya habilitado: no toca nada.
+    assert conf.set_available(conf.by_name["disk0"], True) is False
+
+
+def test_set_available_inserts_after_header():
+    conf = _conf("[global]\n\tworkgroup = X\n\n[datos]\n\tpath = /mnt/datos\n; comentario\n")
+    sec = conf.by_name["datos"]
+    assert sec.flag("available") is None and conf.shares()[0]["enabled"]
+
+    assert conf.set_available(sec, False) is True
+    assert conf.lines[3:6] == ["[datos]\n", "   available = no\n", "\tpath = /mnt/datos\n"]
+    assert conf.lines[-1] == "; comentario\n"
+    assert conf.shares() == [{"name": "datos", "path": "/mnt/datos", "public": False, "read_only": False, "enabled": False}]
+
+
+def test_remove_and_append_reindex():
+    conf = _conf(fixtures.smb_conf_text(3))
+    conf.remove(conf.by_name["disk1"])
+    assert "disk1" not in conf.by_name and conf.share_by_path("/mnt/disk1") is None
+    assert [s["name"] for s in conf.shares()] == ["disk0", "disk2"]
+
+    conf.lines[-1] = conf.lines[-1].rstrip("\n")
+    conf.append("\n[nuevo]\n   path = /mnt/nuevo\n")
+    assert conf.lines[-2].endswith("\n")
+    assert conf.share_by_path("/mnt/nuevo") is conf.by_name["nuevo"]
+    assert conf.by_name["disk2"].end == conf.by_name["nuevo"].start
+
+
+def test_aliases_later_one_wins():
+    conf = _conf(
+        "[a]\n   path = /mnt/a\n   writable = yes\n   read only = yes\n   public = yes\n   guest ok = no\n"
+        "[b]\n   path = /mnt/b\n   read only = yes\n   writable = yes\n   guest ok = no\n   public = yes\n"
+    )
+    a, b = conf.shares()
+    assert a["read_only"] is True and a["public"] is False
+    assert b["read_only"] is False and b["public"] is True
+
+
+def test_load_smb_conf_is_cached_by_signature(backend):
+    assert app.load_smb_conf() is None
+
+    backend.files[app.SMB_CONF_PATH] = fixtures.smb_conf_text(2)
+    first = app.load_smb_conf()
+    assert first is not None and app.load_smb_conf() is first
+
+    # Para editar, copia propia: no ensucia la caché.
+    editable = app.load_smb_conf(for_edit=True)
+    assert editable is not first
+    editable.remove(editable.by_name["disk0"])
+    assert "disk0" in app.load_smb_conf().by_name
+
+    backend.files[app.SMB_CONF_PATH] = fixtures.smb_conf_text(4)
+    reloaded = app.load_smb_conf()
+    assert reloaded is not first and len(reloaded.shares()) == 4
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import app
+
+
+class HangingBackend(app.SystemBackend):
+    """statvfs que no vuelve en los montajes de `hung` (hasta que se suelta `unblock`)."""
+
+    kernel = False
+
+    def __init__(self, hung: set[str]) -> None:
+        self.hung = hung
+        self.unblock = threading.Event()
+
+    def disk_usage(self, path: str) -> tuple[int, int, int]:
+        if path in self.hung:
+            self.unblock.wait(30)
+        return 100, 40, 60
+
+
+def test_hung_mounts_do_not_starve_the_rest():
+    hung = {"/mnt/nfs1", "/mnt/nfs2"}
+    fake = HangingBackend(hung)
+    previous = app.set_backend(fake)
+    try:
+        prober = app._UsageProber(2)
+        first = prober.probe_many(sorted(hung), timeout_s=0.2)
+        assert all(first[mp]["unresponsive"] for mp in hung)
+
+        # Las dos plazas están "ocupadas" por montajes colgados: el resto debe seguir respondiendo.
+        started = time.monotonic()
+        ok = prober.probe_many(["/mnt/usb", *sorted(hung)], timeout_s=0.5)
+        assert ok["/mnt/usb"]["used_bytes"] == 40
+        assert ok["/mnt/nfs1"]["unresponsive"]
+        assert time.monotonic() - started < 1.0
+
+        # Al volver, el colgado no devuelve su plaza dos veces (BoundedSemaphore lanzaría ValueError).
+        fake.unblock.set()
+        deadline = time.monotonic() + 2
+        while prober._inflight and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not prober._inflight
+        assert prober.probe("/mnt/nfs1")["used_bytes"] == 40
+    finally:
+        fake.unblock.set()
+        app.set_backend(previous)
+
+
+def test_known_hung_mount_is_not_waited_for_again():
+    fake = HangingBackend({"/mnt/nfs1"})
+    previous = app.set_backend(fake)
+    try:
+        prober = app._UsageProber(2)
+        assert prober.probe_many(["/mnt/nfs1"], timeout_s=0.2)["/mnt/nfs1"]["unresponsive"]
+
+        # Sigue colgado desde hace más de un plazo: stale al momento, sin volver a esperar.
+        started = time.monotonic()
+        again = prober.probe_many(["/mnt/nfs1", "/mnt/usb"], timeout_s=0.2)
+        assert again["/mnt/nfs1"]["unresponsive"] and again["/mnt/usb"]["used_bytes"] == 40
+        assert time.monotonic() - started < 0.15
+    finally:
+        fake.unblock.set()
+        app.set_backend(previous)